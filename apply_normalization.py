@@ -13,76 +13,277 @@
 #                               columns
 #      --id, -i [ID]          Name of column in csv file with IDs 
 #                               (default = BraTS18ID)
+#      --manifest, -m [FILE]  Build manifest recording input hashes and
+#                                parameters of each output. Outputs are only
+#                                rebuilt when these change
+#                                (default = CSVNAME_manifest.json)
+#      --landmarks, -l [FILE] Landmark json file. Learned from this cohort
+#                                if it does not exist, otherwise reused
+#                                (default = CSVNAME_landmarks.json)
+#      --workers, -w [N]      Worker processes for landmark normalization
+#                                (default = 1)
+#      --segmodule            Use the per-row Segmodule segment_and_normalize
+#                                instead of the cohort landmark normalization
+#                                (Segmodule from Neuroimage_Pipeline has to
+#                                be on the PYTHONPATH)
+#      --in-process           Create mask/tumor/nontumor in process with
+#                                SimpleITK instead of with c3d commands. The
+#                                masks have the same voxels and geometry as
+#                                the c3d ones but are not byte identical
+#                                (default = False, use c3d)
 #      --atropos, -a          Logical (True/False) whether or not to run
 #                                automatic gray/white/csf segmentation
 #                                for tissue labels, requires T2, FLAIR
 #                                images and 'atropos' column
 #                                  (default = False)
+#      --jobs, -j [N]         Threads shared by the c3d/Atropos commands. The
+#                                commands of different subjects run
+#                                concurrently, each subject's mask/tumor ->
+#                                nontumor -> Atropos in order
+#                                (default = cpu count)
+#      --atropos-threads [N]  ITK threads per Atropos command (default = 4)
+#      --trace [FILE]         Append per subject/stage timing and resource
+#                                records to FILE, see stageTrace.py
+#      --shard [i/N]          Only process shard i (0 based) of N, balanced
+#                                by input file sizes, see shardCohort.py.
+#                                Each shard has its own manifest. Landmarks
+#                                are only applied once the landmark file
+#                                exists (landmarkNormalization.py learn after
+#                                all shards made their masks)
 
 import os
 import argparse
 import csv
 import sys
+import numpy as np
+import SimpleITK as sitk
 
-sys.path.append('/rsrch1/ip/egates1/github/RadPath/Code/Neuroimage_Pipeline')
-
-from Segmodule import *
-
-# Get params from cmd line
-# Default don't include overwrite option
-parser = argparse.ArgumentParser(description = "Normalizes images based on filepath csv")
-parser.add_argument("--file", "-f", help = "CSV with IDs", 
-      required = True) 
-parser.add_argument("--id", "-i", default = "BraTS18ID", 
-      help = "Name of column with IDs")
-#parser.add_argument("--overwrite", "-o", action = "store_true",
-#      help = "Overwrite given csv of IDs")
-parser.add_argument("--atropos", "-a", default = False,
-      help = "Option to run Atropos auto tissue segmentation")
-args = parser.parse_args()
-
-print(os.getcwd())
-IDvar = args.id
-csvPath = args.file
-with open(csvPath,'r') as csvData:
-  csvR = csv.DictReader(csvData)
-
-  for row in csvR:
-    outdir = '/'.join([row['type'],row[IDvar]])
-    
-#create mask if it doesn't exist already
+from buildManifest import BuildManifest, manifestPath
+from commandScheduler import Task, reportFailures, runTasks, toolThreads
+from shardCohort import parseShard, shardPath, shardRows
+from stageTrace import enableTrace, stage
+from volumeCache import imageWritten, readImage
+import landmarkNormalization as ln
+
+# Parameters of each step, recorded in the build manifest. Changing one of
+# these rebuilds that step's outputs
+maskParams = '-background 0 -binarize -type uchar'
+nontumorParams = '-scale -1 -add -threshold 1 1 1 0 -type uchar'
+atroposParams = '-d 3 -c [5,0.001] -m [0.2,1x1x1] -i kmeans[3]'
+atroposBin = '/opt/apps/ANTsR/dev//ANTsR_src/ANTsR/src/ANTS/ANTS-build//bin/Atropos'
+landmarkParams = 'landmarks %s' % ln.landmarkPercentiles
+
+def deriveMasks(t1path, segpath, maskpath, tumorpath, nontumorpath, manifest):
+  # Same outputs as the c3d commands but reads T1 and seg at most once each:
+  #   mask     = c3d T1 -background 0 -binarize -type uchar
+  #   tumor    = c3d seg -background 0 -binarize -type uchar
+  #   nontumor = c3d mask tumor -scale -1 -add -threshold 1 1 1 0 -type uchar
+  # Only stale outputs are written. Voxel values, size, origin, spacing and
+  # direction match the c3d outputs; the rest of the NIfTI header and the
+  # gzip bytes do not, so files are not byte identical. c3d stays the
+  # default, this is used with --in-process and by subjectPipeline.py
+  images = {}
+
+  def getMask():
+    if 'mask' not in images:
+      images['T1'] = readImage(t1path)
+      images['mask'] = (sitk.GetArrayViewFromImage(images['T1']) != 0).astype(np.uint8)
+    return images['mask']
+
+  def getTumor():
+    if 'tumor' not in images:
+      images['seg'] = readImage(segpath)
+      images['tumor'] = (sitk.GetArrayViewFromImage(images['seg']) != 0).astype(np.uint8)
+    return images['tumor']
+
+  if manifest.isStale(maskpath, [t1path], maskParams):
+    writeMask(getMask(), images['T1'], maskpath)
+    manifest.record(maskpath, [t1path], maskParams)
+  if manifest.isStale(tumorpath, [segpath], maskParams):
+    writeMask(getTumor(), images['seg'], tumorpath)
+    manifest.record(tumorpath, [segpath], maskParams)
+  if manifest.isStale(nontumorpath, [maskpath, tumorpath], nontumorParams):
+    writeMask(getMask() & (getTumor() ^ 1), images['T1'], nontumorpath)
+    manifest.record(nontumorpath, [maskpath, tumorpath], nontumorParams)
+
+def commandTask(subject, name, command, output, inputs, params, manifest, after = ()):
+  # Task running command to rebuild output, or None if output is current.
+  # Outputs of tasks depending on a task that runs are rebuilt as well
+  after = [task for task in after if task is not None]
+  if not after and not manifest.isStale(output, inputs, params):
+    return None
+  def record(task):
+    manifest.record(output, inputs, params)
+    manifest.save()
+  return Task(subject, name, command, after, record)
+
+def writeMask(arr, reference, path):
+  # Write uint8 array with the geometry of the image it was derived from
+  img = sitk.GetImageFromArray(arr)
+  img.CopyInformation(reference)
+  print('Created %s' % path)
+  # Write to a temporary file and move it into place, so an interrupted run
+  # never leaves a truncated mask that is newer than its inputs
+  tmpPath = os.path.join(os.path.dirname(path), '.partial_' + os.path.basename(path))
+  sitk.WriteImage(img, tmpPath)
+  os.replace(tmpPath, path)
+  imageWritten(path, img)
+
+def normalizeRows(rows, csvPath, manifest, idColumn = 'BraTS18ID', landmarksFile = None,
+                  workers = 1, segmodule = False, c3d = True, atropos = False, threads = None,
+                  atroposThreads = toolThreads['Atropos'], sharded = False):
+  # Masks, Atropos and landmark normalization of rows (dicts of column ->
+  # path). threads is shared by the c3d/Atropos commands. Returns list of
+  # failed commands and subjects whose masks could not be made in process,
+  # see runTasks
+  if landmarksFile is None:
+    landmarksFile = ln.defaultLandmarksPath(csvPath)
+  # c3d/Atropos commands of all subjects, run together after the loop
+  tasks = []
+  maskFailures = []
+  for row in rows:
+  #create mask, tumor and nontumor masks if they don't exist already
     t1path = row['T1']
     maskpath = row['mask']
     segpath = row['seg']
     tumorpath = row['tumor']
-    c3dcmd = 'c3d %s -background 0 -binarize -type uchar -o %s' % (t1path, maskpath)
-    if not os.path.isfile(maskpath):
-      print(c3dcmd)
-      os.system(c3dcmd)
-
-    c3dcmd2 = 'c3d %s -background -0 -binarize -type uchar -o %s' % (segpath, tumorpath)
-    if not os.path.isfile(tumorpath):    
-      print(c3dcmd2)
-      os.system(c3dcmd2)
-
-#Apply ATROPOS to non-tumor tissues
     nontumorpath = row['nontumor']
-    atroposname = row['atropos']
-    c3dcmd3 = 'c3d %s %s -scale -1 -add -threshold 1 1 1 0 -type uchar -o %s' % (maskpath, tumorpath, nontumorpath)
-      if not os.path.isfile(nontumorpath):
-        print(c3dcmd3)
-        os.system(c3dcmd3)
+    nontumorTask = None
+    if c3d:
+      maskTask = commandTask(row[idColumn], 'mask', ['c3d', t1path] + maskParams.split() + ['-o', maskpath],
+                             maskpath, [t1path], maskParams, manifest)
+      tumorTask = commandTask(row[idColumn], 'tumor', ['c3d', segpath] + maskParams.split() + ['-o', tumorpath],
+                              tumorpath, [segpath], maskParams, manifest)
+      nontumorTask = commandTask(row[idColumn], 'nontumor', ['c3d', maskpath, tumorpath] + nontumorParams.split() + ['-o', nontumorpath],
+                                 nontumorpath, [maskpath, tumorpath], nontumorParams, manifest, [maskTask, tumorTask])
+      tasks += [task for task in [maskTask, tumorTask, nontumorTask] if task is not None]
+    else:
+      # A subject with a missing or corrupt T1/seg is reported and skipped
+      try:
+        with stage(row[idColumn], "masks"):
+          deriveMasks(t1path, segpath, maskpath, tumorpath, nontumorpath, manifest)
+      except Exception as e:
+        print('Failed %s masks: %s' % (row[idColumn], e))
+        maskFailures.append({'subject': row[idColumn], 'task': 'masks',
+                             'returncode': None, 'output': str(e)})
+        continue
 
-    if args.atropos:
+  #Apply ATROPOS to non-tumor tissues
+    if atropos:
       FLpath = row['FLAIR']
       t2path = row['T2']
       atroposname = row['atropos']
-      atroposcmd = '/opt/apps/ANTsR/dev//ANTsR_src/ANTsR/src/ANTS/ANTS-build//bin/Atropos -d 3 -c [5,0.001] -m [0.2,1x1x1] -i kmeans[3] -x %s -a %s %s %s -o %s' % (nontumorpath, t1path, t2path, FLpath, atroposname)
-      if not os.path.isfile(atroposname):
-        print(atroposcmd)
-        os.system(atroposcmd)
+      atroposInputs = [nontumorpath, t1path, t2path, FLpath]
+      atroposTask = commandTask(row[idColumn], 'atropos', [atroposBin] + atroposParams.split() + ['-x', nontumorpath, '-a', t1path, t2path, FLpath, '-o', atroposname],
+                                atroposname, atroposInputs, atroposParams, manifest, [nontumorTask])
+      if atroposTask is not None:
+        tasks.append(atroposTask)
+
+  manifest.save()
+
+  # Each subject's commands start as soon as its own inputs are ready
+  failures = maskFailures + runTasks(tasks, threads, dict(toolThreads, Atropos = atroposThreads))
+  reportFailures(failures)
+  # Subjects without masks are left out of the landmark normalization
+  failedSubjects = set(failure['subject'] for failure in failures if failure['task'] != 'atropos')
+  rows = [row for row in rows if row[idColumn] not in failedSubjects]
+
+  # Apply landmark normalization, will also check for tumor masks
+  if segmodule:
+    # Segmodule is part of the Neuroimage_Pipeline repository, which has to be
+    # on the PYTHONPATH
+    try:
+      from Segmodule import segment_and_normalize
+    except ImportError:
+      sys.exit('--segmodule needs Segmodule, add Neuroimage_Pipeline to the PYTHONPATH')
+    for row in rows:
+      outdir = '/'.join([row['type'],row[idColumn]])
+      segment_and_normalize(csv_path = csvPath, output_directory = outdir, ptMRN = row[idColumn], baseline_image= 'T1')
+
+  # Cohort landmark normalization: learn landmarks once over the cohort (or
+  # reuse them), then apply them to every subject in parallel
+  if sharded and not segmodule and not os.path.isfile(landmarksFile):
+    # Landmarks are learned over the whole cohort, not one shard
+    print('Skipping landmark normalization, %s does not exist yet' % landmarksFile)
+    print('Run landmarkNormalization.py learn once all shards are done, then run the shards again')
+  elif not segmodule:
+    maskPaths = [row[ln.landmarkMask] for row in rows]
+    if os.path.isfile(landmarksFile):
+      print('Using landmarks from %s' % landmarksFile)
+      landmarks = ln.loadLandmarks(landmarksFile)
+    else:
+      landmarks = {}
+      for col in ln.landmarkImages:
+        print('Learning %s landmarks' % col)
+        landmarks[col] = ln.learnLandmarks([row[col] for row in rows], maskPaths, workers)
+      ln.saveLandmarks(landmarksFile, landmarks)
+      print('Landmarks written to %s' % landmarksFile)
+
+    # Only normalize images whose inputs or landmarks changed
+    for col in ln.landmarkImages:
+      jobs = []
+      for row, maskpath in zip(rows, maskPaths):
+        outpath = ln.landmarkOutputPath(row[col])
+        if manifest.isStale(outpath, [row[col], maskpath, landmarksFile], landmarkParams):
+          jobs.append((row[col], maskpath, outpath))
+      print('Normalizing %d %s images' % (len(jobs), col))
+      written = []
+      if jobs:
+        imagePaths, jobMasks, outPaths = zip(*jobs)
+        written = ln.applyLandmarks(imagePaths, jobMasks, outPaths, landmarks[col], workers)
+      # Images with an empty mask were skipped and are not recorded
+      for (imagepath, maskpath, outpath), done in zip(jobs, written):
+        if done is not None:
+          manifest.record(outpath, [imagepath, maskpath, landmarksFile], landmarkParams)
+      manifest.save()
+
+  return failures
 
-# Apply landmark normalization, will also check for tumor masks
-    segment_and_normalize(csv_path = csvPath, output_directory = outdir, ptMRN = row[IDvar], baseline_image= 'T1')
+if __name__ == "__main__":
+  # Get params from cmd line
+  # Default don't include overwrite option
+  parser = argparse.ArgumentParser(description = "Normalizes images based on filepath csv")
+  parser.add_argument("--file", "-f", help = "CSV with IDs", 
+        required = True) 
+  parser.add_argument("--id", "-i", default = "BraTS18ID", 
+        help = "Name of column with IDs")
+  parser.add_argument("--manifest", "-m", default = None,
+        help = "Build manifest file (default = next to csv file)")
+  parser.add_argument("--landmarks", "-l", default = None,
+        help = "Landmark json file to reuse or learn into")
+  parser.add_argument("--workers", "-w", default = 1, type = int,
+        help = "Worker processes for landmark normalization")
+  parser.add_argument("--segmodule", action = "store_true",
+        help = "Use per-row Segmodule segment_and_normalize")
+  parser.add_argument("--in-process", action = "store_true",
+        help = "Create masks in process instead of with c3d commands")
+  #parser.add_argument("--overwrite", "-o", action = "store_true",
+  #      help = "Overwrite given csv of IDs")
+  parser.add_argument("--atropos", "-a", default = False,
+        help = "Option to run Atropos auto tissue segmentation")
+  parser.add_argument("--jobs", "-j", default = None, type = int,
+        help = "Threads shared by concurrent c3d/Atropos commands")
+  parser.add_argument("--atropos-threads", default = toolThreads['Atropos'], type = int,
+        help = "Threads per Atropos command")
+  parser.add_argument("--trace", default = None,
+        help = "JSON lines file to append stage timing records to")
+  parser.add_argument("--shard", default = None, type = parseShard,
+        help = "Only process shard i of N (i/N)")
+  args = parser.parse_args()
+  enableTrace(args.trace, "apply_normalization")
 
+  print(os.getcwd())
+  IDvar = args.id
+  csvPath = args.file
+  if args.manifest is None:
+    args.manifest = shardPath(manifestPath(csvPath), args.shard)
+  manifest = BuildManifest(args.manifest)
+  with open(csvPath,'r') as csvData:
+    csvR = csv.DictReader(csvData)
+    rows = shardRows(list(csvR), args.shard)
 
+  failures = normalizeRows(rows, csvPath, manifest, IDvar, args.landmarks, args.workers,
+                           args.segmodule, not args.in_process, args.atropos, args.jobs,
+                           args.atropos_threads, args.shard is not None)
+  if failures:
+    sys.exit('%d commands failed or were skipped, see errors above' % len(failures))
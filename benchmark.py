@@ -0,0 +1,152 @@
+#
+#  Times the pipeline scripts on synthetic cohorts
+#
+#  For each cohort size a synthetic cohort is created with syntheticCohort.py
+#  and each stage is run as its own process, in order:
+#    paths       createFilePaths.py
+#    masks       apply_normalization.py (mask/tumor/nontumor + landmarks)
+#    preprocess  deepmedicPreprocess.py
+#    partition   deepmedicPartitionData.py
+#    reshape     pyradiomics_to_short.py on a synthetic radiomics table
+#  Stages with a --workers option are run once per worker count, the others
+#  once per size. Outputs are removed between worker counts so every run
+#  does the full work. Reports wall time, subjects per second and the peak
+#  resident memory of the stage (largest of its processes).
+#
+#  Usage:
+#    $ python benchmark.py -d /scratch/bench --sizes 10 50 --workers 1 4
+#
+#    Optional command line args
+#      --directory, -d [DIR]  Directory for the cohorts (default = temporary
+#                               directory, removed afterwards)
+#      --sizes [N ..]         Cohort sizes (default = 10)
+#      --workers [N ..]       Worker counts (default = 1)
+#      --shape [X Y Z]        Image size (default = 240 240 155)
+#      --stages [STAGE ..]    Stages to run (default = all)
+#      --features [N]         Features per mask/label in the radiomics table
+#                               (default = 100)
+#      --output, -o [FILE]    Also write the results to a csv file
+
+import argparse, os, shutil, subprocess, sys, tempfile, time
+import pandas as pd
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+stages = ["paths", "masks", "preprocess", "partition", "reshape"]
+
+# Stages run once per worker count
+parallelStages = ["masks", "preprocess"]
+
+
+def stageCommand(stage, workers):
+  # Command of a stage, run inside the cohort directory
+  if stage == "paths":
+    return ["createFilePaths.py", "-f", "ids.csv", "-n", "paths.csv"]
+  if stage == "masks":
+    return ["apply_normalization.py", "-f", "paths.csv", "-w", str(workers)]
+  if stage == "preprocess":
+    return ["deepmedicPreprocess.py", "-f", "paths.csv", "-w", str(workers)]
+  if stage == "partition":
+    return ["deepmedicPartitionData.py", "-f", "paths.csv", "-t", "all",
+            "--train", "0.6", "--val", "0.2", "--test", "0.2",
+            "--folds", "5", "-d", "partition"]
+  if stage == "reshape":
+    return ["pyradiomics_to_short.py", "radiomics.csv", "short.csv",
+            ".nii.gz", "BraTS18ID", "type"]
+
+
+def stageOutputs(cohortDir):
+  # Files written by the stages, removed before each worker count
+  outputs = []
+  for root, dirs, files in os.walk(cohortDir):
+    for name in files:
+      if name.endswith(("_mask.nii.gz", "_tumor.nii.gz", "_nontumor.nii.gz",
+                        "_landmark.nii.gz", "_znorm.nii.gz",
+                        "_dm_roi_mask.nii.gz")):
+        outputs.append(os.path.join(root, name))
+  for name in ["paths_manifest.json", "paths_landmarks.json"]:
+    if os.path.isfile(os.path.join(cohortDir, name)):
+      outputs.append(os.path.join(cohortDir, name))
+  return outputs
+
+
+def runStage(command, cwd, log):
+  # Run a script, returns (wall seconds, peak rss in MB). The rusage of
+  # wait4 covers the process and its reaped children, e.g. pool workers
+  start = time.time()
+  proc = subprocess.Popen([sys.executable, os.path.join(scriptDir,
+      command[0])] + command[1:], cwd = cwd, stdout = log,
+      stderr = subprocess.STDOUT)
+  pid, status, usage = os.wait4(proc.pid, 0)
+  proc.returncode = os.waitstatus_to_exitcode(status)
+  elapsed = time.time() - start
+  if proc.returncode != 0:
+    raise RuntimeError("{0} failed with exit code {1}, see {2}".format(
+        command[0], proc.returncode, log.name))
+  return elapsed, usage.ru_maxrss / 1024.0
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Time the pipeline " +
+      "scripts on synthetic cohorts")
+  parser.add_argument("--directory", "-d", default = None,
+      help = "Directory for the cohorts")
+  parser.add_argument("--sizes", nargs = "+", default = [10], type = int,
+      help = "Cohort sizes")
+  parser.add_argument("--workers", nargs = "+", default = [1], type = int,
+      help = "Worker counts")
+  parser.add_argument("--shape", nargs = 3, default = [240, 240, 155],
+      type = int, help = "Image size x y z")
+  parser.add_argument("--stages", nargs = "+", default = stages,
+      choices = stages, help = "Stages to run")
+  parser.add_argument("--features", default = 100, type = int,
+      help = "Features per mask/label in the radiomics table")
+  parser.add_argument("--output", "-o", default = None,
+      help = "CSV file to write the results to")
+  args = parser.parse_args()
+
+  directory = args.directory
+  if directory is None:
+    directory = tempfile.mkdtemp(prefix = "benchmark_")
+
+  results = []
+  try:
+    for size in args.sizes:
+      cohortDir = os.path.join(directory, "cohort_" + str(size))
+      if not os.path.isfile(os.path.join(cohortDir, "ids.csv")):
+        print("Creating cohort of {0} subjects in {1}".format(size, cohortDir))
+        subprocess.check_call([sys.executable,
+            os.path.join(scriptDir, "syntheticCohort.py"), "-o", cohortDir,
+            "-n", str(size), "--shape"] + [str(s) for s in args.shape] +
+            ["--radiomics", str(args.features),
+             "-w", str(max(args.workers))], stdout = subprocess.DEVNULL)
+
+      logPath = os.path.join(cohortDir, "benchmark.log")
+      with open(logPath, "w") as log:
+        for n, workers in enumerate(args.workers):
+          for path in stageOutputs(cohortDir):
+            os.remove(path)
+          for stage in args.stages:
+            if n > 0 and stage not in parallelStages:
+              continue
+            command = stageCommand(stage, workers)
+            log.write("$ " + " ".join(command) + "\n")
+            log.flush()
+            elapsed, rss = runStage(command, cohortDir, log)
+            result = {"subjects": size,
+                      "workers": workers if stage in parallelStages else 1,
+                      "stage": stage, "seconds": round(elapsed, 3),
+                      "subjects_per_second": round(size / elapsed, 3),
+                      "peak_rss_mb": round(rss, 1)}
+            results.append(result)
+            print("{subjects:>6} subjects {workers:>3} workers  " \
+                  "{stage:<10} {seconds:>9.2f}s {subjects_per_second:>9.2f}" \
+                  " subjects/s {peak_rss_mb:>8.1f} MB".format(**result))
+  finally:
+    if args.directory is None:
+      shutil.rmtree(directory, ignore_errors = True)
+
+  table = pd.DataFrame(results)
+  if args.output is not None:
+    table.to_csv(args.output, index = False)
+    print("Results written to {0}".format(args.output))
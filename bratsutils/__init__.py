@@ -0,0 +1,12 @@
+#
+#  BratsUtils pipeline stages as a python package
+#
+#  Stage functions take and return DataFrames, see stages.py. Nothing heavy
+#  (pandas, SimpleITK, ...) is imported until a stage is called, so the
+#  command line (python -m bratsutils) starts quickly.
+#
+#  The scripts in the repository directory are imported by the stages, so
+#  that directory has to be the working directory or on the PYTHONPATH.
+
+from bratsutils.stages import (masks, partition, paths, pipelineStages,
+                               preprocess, reshape, runPipeline)
@@ -0,0 +1,232 @@
+#
+#  Command line of the bratsutils package, one subcommand per stage
+#
+#  Paths in the csv files are relative to the directory of the csv file.
+#  Only the modules a subcommand needs are imported.
+#
+#  Usage:
+#    $ python -m bratsutils paths -f ids.csv -o paths.csv --discover
+#    $ python -m bratsutils masks -f paths.csv -w 8
+#    $ python -m bratsutils preprocess -f paths.csv -w 8 --crop
+#    $ python -m bratsutils partition -f paths.csv -d lists -t all \
+#          --train 0.7 --val 0.1 --test 0.2
+#    $ python -m bratsutils reshape pyradiomicsout.csv short.csv .nii.gz \
+#          BraTS18ID
+#    $ python -m bratsutils pipeline -f ids.csv -o paths.csv \
+#          --stages paths masks preprocess partition -w 8
+#
+#    pipeline runs the stages one after another in this process with the
+#    filepath table in memory and writes it to --output after the paths and
+#    preprocess stages. The input csv is never changed, preprocess
+#    --compression none alone writes CSVNAME_nii.csv. Use python -m bratsutils COMMAND --help for the
+#    arguments of each command.
+
+import argparse, os, sys
+
+from bratsutils.stages import pipelineStages
+
+
+def addTableArgs(parser):
+  parser.add_argument("--file", "-f", required = True,
+      help = "CSV with filepaths (or IDs for paths/pipeline)")
+  parser.add_argument("--id", "-i", default = "BraTS18ID",
+      help = "Name of column with IDs")
+  parser.add_argument("--trace", default = None,
+      help = "JSON lines file to append stage timing records to")
+
+
+def addMaskArgs(parser):
+  parser.add_argument("--manifest", "-m", default = None,
+      help = "Build manifest file (default = CSVNAME_manifest.json)")
+  parser.add_argument("--landmarks", "-l", default = None,
+      help = "Landmark json file (default = CSVNAME_landmarks.json)")
+  parser.add_argument("--in-process", action = "store_true",
+      help = "Create masks in process instead of with c3d commands")
+  parser.add_argument("--atropos", action = "store_true",
+      help = "Run Atropos tissue segmentation")
+  parser.add_argument("--jobs", "-j", default = None, type = int,
+      help = "Threads shared by concurrent c3d/Atropos commands")
+
+
+def addPreprocessArgs(parser):
+  parser.add_argument("-n4", action = "store_true",
+      help = "Apply n4 bias correction")
+  parser.add_argument("--bias-field", "-b", action = "store_true",
+      help = "Save and reuse n4 bias fields next to the input images")
+  parser.add_argument("--threads", default = None, type = int,
+      help = "SimpleITK threads per worker (default = cpus / workers)")
+  parser.add_argument("--resume", "-r", action = "store_true",
+      help = "Skip outputs already finished in an earlier run")
+  parser.add_argument("--crop", "-c", action = "store_true",
+      help = "Crop channels of each subject to the brain bounding box")
+  parser.add_argument("--pad", default = 4, type = int,
+      help = "Padding in voxels around the crop bounding box")
+  parser.add_argument("--compression", default = "gzip",
+      choices = ["gzip", "fast", "pigz", "none"], help = "Output compression")
+
+
+def addPartitionArgs(parser):
+  parser.add_argument("--directory", "-d", default = "",
+      help = "Directory to place the lists and partition.csv in")
+  parser.add_argument("--type", "-t", default = None,
+      help = "Type [HGG, LGG, VAL, TEST, all] to partition")
+  parser.add_argument("--train", default = 0, type = float,
+      help = "Ratio [0,1] of cases to put in train set")
+  parser.add_argument("--val", default = 0, type = float,
+      help = "Ratio [0,1] of cases to put in validation set")
+  parser.add_argument("--test", default = 0, type = float,
+      help = "Ratio [0,1] of cases to put in test set")
+  parser.add_argument("--seed", default = [0], type = int, nargs = "+",
+      help = "Seeds to partition with")
+  parser.add_argument("--folds", default = None, type = int,
+      help = "Number of cross validation folds")
+  parser.add_argument("--stratify", default = ["type"], nargs = "*",
+      help = "Columns to stratify by")
+
+
+def stageOptions(args):
+  # Keyword arguments of each stage from the command line. File names that
+  # default to CSVNAME_* come from the csvPath runPipeline passes
+  options = {}
+  if "discover" in args:
+    options["paths"] = {"idColumn": args.id, "typeColumn": args.type_column,
+        "discover": args.discover, "threads": args.scan_threads}
+  if "in_process" in args:
+    options["masks"] = {"idColumn": args.id, "workers": args.workers,
+        "manifest": args.manifest, "landmarks": args.landmarks,
+        "c3d": not args.in_process, "atropos": args.atropos, "threads": args.jobs}
+  if "crop" in args:
+    options["preprocess"] = {"idColumn": args.id, "workers": args.workers,
+        "threads": args.threads, "n4": args.n4, "biasField": args.bias_field,
+        "resume": args.resume, "crop": args.crop, "pad": args.pad,
+        "compression": args.compression}
+  if "folds" in args:
+    options["partition"] = {"idColumn": args.id, "outDir": args.directory,
+        "caseType": args.type, "train": args.train, "val": args.val,
+        "test": args.test, "seeds": args.seed, "folds": args.folds,
+        "stratify": args.stratify}
+  return options
+
+
+def main(argv = None):
+  parser = argparse.ArgumentParser(prog = "python -m bratsutils",
+      description = "BraTS data pipeline stages")
+  commands = parser.add_subparsers(dest = "command", required = True)
+
+  pathsParser = commands.add_parser("paths",
+      help = "Create image filepaths from IDs")
+  addTableArgs(pathsParser)
+  pathsParser.add_argument("--output", "-o", default = None,
+      help = "Output csv (default = CSVNAME_with_paths.csv)")
+
+  masksParser = commands.add_parser("masks",
+      help = "Create masks and landmark normalize images")
+  addTableArgs(masksParser)
+  addMaskArgs(masksParser)
+
+  preprocessParser = commands.add_parser("preprocess",
+      help = "Preprocess images for DeepMedic")
+  addTableArgs(preprocessParser)
+  addPreprocessArgs(preprocessParser)
+
+  partitionParser = commands.add_parser("partition",
+      help = "Partition cases into DeepMedic train/val/test lists")
+  addTableArgs(partitionParser)
+  addPartitionArgs(partitionParser)
+
+  reshapeParser = commands.add_parser("reshape",
+      help = "Reshape pyradiomics output into a short matrix")
+  reshapeParser.add_argument("input", help = "pyradiomics output table")
+  reshapeParser.add_argument("output", help = "short matrix table to write")
+  reshapeParser.add_argument("suffix", nargs = "?", default = ".nii.gz",
+      help = "Image suffix after the image type")
+  reshapeParser.add_argument("IDs", nargs = "*", default = ["Image"],
+      help = "Columns that identify unique cases")
+  reshapeParser.add_argument("--all-shapes", action = "store_true",
+      help = "Keep shape features of every image type")
+  reshapeParser.add_argument("--chunksize", default = None, type = int,
+      help = "Read input in chunks of this many rows")
+
+  pipelineParser = commands.add_parser("pipeline",
+      help = "Run several stages in one process")
+  addTableArgs(pipelineParser)
+  pipelineParser.add_argument("--stages", nargs = "+", default = pipelineStages,
+      choices = pipelineStages, help = "Stages to run")
+  pipelineParser.add_argument("--output", "-o", default = None,
+      help = "Filepath csv to write (default = CSVNAME_with_paths.csv)")
+  addMaskArgs(pipelineParser)
+  addPreprocessArgs(pipelineParser)
+  addPartitionArgs(pipelineParser)
+
+  # Options shared by several commands
+  for sub in [pathsParser, pipelineParser]:
+    sub.add_argument("--type-column", default = "type",
+        help = "Name of column with type (i.e. HGG, LGG, VAL, TEST, etc.)")
+    sub.add_argument("--discover", "-s", action = "store_true",
+        help = "Fill paths from files found on disk")
+    sub.add_argument("--scan-threads", default = 16, type = int,
+        help = "Number of threads used to scan data directory")
+  for sub in [masksParser, preprocessParser, pipelineParser]:
+    sub.add_argument("--workers", "-w", default = 1, type = int,
+        help = "Number of worker processes")
+  args = parser.parse_args(argv)
+
+  if args.command == "reshape":
+    import pyradiomics_to_short as ps
+    from featureStore import isColumnar, writeTable
+    frames = ps.readRadiomics(args.input, args.IDs, args.chunksize)
+    shortMatrix = ps.reshapeToShort(frames, args.IDs, args.suffix,
+                                    args.all_shapes)
+    if isColumnar(args.output):
+      writeTable(shortMatrix, args.output)
+    else:
+      shortMatrix.to_csv(args.output, index = False, na_rep = "NA")
+    print("{0} cases written to {1}".format(len(shortMatrix.index),
+        args.output))
+    return 0
+
+  from featureStore import readTable, writeTable
+  from stageTrace import enableTrace
+  enableTrace(args.trace, "bratsutils")
+
+  # Paths in csv are relative to its directory
+  root = os.path.dirname(args.file)
+  table = readTable(args.file)
+  stages = args.stages if args.command == "pipeline" else [args.command]
+  # The input csv is never changed: paths writes to --output and
+  # preprocess --compression none without paths to CSVNAME_nii.csv
+  output = args.file
+  tableOutput = None
+  if "paths" in stages:
+    output = args.output
+    if output is None:
+      split = os.path.splitext(args.file)
+      output = split[0] + "_with_paths" + split[1]
+    tableOutput = output
+  elif "preprocess" in stages and args.compression == "none":
+    split = os.path.splitext(args.file)
+    tableOutput = split[0] + "_nii" + split[1]
+
+  def writeOutput(name, result):
+    # Keep the filepath csv up to date after stages that change it
+    if name == "paths" or (name == "preprocess" and
+                           args.compression == "none"):
+      writeTable(result, tableOutput)
+      print("Filepaths written to {0}".format(tableOutput))
+
+  from bratsutils.stages import runPipeline
+  try:
+    results = runPipeline(table, stages, root, stageOptions(args), output,
+                          writeOutput)
+  except (RuntimeError, ValueError) as e:
+    sys.exit("Error: {0}".format(e))
+
+  if "partition" in results:
+    partitionFile = os.path.join(args.directory, "partition.csv")
+    results["partition"].to_csv(partitionFile, index = False)
+    print("Partition written to {0}".format(partitionFile))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
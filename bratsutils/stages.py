@@ -0,0 +1,155 @@
+#
+#  Pipeline stages as functions that take and return DataFrames
+#
+#  Each stage runs the code of one of the scripts on a filepath table
+#  (DataFrame from createFilePaths.py) that is kept in memory, so stages can
+#  be chained in one process without writing and reading the csv in between.
+#  Paths in the table are relative to root, the directory of the csv file.
+#  Files the scripts name after the csv (CSVNAME_manifest.json,
+#  CSVNAME_landmarks.json, CSVNAME_crop.csv) are named after csvPath in the
+#  same way.
+#  The script modules (and pandas, SimpleITK, ...) are only imported when a
+#  stage is called.
+#
+#    paths       createFilePaths.py        fill path columns from IDs
+#    masks       apply_normalization.py    mask/tumor/nontumor, Atropos and
+#                                            landmark normalization
+#    preprocess  deepmedicPreprocess.py    dm_* z-score images and roi mask
+#    partition   deepmedicPartitionData.py train/val/test lists
+#    reshape     pyradiomics_to_short.py   pyradiomics output to short matrix
+#
+#  In python:
+#    from bratsutils import paths, preprocess, partition
+#    table = paths(pd.read_csv("data/ids.csv"), root = "data")
+#    table = preprocess(table, root = "data", workers = 8,
+#        csvPath = "data/paths.csv")
+#    assignments = partition(table, "lists", root = "data", caseType = "all",
+#        train = 0.7, val = 0.1, test = 0.2)
+
+import os
+
+# Stages runPipeline can chain, in order
+pipelineStages = ["paths", "masks", "preprocess", "partition"]
+
+
+def paths(table, root = "", idColumn = "BraTS18ID", typeColumn = "type",
+          discover = False, threads = 16):
+  # Returns table with a path column for each column in createFilePaths'
+  # columnPathPairs. With discover root is scanned and the extension of the
+  # files that exist is used
+  import createFilePaths as cf
+  existingFiles = None
+  if discover:
+    existingFiles = cf.discoverFiles(table, root or ".", idColumn, typeColumn,
+                                     threads)
+  return cf.fillPaths(table, idColumn, typeColumn, existingFiles)
+
+
+def masks(table, root = "", idColumn = "BraTS18ID", manifest = None,
+          landmarks = None, workers = 1, c3d = True, atropos = False,
+          threads = None, csvPath = None):
+  # Creates masks (and Atropos tissue labels) and landmark normalizes the
+  # images of table, see apply_normalization.py. manifest and landmarks are
+  # file names (default = CSVNAME_manifest.json and CSVNAME_landmarks.json
+  # like the script, either csvPath or both names must be given). Raises
+  # RuntimeError if c3d/Atropos commands failed. Returns table
+  import apply_normalization as an
+  import landmarkNormalization as ln
+  from buildManifest import BuildManifest, manifestPath
+  from checkCohort import pathColumns
+  if csvPath is None and (manifest is None or landmarks is None):
+    raise ValueError("masks needs csvPath or manifest and landmarks")
+  if manifest is None:
+    manifest = manifestPath(csvPath)
+  if landmarks is None:
+    landmarks = ln.defaultLandmarksPath(csvPath)
+  columns = set(pathColumns(table))
+  rows = []
+  for row in table.to_dict("records"):
+    rows.append(dict((col, os.path.join(root, value) if col in columns and
+                      isinstance(value, str) else value)
+                     for col, value in row.items()))
+  failures = an.normalizeRows(rows, None, BuildManifest(manifest), idColumn,
+                              landmarks, workers, False, c3d, atropos, threads)
+  if failures:
+    raise RuntimeError("{0} commands failed or were skipped".format(
+        len(failures)))
+  return table
+
+
+def preprocess(table, root = "", idColumn = "BraTS18ID", workers = 1,
+               threads = None, n4 = False, n4Shrink = 1, n4Levels = 4,
+               n4Iterations = 50, biasField = False, resume = False,
+               crop = False, pad = 4, compression = "gzip", cropFile = None,
+               csvPath = None):
+  # Writes the dm_* images and roi mask of every subject, see
+  # deepmedicPreprocess.py. With crop the crop offsets are written to
+  # cropFile (default = CSVNAME_crop.csv if csvPath is given, kept from
+  # earlier runs). Returns table, with .nii dm_* paths for compression
+  # "none"
+  import argparse, multiprocessing, shutil
+  import deepmedicPreprocess as dp
+  if compression == "pigz" and shutil.which("pigz") is None:
+    raise ValueError("compression pigz needs pigz on the PATH")
+  if threads is None:
+    threads = max(1, multiprocessing.cpu_count() // max(1, workers))
+  options = argparse.Namespace(id = idColumn, n4 = n4, n4_shrink = n4Shrink,
+      n4_levels = n4Levels, n4_iterations = n4Iterations,
+      bias_field = biasField, workers = workers, threads = threads,
+      resume = resume, crop = crop, pad = pad, compression = compression)
+  if compression == "none":
+    table = dp.uncompressedPaths(table)
+  if cropFile is None and csvPath is not None:
+    cropFile = os.path.splitext(csvPath)[0] + "_crop.csv"
+  crops = {}
+  if crop and cropFile is not None:
+    crops = dp.readCrops(cropFile)
+  dp.preprocessPaths(table, root, options, crops,
+                     cropFile if crop else None)
+  if crop and cropFile is not None:
+    dp.cropTable(crops, idColumn).to_csv(cropFile, index = False)
+  return table
+
+
+def partition(table, outDir = "", root = "", caseType = None, train = 0,
+              val = 0, test = 0, seeds = (0,), folds = None,
+              stratify = ("type",), idColumn = "BraTS18ID"):
+  # Writes the DeepMedic lists to outDir, see deepmedicPartitionData.py.
+  # Returns the set of every case for each seed and fold (partition.csv)
+  import deepmedicPartitionData as dpd
+  return dpd.partitionCases(table, outDir, root, caseType,
+                            (train, val, test), list(seeds), folds,
+                            list(stratify), idColumn)
+
+
+def reshape(radiomics, ids = ("Image",), suffix = ".nii.gz",
+            allShapes = False):
+  # Short matrix (one row per case) of pyradiomics output, see
+  # pyradiomics_to_short.py. radiomics is a DataFrame or iterable of chunks
+  import pyradiomics_to_short as ps
+  return ps.reshapeToShort(radiomics, list(ids), suffix, allShapes)
+
+
+def runPipeline(table, stages, root = "", options = None, csvPath = None,
+                afterStage = None):
+  # Run stages (names in pipelineStages, in that order) on table. options
+  # maps a stage name to a dict of keyword arguments of that stage and
+  # csvPath is passed to the stages that name files after it. afterStage is
+  # called with (name, result) after each stage, e.g. to write the table.
+  # Returns dict of stage name -> DataFrame the stage returned
+  options = options or {}
+  functions = {"paths": paths, "masks": masks, "preprocess": preprocess,
+               "partition": partition}
+  results = {}
+  for name in [s for s in pipelineStages if s in stages]:
+    print("Running {0}...".format(name))
+    kwargs = dict(options.get(name, {}))
+    if name in ["masks", "preprocess"]:
+      kwargs.setdefault("csvPath", csvPath)
+    result = functions[name](table, root = root, **kwargs)
+    results[name] = result
+    if name != "partition":
+      table = result
+    if afterStage is not None:
+      afterStage(name, result)
+  return results
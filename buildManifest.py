@@ -0,0 +1,104 @@
+#
+#  Incremental build manifest for pipeline outputs
+#
+#  Records, for each output file, the content hash of every input it was
+#  built from and the parameters (command) used to build it. A step only
+#  needs to run again if its output is missing, its parameters changed or
+#  one of its inputs changed. Since outputs of one step are inputs of the
+#  next, rebuilding e.g. tumor after seg is corrected also marks nontumor and
+#  atropos as stale, while a rebuild that produces identical content does not.
+#
+#  File hashes are cached by (mtime, size) so unchanged files are not read
+#  again on every run.
+#
+#  Usage:
+#    manifest = BuildManifest("BraTS18_filepaths_manifest.json")
+#    if manifest.isStale(output, [input1, input2], command):
+#      ...build output...
+#      manifest.record(output, [input1, input2], command)
+#    manifest.save()
+
+import hashlib, json, os
+
+manifestVersion = 1
+
+
+def manifestPath(csvPath):
+  # Default manifest location, next to the csv file
+  return os.path.splitext(csvPath)[0] + "_manifest.json"
+
+
+def hashFile(path, blockSize = 1 << 20):
+  # sha1 of file contents
+  h = hashlib.sha1()
+  with open(path, "rb") as f:
+    for block in iter(lambda: f.read(blockSize), b""):
+      h.update(block)
+  return h.hexdigest()
+
+
+class BuildManifest:
+
+  def __init__(self, path):
+    self.path = path
+    self.files = {}
+    self.outputs = {}
+    if os.path.isfile(path):
+      with open(path, "r") as f:
+        data = json.load(f)
+      if data.get("version") == manifestVersion:
+        self.files = data["files"]
+        self.outputs = data["outputs"]
+
+  def signature(self, path):
+    # Returns content hash of file or None if it does not exist
+    try:
+      st = os.stat(path)
+    except OSError:
+      return None
+    cached = self.files.get(path)
+    if (cached is not None and cached["mtime"] == st.st_mtime_ns and
+        cached["size"] == st.st_size):
+      return cached["sha1"]
+    digest = hashFile(path)
+    self.files[path] = {"mtime": st.st_mtime_ns, "size": st.st_size,
+                        "sha1": digest}
+    return digest
+
+  def isStale(self, output, inputs, params):
+    # True if output needs to be (re)built
+    if not os.path.isfile(output):
+      return True
+    entry = self.outputs.get(output)
+    if entry is None:
+      # Output from before the manifest existed. Trust it if it is newer
+      # than all of its inputs (like make) and start tracking it
+      outTime = os.stat(output).st_mtime_ns
+      for path in inputs:
+        if not os.path.isfile(path) or os.stat(path).st_mtime_ns > outTime:
+          return True
+      self.record(output, inputs, params)
+      return False
+    if entry["params"] != params:
+      return True
+    if sorted(entry["inputs"]) != sorted(inputs):
+      return True
+    for path in inputs:
+      if entry["inputs"][path] != self.signature(path):
+        return True
+    return False
+
+  def record(self, output, inputs, params):
+    # Record that output was built from the current inputs with params
+    self.outputs[output] = {
+        "inputs": dict((path, self.signature(path)) for path in inputs),
+        "params": params}
+
+  def save(self):
+    # Write to a temporary file and move it into place so an interrupted
+    # run never leaves a truncated manifest
+    tmpPath = self.path + ".tmp"
+    with open(tmpPath, "w") as f:
+      json.dump({"version": manifestVersion, "files": self.files,
+                 "outputs": self.outputs}, f, indent = 1, sort_keys = True)
+    os.replace(tmpPath, self.path)
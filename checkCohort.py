@@ -0,0 +1,192 @@
+#
+#  Checks a filepath csv (from createFilePaths.py) before a pipeline run
+#
+#  For every subject and path column:
+#    missing    the file does not exist
+#    unreadable the header can not be read
+#    geometry   size, spacing, origin or direction differ from the subject's
+#               first image in the same group. dm_* columns are one group
+#               (they may be cropped) and all other columns another
+#  Only the NIfTI headers are read, except for mask and label map columns:
+#    empty      a mask column (see maskColumns) has no non zero voxel
+#    labels     a label map has labels not in labelColumns (seg: 0/1/2/4)
+#  which are small and are decoded fully unless --headers-only is given.
+#  Files are checked in a thread pool. The exit code is 1 if anything was
+#  found, so it can gate a run:
+#    $ python checkCohort.py -f paths.csv && ...
+#
+#  Usage:
+#    $ python checkCohort.py -f csvwithfilepaths.csv
+#
+#    Optional command line args
+#      --columns, -c [COL ..] Path columns to check (default = the required
+#                               inputs in requiredColumns). Optional columns
+#                               like tissue, atropos or BE3_Grade are only
+#                               checked when listed here
+#      --all                  Check every column with .nii/.nii.gz paths
+#      --id, -i [ID]          Name of column with IDs (default = BraTS18ID)
+#      --headers-only         Do not decode masks and label maps
+#      --tolerance [T]        Allowed difference in spacing, origin and
+#                               direction (default = 1e-4)
+#      --threads [N]          Number of threads (default = 16)
+#      --output, -o [FILE]    Report csv (default = CSVNAME_check.csv)
+
+import argparse, os, sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+# Input columns every subject needs, checked by default
+requiredColumns = ["T1", "T2", "T1C", "FLAIR", "seg"]
+
+# Columns that should have at least one non zero voxel
+maskColumns = ["seg", "mask", "tumor", "nontumor", "dm_roi_mask", "dm_seg"]
+
+# Label map columns and the labels they may contain
+labelColumns = [["seg", [0, 1, 2, 4]], ["dm_seg", [0, 1, 2, 4]]]
+
+imageExtensions = (".nii.gz", ".nii")
+
+
+def pathColumns(paths):
+  # Columns whose values are image paths
+  columns = []
+  for col in paths.columns:
+    values = paths[col].dropna()
+    if len(values.index) and values.astype(str).str.endswith(
+        imageExtensions).all():
+      columns.append(col)
+  return columns
+
+
+def geometryGroup(column):
+  return "dm" if column.startswith("dm_") else "input"
+
+
+def checkFile(job):
+  # Header (and for masks/label maps voxel) information of one file.
+  # Returns dict with geometry and list of [issue, detail]
+  path, column, decode = job
+  result = {"geometry": None, "issues": []}
+  if not os.path.isfile(path):
+    result["issues"].append(["missing", ""])
+    return result
+  reader = sitk.ImageFileReader()
+  reader.SetFileName(path)
+  try:
+    reader.ReadImageInformation()
+  except RuntimeError as e:
+    result["issues"].append(["unreadable", str(e).strip().splitlines()[-1]])
+    return result
+  result["geometry"] = (reader.GetSize(), reader.GetSpacing(),
+                        reader.GetOrigin(), reader.GetDirection())
+  labels = dict(labelColumns)
+  if decode and (column in maskColumns or column in labels):
+    img = reader.Execute()
+    arr = sitk.GetArrayViewFromImage(img)
+    if column in maskColumns and not arr.any():
+      result["issues"].append(["empty", ""])
+    if column in labels:
+      found = np.unique(arr)
+      unexpected = [v for v in found.tolist() if v not in labels[column]]
+      if unexpected:
+        result["issues"].append(["labels", "unexpected labels {0}".format(
+            unexpected)])
+  return result
+
+
+def geometryIssues(reference, geometry, tolerance):
+  # Names of geometry fields that differ
+  names = []
+  if reference[0] != geometry[0]:
+    names.append("size {0} != {1}".format(list(geometry[0]),
+        list(reference[0])))
+  for name, i in [["spacing", 1], ["origin", 2], ["direction", 3]]:
+    if not np.allclose(reference[i], geometry[i], rtol = 0,
+                       atol = tolerance):
+      names.append("{0} {1} != {2}".format(name,
+          np.round(geometry[i], 4).tolist(), np.round(reference[i], 4).tolist()))
+  return names
+
+
+def checkCohort(paths, columns, directory = "", idColumn = "BraTS18ID",
+                decode = True, tolerance = 1e-4, threads = 16):
+  # Returns report DataFrame with one row per issue
+  jobs = []
+  keys = []
+  for col in columns:
+    for i, value in paths[col].items():
+      if isinstance(value, str) and value:
+        jobs.append((os.path.join(directory, value), col, decode))
+        keys.append((i, col))
+  with ThreadPoolExecutor(threads) as executor:
+    results = list(executor.map(checkFile, jobs))
+
+  # Compare each subject's files with its first file in the same group
+  report = []
+  references = {}
+  for (i, col), (path, _, _), result in zip(keys, jobs, results):
+    subject = paths[idColumn][i] if idColumn in paths else i
+    for issue, detail in result["issues"]:
+      report.append([subject, col, path, issue, detail])
+    if result["geometry"] is None:
+      continue
+    group = (i, geometryGroup(col))
+    if group not in references:
+      references[group] = (col, result["geometry"])
+      continue
+    refColumn, reference = references[group]
+    for detail in geometryIssues(reference, result["geometry"], tolerance):
+      report.append([subject, col, path, "geometry",
+                     "{0} (vs {1})".format(detail, refColumn)])
+  return pd.DataFrame(report, columns = [idColumn, "column", "path", "issue",
+                                         "detail"])
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Check that the files " +
+      "of a filepath csv exist and agree in geometry")
+  parser.add_argument("--file", "-f", help = "CSV with filepaths",
+      required = True)
+  parser.add_argument("--columns", "-c", nargs = "+", default = None,
+      help = "Path columns to check (default = required input columns)")
+  parser.add_argument("--all", action = "store_true",
+      help = "Check every column with .nii/.nii.gz paths")
+  parser.add_argument("--id", "-i", default = "BraTS18ID",
+      help = "Name of column with IDs")
+  parser.add_argument("--headers-only", action = "store_true",
+      help = "Do not decode masks and label maps")
+  parser.add_argument("--tolerance", default = 1e-4, type = float,
+      help = "Allowed difference in spacing, origin and direction")
+  parser.add_argument("--threads", default = 16, type = int,
+      help = "Number of threads")
+  parser.add_argument("--output", "-o", default = None,
+      help = "Report csv")
+  args = parser.parse_args()
+
+  if args.output is None:
+    args.output = os.path.splitext(args.file)[0] + "_check.csv"
+
+  # Paths in csv are relative to its directory
+  directory = os.path.dirname(args.file)
+  paths = pd.read_csv(args.file)
+  if args.columns is not None:
+    columns = args.columns
+  elif args.all:
+    columns = pathColumns(paths)
+  else:
+    columns = [col for col in requiredColumns if col in paths]
+  print("Checking {0} columns of {1} subjects...".format(len(columns),
+      len(paths.index)))
+
+  report = checkCohort(paths, columns, directory, args.id,
+      not args.headers_only, args.tolerance, args.threads)
+  report.to_csv(args.output, index = False)
+  if len(report.index) == 0:
+    print("No problems found")
+    sys.exit(0)
+  print("Problems per column:")
+  print(report.groupby(["column", "issue"], sort = False).size().to_string())
+  print("Report written to {0}".format(args.output))
+  sys.exit(1)
@@ -0,0 +1,182 @@
+#
+#  Memory-mapped cohort store for training data loading
+#
+#  Packs the channel lists written by deepmedicPartitionData.py
+#  (SPLIT_CHANNEL.txt) into one uncompressed store per split so trainers do
+#  not decode hundreds of gzipped NIfTI files every epoch. A store is two
+#  files:
+#    SPLIT.dat   raw voxels, one contiguous chunk per (subject, channel)
+#    SPLIT.json  index: channels and, per subject ID, the offset, shape and
+#                dtype of each channel plus spacing, origin and direction
+#  Volumes are opened with numpy.memmap, so reading a patch only touches the
+#  pages it needs, with no decompression or copy.
+#
+#  Usage:
+#    $ python cohortStore.py pack -d partitiondir -o storedir
+#    $ python cohortStore.py export -s storedir/train.json -o niftidir
+#
+#    Optional command line args
+#      --splits [SPLIT ..]    Splits to pack (default = train val test)
+#      --channels [CH ..]     Channels to pack (default = channels from
+#                               deepmedicPartitionData.py)
+#
+#  In python:
+#    store = CohortStore("storedir/train.json")
+#    patch = store.volume(store.ids[0], "dm_T1_znorm")[10:35, 40:65, 40:65]
+
+import argparse, json, os
+from collections import Counter
+import numpy as np
+
+channels = ["dm_T1_znorm", "dm_T2_znorm", "dm_T1C_znorm", "dm_FLAIR_znorm",
+            "seg", "dm_roi_mask"]
+splits = ["train", "val", "test"]
+
+# Chunks start at multiples of this many bytes
+alignment = 64
+
+
+def subjectID(path):
+  # Subject ID from a TYPE/ID/ID_suffix.nii.gz path
+  return os.path.basename(os.path.dirname(path))
+
+
+def readList(path):
+  with open(path, "r") as f:
+    return [line.strip() for line in f if line.strip()]
+
+
+def packSplit(listFiles, storePath):
+  # Pack images listed in listFiles (dict of channel -> list file) into
+  # storePath.dat/.json. Returns number of subjects
+  import SimpleITK as sitk
+  lists = dict((ch, readList(path)) for ch, path in listFiles.items())
+  names = list(lists)
+  count = len(lists[names[0]])
+  if any(len(lists[ch]) != count for ch in names):
+    raise ValueError("Channel lists of {0} differ in length".format(storePath))
+  # Volumes are indexed by subject ID, so an ID listed twice would overwrite
+  # the first entry and orphan its voxels
+  ids = [subjectID(path) for path in lists[names[0]]]
+  duplicates = sorted(sid for sid, n in Counter(ids).items() if n > 1)
+  if duplicates:
+    raise ValueError("Subjects listed more than once for {0}: {1}".format(
+        storePath, ", ".join(duplicates)))
+
+  index = {"channels": names, "subjects": {}, "order": []}
+  offset = 0
+  tmpData = storePath + ".dat.tmp"
+  with open(tmpData, "wb") as f:
+    for i in range(count):
+      sid = ids[i]
+      subject = {"channels": {}}
+      for ch in names:
+        img = sitk.ReadImage(lists[ch][i])
+        arr = sitk.GetArrayViewFromImage(img)
+        if "spacing" not in subject:
+          subject["spacing"] = list(img.GetSpacing())
+          subject["origin"] = list(img.GetOrigin())
+          subject["direction"] = list(img.GetDirection())
+        padding = (-offset) % alignment
+        f.write(b"\0" * padding)
+        offset += padding
+        f.write(np.ascontiguousarray(arr).tobytes())
+        subject["channels"][ch] = {"offset": offset, "shape": list(arr.shape),
+                                   "dtype": arr.dtype.str}
+        offset += arr.nbytes
+      index["subjects"][sid] = subject
+      index["order"].append(sid)
+      print("  [{0}/{1}] {2}".format(i + 1, count, sid))
+  os.replace(tmpData, storePath + ".dat")
+  with open(storePath + ".json", "w") as f:
+    json.dump(index, f, indent = 1)
+  return count
+
+
+class CohortStore:
+
+  def __init__(self, path):
+    # path is SPLIT.json or SPLIT (without extension)
+    base = path[:-len(".json")] if path.endswith(".json") else path
+    with open(base + ".json", "r") as f:
+      self.index = json.load(f)
+    self.dataPath = base + ".dat"
+    self.channels = self.index["channels"]
+    self.ids = self.index["order"]
+
+  def volume(self, sid, channel):
+    # Read-only memmap (z, y, x) of one channel of one subject
+    entry = self.index["subjects"][sid]["channels"][channel]
+    return np.memmap(self.dataPath, dtype = np.dtype(entry["dtype"]),
+                     mode = "r", offset = entry["offset"],
+                     shape = tuple(entry["shape"]))
+
+  def geometry(self, sid):
+    # (spacing, origin, direction) of a subject
+    subject = self.index["subjects"][sid]
+    return subject["spacing"], subject["origin"], subject["direction"]
+
+  def image(self, sid, channel):
+    # SimpleITK image of one channel with the subject's geometry
+    import SimpleITK as sitk
+    img = sitk.GetImageFromArray(np.asarray(self.volume(sid, channel)))
+    spacing, origin, direction = self.geometry(sid)
+    img.SetSpacing(spacing)
+    img.SetOrigin(origin)
+    img.SetDirection(direction)
+    return img
+
+
+def exportStore(store, outDir):
+  # Write every subject/channel back to outDir/ID/ID_CHANNEL.nii.gz for tools
+  # that need NIfTI files
+  import SimpleITK as sitk
+  written = []
+  for sid in store.ids:
+    subjectDir = os.path.join(outDir, sid)
+    if not os.path.isdir(subjectDir):
+      os.makedirs(subjectDir)
+    for ch in store.channels:
+      path = os.path.join(subjectDir, sid + "_" + ch + ".nii.gz")
+      sitk.WriteImage(store.image(sid, ch), path)
+      written.append(path)
+  return written
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Pack partitioned " +
+      "channel lists into memory-mapped stores, or export them to NIfTI")
+  parser.add_argument("command", choices = ["pack", "export"])
+  parser.add_argument("--directory", "-d", default = ".",
+      help = "Directory with SPLIT_CHANNEL.txt lists (pack)")
+  parser.add_argument("--store", "-s", default = None,
+      help = "Store json to export (export)")
+  parser.add_argument("--output", "-o", required = True,
+      help = "Directory to write stores (pack) or NIfTI files (export) to")
+  parser.add_argument("--splits", nargs = "+", default = splits,
+      help = "Splits to pack")
+  parser.add_argument("--channels", nargs = "+", default = channels,
+      help = "Channels to pack")
+  args = parser.parse_args()
+
+  if not os.path.isdir(args.output):
+    os.makedirs(args.output)
+
+  if args.command == "pack":
+    for split in args.splits:
+      listFiles = dict((ch, os.path.join(args.directory,
+          split + "_" + ch + ".txt")) for ch in args.channels)
+      listFiles = dict((ch, path) for ch, path in listFiles.items()
+                       if os.path.isfile(path))
+      if not listFiles:
+        print("No channel lists for {0}, skipping".format(split))
+        continue
+      print("Packing {0} channels of {1}...".format(len(listFiles), split))
+      count = packSplit(listFiles, os.path.join(args.output, split))
+      print("{0} subjects written to {1}".format(count,
+          os.path.join(args.output, split + ".dat")))
+  else:
+    if args.store is None:
+      parser.error("export needs --store")
+    written = exportStore(CohortStore(args.store), args.output)
+    print("{0} files written to {1}".format(len(written), args.output))
@@ -0,0 +1,178 @@
+#
+#  Runs external commands (c3d, Atropos, ...) of many subjects concurrently
+#
+#  Each command is a Task with the tasks it depends on, e.g. per subject
+#    mask, tumor -> nontumor -> atropos
+#  A task starts as soon as the tasks it depends on have finished, so each
+#  subject advances on its own instead of waiting for the whole cohort.
+#  Running commands share a thread budget (default = cpu count): a task
+#  takes toolThreads[tool] threads of it while running and the tool gets
+#  that many threads through the ITK/OpenMP thread environment variables.
+#  Commands are run without a shell and their exit codes are checked. A
+#  failed task's dependents are skipped and all failures are returned.
+#  Commands run in threads and are waited for with os.wait4, so their stage
+#  trace records have the cpu time and peak memory of the command itself
+#  rather than of this process.
+#
+#  In python:
+#    mask = Task("ID", "mask", ["c3d", "T1.nii.gz", ..., "-o", "mask.nii.gz"])
+#    tumor = Task("ID", "tumor", ["c3d", ...])
+#    nontumor = Task("ID", "nontumor", ["c3d", ...], after = [mask, tumor])
+#    failures = runTasks([mask, tumor, nontumor], threads = 8)
+
+import asyncio, os, subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from stageTrace import stage
+
+# Threads given to each tool (by executable name), tools not listed get 1
+toolThreads = {"c3d": 1, "Atropos": 4}
+
+# Environment variables that set the number of threads of a tool
+threadVariables = ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", "OMP_NUM_THREADS"]
+
+# Lines of output kept for the failure report
+outputLines = 20
+
+
+class Task:
+
+  def __init__(self, subject, name, command, after = (), onSuccess = None):
+    # command is a list of arguments. onSuccess is called with the task
+    # after the command exits with 0, e.g. to record outputs in a manifest
+    self.subject = subject
+    self.name = name
+    self.command = [str(arg) for arg in command]
+    self.after = list(after)
+    self.onSuccess = onSuccess
+    self.tool = os.path.basename(self.command[0])
+
+  def __repr__(self):
+    return "{0} {1}".format(self.subject, self.name)
+
+
+class ThreadBudget:
+
+  def __init__(self, threads):
+    self.capacity = max(1, threads)
+    self.free = self.capacity
+    self.condition = asyncio.Condition()
+
+  async def acquire(self, threads):
+    # Wait until threads are free, returns the number taken
+    threads = min(max(1, threads), self.capacity)
+    async with self.condition:
+      await self.condition.wait_for(lambda: self.free >= threads)
+      self.free -= threads
+    return threads
+
+  async def release(self, threads):
+    async with self.condition:
+      self.free += threads
+      self.condition.notify_all()
+
+
+def runCommand(command, env):
+  # Run command and wait for it with os.wait4. Returns (exit code, output,
+  # resource usage of the command)
+  proc = subprocess.Popen(command, env = env, stdout = subprocess.PIPE,
+                          stderr = subprocess.STDOUT)
+  output = proc.stdout.read()
+  proc.stdout.close()
+  _, status, usage = os.wait4(proc.pid, 0)
+  proc.returncode = os.waitstatus_to_exitcode(status)
+  return proc.returncode, output, usage
+
+
+async def runTask(task, running, budget, threadsPerTool, failures, executor):
+  # Returns True if the task succeeded
+  for dependency in task.after:
+    if not await running[dependency]:
+      failures.append({"subject": task.subject, "task": task.name,
+                       "returncode": None, "output": "skipped, {0} failed"
+                       .format(dependency.name)})
+      return False
+
+  threads = await budget.acquire(threadsPerTool.get(task.tool, 1))
+  env = dict(os.environ)
+  for variable in threadVariables:
+    env[variable] = str(threads)
+  try:
+    print("Running {0}: {1}".format(task, " ".join(task.command)))
+    with stage(task.subject, task.name, external = True,
+               tool = task.tool) as timer:
+      try:
+        returncode, output, usage = await asyncio.get_running_loop() \
+            .run_in_executor(executor, runCommand, task.command, env)
+        output = output.decode(errors = "replace")
+        timer.childUsage(usage)
+      except OSError as e:
+        returncode = None
+        output = str(e)
+  finally:
+    await budget.release(threads)
+
+  if returncode != 0:
+    failures.append({"subject": task.subject, "task": task.name,
+                     "returncode": returncode, "output":
+                     "\n".join(output.splitlines()[-outputLines:])})
+    print("Failed {0} ({1})".format(task, returncode))
+    return False
+  if task.onSuccess is not None:
+    task.onSuccess(task)
+  print("Finished {0}".format(task))
+  return True
+
+
+async def runAll(tasks, threads, threadsPerTool):
+  budget = ThreadBudget(threads)
+  failures = []
+  running = {}
+  # One thread per command that can run at once under the budget
+  with ThreadPoolExecutor(budget.capacity) as executor:
+    # Tasks are started in dependency order so running has every dependency
+    for task in orderTasks(tasks):
+      running[task] = asyncio.ensure_future(runTask(task, running, budget,
+          threadsPerTool, failures, executor))
+    await asyncio.gather(*running.values())
+  return failures
+
+
+def orderTasks(tasks):
+  # Tasks with every dependency before its dependents. Dependencies that
+  # are not in tasks are added
+  ordered = []
+  seen = set()
+
+  def visit(task):
+    if task in seen:
+      return
+    seen.add(task)
+    for dependency in task.after:
+      visit(dependency)
+    ordered.append(task)
+
+  for task in tasks:
+    visit(task)
+  return ordered
+
+
+def runTasks(tasks, threads = None, threadsPerTool = None):
+  # Run tasks, returns list of failures (dicts with subject, task,
+  # returncode and the end of the command output). Dependents of failed
+  # tasks are reported with returncode None
+  if threads is None:
+    threads = os.cpu_count() or 1
+  if threadsPerTool is None:
+    threadsPerTool = toolThreads
+  if not tasks:
+    return []
+  return asyncio.run(runAll(tasks, threads, threadsPerTool))
+
+
+def reportFailures(failures):
+  for failure in failures:
+    print("Error: {0} {1} exited with {2}".format(failure["subject"],
+        failure["task"], failure["returncode"]))
+    for line in failure["output"].splitlines():
+      print("    " + line)
@@ -33,27 +33,31 @@
 #                               are not specified
 #      --excel, -e            Flag to also make an excel file with viewer column
 #      --name, -n [NAME]      Name of new csv file (default = name of input csv)
+#
+#      --discover, -s         Flag to scan the data directory for existing
+#                               files. Paths are filled from the files found
+#                               (.nii.gz or .nii) and a report of missing
+#                               files is written to NAME_missing.csv
+#      --threads [N]          Number of threads used to scan (default = 16)
+#      --append, -a           Flag to only add rows for IDs that are not yet in
+#                               the output file. Rows already in it (and any
+#                               hand edits) are left as they are, new rows are
+#                               appended to the end of the file
+#
+#  The input and output can also be .parquet or .feather files, see
+#  featureStore.py.
+#
+#  Path columns that already exist in the csv file are kept, only blank cells
+#  are filled in.
+#
+#  The excel file is written row by row from the output file with
+#  xlsxwriter in constant memory mode, so its size does not depend on the
+#  number of rows.
 
 import argparse, os
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-
-# Get params from cmd line
-parser = argparse.ArgumentParser(description = "Creates filepaths for image files from IDs")
-parser.add_argument("--file", "-f", help = "CSV with IDs", 
-      required = True) 
-parser.add_argument("--id", "-i", default = "BraTS18ID", 
-      help = "Name of column with IDs")
-parser.add_argument("--type", "-t", default = "type", 
-      help = "Name of column with type (i.e. HGG, LGG, VAL, TEST, etc.)")
-parser.add_argument("--directory", "-d", default = None,
-      help = "Directory to write new CSV to")
-parser.add_argument("--overwrite", "-o", action = "store_true",
-      help = "Overwrite given csv of IDs")
-parser.add_argument("--excel", "-e", action = "store_true",
-      help = "Create excel file with filepaths plus viewer column")
-parser.add_argument("--name", "-n", default = None,
-      help = "Name of output CSV file")
-args = parser.parse_args()
+from featureStore import isColumnar, readTable, tableColumns, writeTable
 
 # List of list of length 2 where the first index is the column title and
 # the second index is string to append to the filepath + id
@@ -70,103 +74,279 @@ columnPathPairs = [
     ["ERGarea", "ERGarea_RF_POS"], ["Ki67", "Ki67_RF_POS"],
     ["dm_T1_znorm", "dm_t1_znorm"], ["dm_T2_znorm", "dm_t2_znorm"], 
     ["dm_T1C_znorm", "dm_t1ce_znorm"], ["dm_FLAIR_znorm", "dm_flair_znorm"], 
-    ["dm_roi_mask", "dm_roi_mask"]
-  ] 
+    ["dm_roi_mask", "dm_roi_mask"], ["dm_seg", "dm_seg"]
+  ]
+
+# File extensions tried in order when discovering files
+discoverExtensions = [".nii.gz", ".nii"]
+
+
+def scanDirectory(path):
+  # Returns (path, list of file names, list of sub directories)
+  files = []
+  dirs = []
+  try:
+    with os.scandir(path) as entries:
+      for entry in entries:
+        if entry.is_dir():
+          dirs.append(entry.name)
+        else:
+          files.append(entry.name)
+  except OSError:
+    pass
+  return path, files, dirs
+
 
-print("Reading file {0}".format(args.file))
-csvFile = pd.read_csv(args.file)
+def scanDataTree(root, typeDirs, threads, ids = None):
+  # Scan root/TYPE/ID/ once and return set of existing "TYPE/ID/file" paths
+  # relative to root. Type directories and then ID directories are listed in
+  # parallel so large (network) trees need one listing per directory instead
+  # of one stat per file. If ids is given only those ID directories are listed
+  existing = set()
+  with ThreadPoolExecutor(threads) as pool:
+    idDirs = []
+    for path, files, dirs in pool.map(scanDirectory,
+        [os.path.join(root, t) for t in typeDirs]):
+      idDirs.extend(os.path.join(path, d) for d in dirs
+                    if ids is None or d in ids)
+    for path, files, dirs in pool.map(scanDirectory, idDirs):
+      rel = os.path.relpath(path, root).replace(os.sep, "/")
+      existing.update(rel + "/" + name for name in files)
+  return existing
 
-print("Creating columns: {0}".format([pair[0] for pair in columnPathPairs]))
 
-# Create empty column for each COLNAME in columnPathPairs if the column does
-# not already exist
-for pair in columnPathPairs:
-  if pair[0] not in csvFile:
-    csvFile[pair[0]] = ""
+def rowDirectories(table, idColumn = "BraTS18ID", typeColumn = "type"):
+  # Directory of each row relative to the data directory, TYPE/ID or ID
+  rowIDs = table[idColumn].astype(str)
+  if typeColumn in table:
+    return table[typeColumn].astype(str) + "/" + rowIDs
+  return rowIDs
 
-print("Writing filepaths...")
 
-# For each ID in csvFile
-for i in range(len(csvFile.index)):
-  # Get row ID
-  rowID = csvFile[args.id].iloc[i]
+def discoverFiles(table, root, idColumn = "BraTS18ID", typeColumn = "type",
+                  threads = 16, onlyRows = False):
+  # Set of existing "TYPE/ID/file" paths under root. With onlyRows only the
+  # ID directories of the rows of table are listed
+  if typeColumn in table:
+    typeDirs = table[typeColumn].dropna().astype(str).unique()
+  else:
+    typeDirs = [""]
+  ids = set(table[idColumn].astype(str)) if onlyRows else None
+  return scanDataTree(root, typeDirs, threads, ids)
 
-  # get row type if exists
-  if args.type in csvFile:  
-    rowType = csvFile[args.type].iloc[i] + "/"
-  else: 
-    rowType = ""
 
-  # For each column write path for current ID
+def fillPaths(table, idColumn = "BraTS18ID", typeColumn = "type",
+              existingFiles = None):
+  # Returns copy of table with a path column for each COLNAME in
+  # columnPathPairs. Cells that already have a path are kept, only blank
+  # cells (or new columns) are filled. With existingFiles (see
+  # discoverFiles) the first extension that exists on disk is used
+  table = table.copy()
+  # Path prefix for each row
   # Filepath format:
   #   TYPE/ID/ID_FILEAPPEND.nii.gz
   #   e.g. HGG/Brats_CBICA_ABC_1/Brats_CBICA_ABC_1_t2.nii.gz
-  # TODO Check if is blank else skip
+  rowPrefixes = (rowDirectories(table, idColumn, typeColumn) + "/" +
+                 table[idColumn].astype(str) + "_")
+  for pair in columnPathPairs:
+    filepaths = rowPrefixes + pair[1] + ".nii.gz"
+    # Keep the default path where no file is found
+    if existingFiles is not None:
+      for ext in reversed(discoverExtensions):
+        found = rowPrefixes + pair[1] + ext
+        filepaths = filepaths.where(~found.isin(existingFiles), found)
+    if pair[0] in table:
+      existing = table[pair[0]].astype(object)
+      blank = existing.isna() | (existing.astype(str) == "")
+      table[pair[0]] = existing.where(~blank, filepaths)
+    else:
+      table[pair[0]] = filepaths
+  return table
+
+
+def missingPaths(table, idColumn, root, existingFiles):
+  # DataFrame (ID, column, path) of paths that do not exist. Only paths not
+  # in existingFiles are checked with a stat
+  missing = []
   for pair in columnPathPairs:
-    filepath = rowType + rowID + "/" + rowID + "_" + pair[1] + ".nii.gz"
-    csvFile.at[i, pair[0]] = filepath
-
-print("All filepaths created")
-
-# Create new filename/path to write csv file to
-newCSVFile = None
-# If directory specified make new csv file in that directory
-if args.directory is not None:
-  # check if dir exists, if not make it
-  if not os.path.isdir(args.directory):
-    os.makedirs(args.directory)
-  newCSVFile = args.directory
-  # Use specified name or use existing name of file
-  if args.name is not None:
-    newCSVFile = newCSVFile + "/" + args.name
+    values = table[pair[0]]
+    notFound = values.notna() & ~values.isin(existingFiles)
+    for i in notFound[notFound].index:
+      if not os.path.exists(os.path.join(root, values[i])):
+        missing.append([table[idColumn][i], pair[0], values[i]])
+  return pd.DataFrame(missing, columns = [idColumn, "column", "path"])
+
+
+def excelCell(value):
+  # Table value as a cell value for xlsxwriter, None for a blank cell
+  if pd.isna(value):
+    return None
+  if hasattr(value, "item"):
+    return value.item()
+  return value
+
+
+def writeExcel(tableFile, xlsxFileName, idColumn, typeColumn, viewerBefore,
+               viewerDirectory, chunksize = 10000):
+  # Stream the rows of tableFile into xlsxFileName with a "viewer" formula
+  # column inserted before column viewerBefore. Only one chunk of the table
+  # and one row of the sheet are in memory at a time. Returns number of rows
+  import xlsxwriter
+  columns = tableColumns(tableFile)
+  position = columns.index(viewerBefore) if viewerBefore in columns else 0
+  workbook = xlsxwriter.Workbook(xlsxFileName, {"constant_memory": True})
+  sheet = workbook.add_worksheet()
+  sheet.write_row(0, 0, columns[:position] + ["viewer"] + columns[position:])
+  row = 0
+  for chunk in readTable(tableFile, chunksize = chunksize):
+    ids = chunk[idColumn].astype(str)
+    rowDirs = chunk[typeColumn].astype(str) + "/" + ids \
+        if typeColumn in chunk else ids
+    viewers = ("=REVIEWTRUTH(1,\"-C " + viewerDirectory +
+               " -f prediction.makefile " + rowDirs + "/reviewtruth\")")
+    for values, viewer in zip(chunk[columns].itertuples(index = False,
+                                                        name = None), viewers):
+      row += 1
+      cells = [excelCell(value) for value in values]
+      sheet.write_row(row, 0, cells[:position] + [viewer] + cells[position:])
+  workbook.close()
+  return row
+
+if __name__ == "__main__":
+  # Get params from cmd line
+  parser = argparse.ArgumentParser(description = "Creates filepaths for image files from IDs")
+  parser.add_argument("--file", "-f", help = "CSV with IDs", 
+        required = True) 
+  parser.add_argument("--id", "-i", default = "BraTS18ID", 
+        help = "Name of column with IDs")
+  parser.add_argument("--type", "-t", default = "type", 
+        help = "Name of column with type (i.e. HGG, LGG, VAL, TEST, etc.)")
+  parser.add_argument("--directory", "-d", default = None,
+        help = "Directory to write new CSV to")
+  parser.add_argument("--overwrite", "-o", action = "store_true",
+        help = "Overwrite given csv of IDs")
+  parser.add_argument("--excel", "-e", action = "store_true",
+        help = "Create excel file with filepaths plus viewer column")
+  parser.add_argument("--name", "-n", default = None,
+        help = "Name of output CSV file")
+  parser.add_argument("--discover", "-s", action = "store_true",
+        help = "Fill paths from files found on disk and report missing files")
+  parser.add_argument("--threads", default = 16, type = int,
+        help = "Number of threads used to scan data directory")
+  parser.add_argument("--append", "-a", action = "store_true",
+        help = "Only add rows for IDs not yet in the output file")
+  args = parser.parse_args()
+
+  # Create new filename/path to write csv file to
+  newCSVFile = None
+  # If directory specified make new csv file in that directory
+  if args.directory is not None:
+    # check if dir exists, if not make it
+    if not os.path.isdir(args.directory):
+      os.makedirs(args.directory)
+    newCSVFile = args.directory
+    # Use specified name or use existing name of file
+    if args.name is not None:
+      newCSVFile = newCSVFile + "/" + args.name
+    else:
+      newCSVFile = newCSVFile + "/" + os.path.basename(args.file)
+  # If no directoy, use current directory with given name
+  elif args.name is not None:
+    newCSVFile = os.path.join(os.path.dirname(args.file), args.name)
+  # If no directory or name specified but overwrite flag is true
+  # overwrite the input csv file
+  elif args.overwrite:
+    newCSVFile = args.file
+  # If overwrite flag == false, append input filename to write csv file to
   else:
-    newCSVFile = newCSVFile + "/" + os.path.basename(args.file)
-# If no directoy, use current directory with given name
-elif args.name is not None:
-  newCSVFile = os.path.dirname(args.file) + args.name
-# If no directory or name specified but overwrite flag is true
-# overwrite the input csv file
-elif args.overwrite:
-  newCSVFile = args.file
-# If overwrite flag == false, append input filename to write csv file to
-else:
-  split = os.path.splitext(args.file)
-  newCSVFile = split[0] + "_with_paths" + split[1]
-
-# Write csv file
-csvFile.to_csv(newCSVFile, index=False)
-print("CSV file written to {0}".format(newCSVFile))
-
-if args.excel:
-  print("Creating \"viewer\" column...")
-
-  # Create excel file
-  xlsxFileName = os.path.splitext(newCSVFile)[0] + ".xlsx"
-  xlsxFile = pd.ExcelWriter(xlsxFileName)
-
-  viewerList = []
-  for i in range(len(csvFile.index)):
-    # Get row ID
-    rowID = csvFile[args.id].iloc[i]
-
-    # get row type if exists
-    if args.type in csvFile:
-      rowType = csvFile[args.type].iloc[i] + "/"
+    split = os.path.splitext(args.file)
+    newCSVFile = split[0] + "_with_paths" + split[1]
+
+  if args.append and os.path.abspath(newCSVFile) == os.path.abspath(args.file):
+    parser.error("--append needs an output file other than the input, " +
+                 "use --directory or --name")
+
+  print("Reading file {0}".format(args.file))
+  csvFile = readTable(args.file)
+
+  # Only keep IDs that are not in the output file yet. Only its ID column is
+  # read
+  appending = args.append and os.path.isfile(newCSVFile)
+  if appending:
+    knownIDs = set(readTable(newCSVFile, columns = [args.id])[args.id].astype(
+        str))
+    csvFile = csvFile[~csvFile[args.id].astype(str).isin(knownIDs)]
+    csvFile = csvFile.reset_index(drop = True)
+    print("{0} IDs already in {1}, {2} new IDs".format(len(knownIDs),
+        newCSVFile, len(csvFile.index)))
+
+
+  print("Creating columns: {0}".format([pair[0] for pair in columnPathPairs]))
+
+  print("Writing filepaths...")
+
+  # Index existing files in the data directory
+  existingFiles = None
+  if args.discover:
+    dataRoot = os.path.dirname(args.file) or "."
+    print("Scanning {0} for files...".format(dataRoot))
+    existingFiles = discoverFiles(csvFile, dataRoot, args.id, args.type,
+        args.threads, appending)
+    print("Found {0} files".format(len(existingFiles)))
+
+  csvFile = fillPaths(csvFile, args.id, args.type, existingFiles)
+
+  print("All filepaths created")
+
+  # Report paths that do not exist
+  if args.discover:
+    missing = missingPaths(csvFile, args.id, dataRoot, existingFiles)
+    print("Missing files per column:")
+    print(missing.groupby("column", sort = False).size().to_string())
+
+  # Write csv file (or .parquet/.feather if that is the file extension)
+  if appending:
+    # New rows get the columns of the output file, columns it does not have
+    # are dropped
+    outputColumns = tableColumns(newCSVFile)
+    dropped = [col for col in csvFile.columns if col not in outputColumns]
+    if dropped:
+      print("Columns not in {0} are not appended: {1}".format(newCSVFile,
+          dropped))
+    csvFile = csvFile.reindex(columns = outputColumns)
+    if isColumnar(newCSVFile):
+      # Columnar files can not be appended to, old rows are copied unchanged
+      writeTable(pd.concat([readTable(newCSVFile), csvFile],
+          ignore_index = True), newCSVFile)
+    elif len(csvFile.index):
+      with open(newCSVFile, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        newline = f.read(1) not in b"\r\n"
+      with open(newCSVFile, "a") as f:
+        if newline:
+          f.write("\n")
+        csvFile.to_csv(f, header = False, index = False)
+    print("{0} rows appended to {1}".format(len(csvFile.index), newCSVFile))
+  elif isColumnar(newCSVFile):
+    writeTable(csvFile, newCSVFile)
+    print("CSV file written to {0}".format(newCSVFile))
+  else:
+    csvFile.to_csv(newCSVFile, index=False)
+    print("CSV file written to {0}".format(newCSVFile))
+
+  if args.discover:
+    missingFile = os.path.splitext(newCSVFile)[0] + "_missing.csv"
+    if appending and os.path.isfile(missingFile):
+      missing.to_csv(missingFile, mode = "a", header = False, index = False)
     else:
-      rowType = ""
-
-    viewer = ("=REVIEWTRUTH(1,\"-C " + os.path.dirname(args.file) + 
-              " -f prediction.makefile " + rowType + rowID + 
-              "/reviewtruth\")")
-    viewerList.append(viewer)
-   
-  # Create viewer column with vector
-  csvFile.insert(csvFile.columns.get_loc(
-      columnPathPairs[0][0]), "viewer", viewerList)
-
-  print("Viewer column created")
-
-  # Write excel file
-  csvFile.to_excel(xlsxFile, index=False)
-  xlsxFile.save()
-  print("Excel file written to {0}".format(xlsxFileName))
+      missing.to_csv(missingFile, index=False)
+    print("{0} missing files written to {1}".format(len(missing), missingFile))
+
+  if args.excel:
+    # The whole output file is streamed into the excel file, including rows
+    # from earlier runs when appending
+    xlsxFileName = os.path.splitext(newCSVFile)[0] + ".xlsx"
+    print("Writing excel file with \"viewer\" column...")
+    rows = writeExcel(newCSVFile, xlsxFileName, args.id, args.type,
+        columnPathPairs[0][0], os.path.dirname(args.file))
+    print("{0} rows written to excel file {1}".format(rows, xlsxFileName))
@@ -1,9 +1,11 @@
 # Partitions BraTS data into training, validation, and testing sets
 #
 # Notes:
-#   Partitioning is done by generating a random number [0,1] for each
-#     patient and checking which sets' proportional range it falls in.
-#     As a result, set proportions may not be exact.
+#   Partitioning is seeded and exact: exactly round(n * train) cases go to
+#     train, round(n * val) to val and round(n * test) to test. Cases are
+#     stratified (by default by type, e.g. HGG and LGG) so each set holds
+#     every stratum in proportion. Several seeds and k folds are produced
+#     in one run.
 #
 # Input/Args:
 #   Usage:
@@ -28,124 +30,199 @@
 #     --train [0,1]      Args to specify ratio of data in each set
 #     --val [0,1]          Sum of train, val, test args cannot be greater than
 #     --test [0,1]         1.
+#     --seed [N ..]      Seeds to partition with (default: 0). With more
+#                          than one seed each goes to DIRECTORY/seedN/
+#     --folds [K]        Stratified k-fold cross validation. Test cases are
+#                          held out with --test, the rest is split into K
+#                          folds and fold k is the val set of
+#                          DIRECTORY/[seedN/]foldk/. --train/--val ignored
+#     --stratify [COL ..]
+#                        Columns to stratify by (default: type)
+#     --id, -i [ID]      Name of column with IDs (default: BraTS18ID)
 #
 # Output:
 #   For each set in [train, val, test] creates a text file corresponding to
 #     each channel containing paths to the relevant files.
 #   For val and test, a _pred.txt file is created with a list of prediction
-#     filenames corresponding to each patient in the val and test sets 
+#     filenames corresponding to each patient in the val and test sets
+#   partition.csv in DIRECTORY lists the set of every case for each seed and
+#     fold
 
+import argparse, os, sys
+import numpy as np
 import pandas as pd
-import random, argparse, os
-
-# Get params from cmd line
-parser = argparse.ArgumentParser(description = "Partition filepaths into " + 
-    "text files for deepmedic")
-parser.add_argument("--file", "-f", help = "CSV with filepaths",
-      required = True)
-parser.add_argument("--type", "-t", default = None,
-      help = "Type [HGG, LGG, VAL, TEST, all] in csv file to use\n" +
-             "Note: 'all' just includes HGG/LGGi." +
-             "If --type not specified, HGG/LGG used in train and " +
-             "VAL and TEST are used for val and test respectively")
-parser.add_argument("--directory", "-d", default = "",
-      help = "Directory to place output files in")
-parser.add_argument("--train", default = 0, type = float,
-      help = "Ratio [0,1] of cases to put in train set")
-parser.add_argument("--val", default = 0, type = float,
-      help = "Ratio [0,1] of cases to put in validation set")
-parser.add_argument("--test", default = 0, type = float,
-      help = "Ratio [0,1] of cases to put in test set")
-args = parser.parse_args()
-
-# Check if sum of ratios is greater than 1
-if args.train + args.test + args.val > 1.0:
-  sys.exit("Error: Sum of ratios train, val, and test cannot be greater that 1")
-
-# Directory of image files, not to be confused with directory to place output
-# files in
-directory = os.path.dirname(args.file)
 
 # Channels of files to make
-channels = ["dm_T1_znorm", "dm_T2_znorm", "dm_T1C_znorm", "dm_FLAIR_znorm", 
+channels = ["dm_T1_znorm", "dm_T2_znorm", "dm_T1C_znorm", "dm_FLAIR_znorm",
 "seg", "dm_roi_mask"]
-ch_range = range(len(channels))
-
-# Format directory and make sure it exists
-if args.directory[-1] is not "/":
-  args.directory = args.directory + "/"
-if not os.path.isdir(args.directory):
-  os.makedirs(args.directory)
-
-# Open all files
-train_files = [open(args.directory + "train_" + channels[i] + 
-        ".txt", "w") for i in ch_range]
-val_files = [open(args.directory + "val_" + channels[i] + 
-        ".txt", "w") for i in ch_range]
-test_files = [open(args.directory + "test_" + channels[i] + 
-        ".txt", "w") for i in ch_range]
-val_pred = open(args.directory + "val_pred.txt", "w")
-test_pred = open(args.directory + "test_pred.txt", "w")
-
-# Read in filenames csv as pandas data frame
-fp = pd.read_csv(args.file, sep=",")
-
-if args.type is None:
-  # For each patient in the data frame
-  for i in range(len(fp.index)):
-    split = fp["type"].iloc[i]
-    if split == "HGG" or split == "LGG":
-      for j in ch_range:
-        train_files[j].write(directory + fp[channels[j]].iloc[i] + "\n")
-    elif split == "VAL":
-      for j in ch_range:
-        val_files[j].write(directory + fp[channels[j]].iloc[i] + "\n")
-      val_pred.write(fp["BraTS18ID"].iloc[i] + "_pred.nii.gz" + "\n")
-    elif split == "TEST":
-      for j in ch_range:
-        test_files[j].write(directory + fp[channels[j]].iloc[i] + "\n")
-      test_pred.write(fp["BraTS18ID"].iloc[i] + "_pred.nii.gz" + "\n")
-
-elif args.type == "all":
-  # For each patient in the data frame
-  for i in range(len(fp.index)):
-    if fp["type"].iloc[i] == "HGG" or fp["type"].iloc[i] == "LGG":
-      # Generate random number and see which range it is in
-      # Then write path of each channel to corresponding text file
-      # If val or test set, also create a new filename for a prediction
-      # output from the neural network
-      split = random.random()
-      if split < args.train:
-        for j in ch_range:
-          train_files[j].write(directory + fp[channels[j]].iloc[i] + "\n")
-      elif split < args.train + args.val:
-        for j in ch_range:
-          val_files[j].write(directory + fp[channels[j]].iloc[i] + "\n")
-        val_pred.write(fp["BraTS18ID"].iloc[i] + "_pred.nii.gz" + "\n")
-      elif split < args.train + args.val + args.test:
-        for j in ch_range:
-          test_files[j].write(directory + fp[channels[j]].iloc[i] + "\n")
-        test_pred.write(fp["BraTS18ID"].iloc[i] + "_pred.nii.gz" + "\n")
-
-else:
-  # For each patient in the data frame
-  for i in range(len(fp.index)):
-    if fp["type"].iloc[i] == args.type:
-      # Generate random number and see which range it is in
-      # Then write path of each channel to corresponding text file
-      # If val or test set, also create a new filename for a prediction
-      # output from the neural network
-      split = random.random()
-      if split < args.train:
-        for j in ch_range:
-          train_files[j].write(directory + fp[channels[j]].iloc[i] + "\n")
-      elif split < args.train + args.val:
-        for j in ch_range:
-          val_files[j].write(directory + fp[channels[j]].iloc[i] + "\n")
-        val_pred.write(fp["BraTS18ID"].iloc[i] + "_pred.nii.gz" + "\n")
-      elif split < args.train + args.val + args.test:
-        for j in ch_range:
-          test_files[j].write(directory + fp[channels[j]].iloc[i] + "\n")
-        test_pred.write(fp["BraTS18ID"].iloc[i] + "_pred.nii.gz" + "\n")
-     else:
-       sys.exit("Error: Type: '" + args.type + "' not found in file")
+
+# Column listed for a channel when the csv has it. The seg lists hold the
+# dm_seg copy written (and cropped) by deepmedicPreprocess.py, so they match
+# the size of the dm_* images
+channelColumns = {"seg": "dm_seg"}
+
+sets = ["train", "val", "test"]
+
+
+def strataCodes(fp, stratify):
+  # Integer code of each row's stratum
+  if not stratify:
+    return np.zeros(len(fp.index), np.intp)
+  return fp.groupby(list(stratify), sort = True, dropna = False) \
+      .ngroup().values
+
+
+def stratifiedOrder(codes, seed):
+  # Shuffle each stratum with the seed, then interleave the strata so that
+  # any leading run of the order holds each stratum in proportion to its
+  # size. Returns the rank of each row in that order
+  rng = np.random.default_rng(seed)
+  noise = rng.random(len(codes))
+  order = np.lexsort((noise, codes))
+  sizes = np.bincount(codes)
+  starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+  positions = np.empty(len(codes), np.intp)
+  positions[order] = np.arange(len(codes)) - starts[codes[order]]
+  fraction = (positions + 0.5) / sizes[codes]
+  ranks = np.empty(len(codes), np.intp)
+  ranks[np.lexsort((noise, fraction))] = np.arange(len(codes))
+  return ranks
+
+
+def setCounts(n, ratios):
+  # Exact number of cases in each set, rounding the cumulative ratios
+  bounds = np.floor(n * np.cumsum(ratios) + 0.5).astype(np.intp)
+  return np.minimum(bounds, n)
+
+
+def ratioSplits(codes, ratios, seed):
+  # Set index (0 train, 1 val, 2 test) of each row, -1 for rows in none of
+  # the sets
+  ranks = stratifiedOrder(codes, seed)
+  split = np.searchsorted(setCounts(len(codes), ratios), ranks, side = "right")
+  split[split == len(ratios)] = -1
+  return split
+
+
+def foldSplits(codes, folds, test, seed):
+  # Stratified k folds after holding out a test fraction. Returns list of
+  # set index arrays, one per fold
+  ranks = stratifiedOrder(codes, seed)
+  nTest = setCounts(len(codes), [test])[0]
+  isTest = ranks < nTest
+  fold = (ranks - nTest) % folds
+  splits = []
+  for k in range(folds):
+    split = np.where(fold == k, 1, 0)
+    split[isTest] = 2
+    splits.append(split)
+  return splits
+
+
+def writeLists(fp, split, outDir, directory, idColumn):
+  # One buffered write per output file
+  if outDir and not os.path.isdir(outDir):
+    os.makedirs(outDir)
+  for i, name in enumerate(sets):
+    rows = fp[split == i]
+    for ch in channels:
+      col = channelColumns.get(ch, ch)
+      if col not in fp:
+        col = ch
+      with open(os.path.join(outDir, name + "_" + ch + ".txt"), "w") as f:
+        f.write("".join(os.path.join(directory, p) + "\n" for p in rows[col]))
+    if name != "train":
+      with open(os.path.join(outDir, name + "_pred.txt"), "w") as f:
+        f.write("".join(str(sid) + "_pred.nii.gz\n" for sid in rows[idColumn]))
+
+
+def partitionCases(fp, outDir = "", directory = "", caseType = None,
+                   ratios = (0, 0, 0), seeds = (0,), folds = None,
+                   stratify = ("type",), idColumn = "BraTS18ID"):
+  # Partition the cases of fp (DataFrame from createFilePaths.py) and write
+  # the lists of each seed/fold to outDir. caseType and ratios are --type and
+  # --train/--val/--test. Returns DataFrame with the set of every case for
+  # each seed and fold (partition.csv)
+  if sum(ratios) > 1.0:
+    raise ValueError("Sum of ratios train, val, and test cannot be greater " +
+                     "that 1")
+
+  if caseType is None:
+    # HGG/LGG train, VAL val, TEST test
+    split = fp["type"].map({"HGG": 0, "LGG": 0, "VAL": 1, "TEST": 2}) \
+        .fillna(-1).astype(int).values
+    writeLists(fp, split, outDir, directory, idColumn)
+    return fp.assign(split = [sets[s] if s >= 0 else "" for s in split])[
+        [idColumn, "type", "split"]]
+
+  if caseType == "all":
+    fp = fp[fp["type"].isin(["HGG", "LGG"])].reset_index(drop = True)
+  else:
+    fp = fp[fp["type"] == caseType].reset_index(drop = True)
+    if len(fp.index) == 0:
+      raise ValueError("Type: '" + caseType + "' not found in file")
+
+  codes = strataCodes(fp, stratify)
+  assignments = fp[[idColumn, "type"]].copy()
+  for seed in seeds:
+    seedDir = outDir
+    if len(seeds) > 1:
+      seedDir = os.path.join(outDir, "seed" + str(seed))
+    if folds is None:
+      split = ratioSplits(codes, ratios, seed)
+      writeLists(fp, split, seedDir, directory, idColumn)
+      assignments["seed" + str(seed)] = [sets[s] if s >= 0 else "" for s in split]
+    else:
+      for k, split in enumerate(foldSplits(codes, folds, ratios[2], seed)):
+        writeLists(fp, split, os.path.join(seedDir, "fold" + str(k)),
+            directory, idColumn)
+        assignments["seed" + str(seed) + "_fold" + str(k)] = \
+            [sets[s] for s in split]
+    print("Partitioned {0} cases with seed {1}".format(len(fp.index), seed))
+  return assignments
+
+
+if __name__ == "__main__":
+  # Get params from cmd line
+  parser = argparse.ArgumentParser(description = "Partition filepaths into " +
+      "text files for deepmedic")
+  parser.add_argument("--file", "-f", help = "CSV with filepaths",
+        required = True)
+  parser.add_argument("--type", "-t", default = None,
+        help = "Type [HGG, LGG, VAL, TEST, all] in csv file to use\n" +
+               "Note: 'all' just includes HGG/LGGi." +
+               "If --type not specified, HGG/LGG used in train and " +
+               "VAL and TEST are used for val and test respectively")
+  parser.add_argument("--directory", "-d", default = "",
+        help = "Directory to place output files in")
+  parser.add_argument("--train", default = 0, type = float,
+        help = "Ratio [0,1] of cases to put in train set")
+  parser.add_argument("--val", default = 0, type = float,
+        help = "Ratio [0,1] of cases to put in validation set")
+  parser.add_argument("--test", default = 0, type = float,
+        help = "Ratio [0,1] of cases to put in test set")
+  parser.add_argument("--seed", default = [0], type = int, nargs = "+",
+        help = "Seeds to partition with")
+  parser.add_argument("--folds", default = None, type = int,
+        help = "Number of cross validation folds")
+  parser.add_argument("--stratify", default = ["type"], nargs = "*",
+        help = "Columns to stratify by")
+  parser.add_argument("--id", "-i", default = "BraTS18ID",
+        help = "Name of column with IDs")
+  args = parser.parse_args()
+
+  # Directory of image files, not to be confused with directory to place
+  # output files in
+  directory = os.path.dirname(args.file)
+
+  # Read in filenames csv as pandas data frame
+  fp = pd.read_csv(args.file, sep=",")
+
+  try:
+    assignments = partitionCases(fp, args.directory, directory, args.type,
+        [args.train, args.val, args.test], args.seed, args.folds,
+        args.stratify, args.id)
+  except ValueError as e:
+    sys.exit("Error: {0}".format(e))
+  assignments.to_csv(os.path.join(args.directory, "partition.csv"),
+      index = False)
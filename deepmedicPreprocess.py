@@ -1,55 +1,504 @@
-import argparse, os
+#
+#  Normalizes images and creates roi masks for DeepMedic
+#
+#  Uses output csv file from createFilePaths.py as input. Each image column in
+#  imagePairs is read, cast to float, optionally n4 bias corrected, z-score
+#  normalized and written to its dm_* column. The roi mask is created from
+#  the T1 image. The z-score mean and standard deviation are computed inside
+#  the brain (non zero voxels) only and the background stays 0. The label
+#  map (segPair) is copied unchanged to dm_seg, cropped with the channels
+#  when --crop is given, so the DeepMedic lists only hold images of the same
+#  size. Csv files without a dm_seg column (createFilePaths.py fills it in
+#  for older files) skip it.
+#
+#  Usage:
+#    $ python deepmedicPreprocess.py -f csvwithfilepaths.csv
+#
+#    Optional command line args
+#      -n4                    Apply n4 bias correction (takes a long time)
+#      --n4-shrink [N]        Estimate the n4 bias field on the image shrunk
+#                               by N in each dimension (default = 1, no
+#                               shrinking)
+#      --n4-levels [N]        Number of n4 fitting levels (default = 4)
+#      --n4-iterations [N]    Max n4 iterations per level (default = 50)
+#      --bias-field, -b       Save the n4 log bias field next to each input
+#                               image and reuse it when it is newer than the
+#                               input, so later runs do not estimate it
+#                               again. The n4 parameters are part of the
+#                               file name (INPUT_n4bias_s1l4i50.nii.gz for
+#                               shrink 1, 4 levels, 50 iterations), so a
+#                               field is only reused with the same settings
+#      --workers, -w [N]      Number of worker processes. Each (subject,
+#                               channel) pair is one job (default = 1)
+#      --threads [N]          SimpleITK threads per worker
+#                               (default = cpu count / workers)
+#      --resume, -r           Skip jobs whose outputs were finished in an
+#                               earlier run
+#      --crop, -c             Crop all channels of a subject to the shared
+#                               brain bounding box plus padding. Each subject
+#                               is one job. Crop offsets are written to
+#                               CSVNAME_crop.csv for uncropImage as soon as a
+#                               subject is done. With --resume subjects
+#                               without crop offsets are processed again
+#      --pad [N]              Voxels of padding around the bounding box
+#                               (default = 4)
+#      --id, -i [ID]          Name of column with IDs, used in the crop file
+#                               and traces. Without that column the row
+#                               index is used (default = BraTS18ID)
+#      --compression [TYPE]   Output compression (default = gzip)
+#                               gzip  .nii.gz, default gzip level
+#                               fast  .nii.gz, gzip level 1
+#                               pigz  .nii.gz, parallel gzip with pigz
+#                               none  uncompressed .nii. The csv file with
+#                                     the dm_* paths changed to .nii is
+#                                     written to CSVNAME_nii.csv, the input
+#                                     csv is not changed
+#      --trace [FILE]         Append per subject/stage timing and resource
+#                               records to FILE, see stageTrace.py
+#      --shard [i/N]          Only process shard i (0 based) of N, balanced
+#                               by input file sizes, see shardCohort.py.
+#                               The crop file gets a _shardIofN suffix
+
+import argparse, os, shutil, subprocess
+import multiprocessing
+import numpy as np
 import pandas as pd
 import SimpleITK as sitk
 
-# Get params from cmd line
-parser = argparse.ArgumentParser(description = "Preprocess nii files")
-parser.add_argument("--file", "-f", help = "CSV with filepaths", 
-      required = True) 
-parser.add_argument("-n4", action = "store_true", 
-      help = "Apply n4 bias correction. NOTE: Takes a long time")
-args = parser.parse_args()
+from shardCohort import parseShard, selectShard, shardPath
+from stageTrace import enableTrace, stage
+from volumeCache import readImage
+
+# List of list of length 2 where the first index is the column of the input
+# image and the second index is the column of the normalized output image
+#   e.g.  ["T1", "dm_T1_znorm"]
+imagePairs = [
+    ["T1", "dm_T1_znorm"], ["T2", "dm_T2_znorm"], ["T1C", "dm_T1C_znorm"],
+    ["FLAIR", "dm_FLAIR_znorm"]
+  ]
+
+# Input column the roi mask is created from and the column to write it to
+maskPair = ["T1", "dm_roi_mask"]
+
+# Label map column and the column of its copy next to the dm_* images. It is
+# cropped like the images, but not normalized
+segPair = ["seg", "dm_seg"]
+
+
+compressionTypes = ["gzip", "fast", "pigz", "none"]
+
+
+def outputPath(filePath, compression):
+  # .nii.gz paths become .nii for uncompressed output. Blank cells are kept
+  if (compression == "none" and isinstance(filePath, str) and
+      filePath.endswith(".nii.gz")):
+    return filePath[:-len(".gz")]
+  return filePath
+
+
+def writeImage(img, filePath, compression = "gzip", threads = 1):
+  # Write to a temporary file first and move it into place so a file at
+  # filePath is always complete. --resume relies on this.
+  tmpPath = os.path.join(os.path.dirname(filePath),
+      ".partial_" + os.path.basename(filePath))
+  if compression == "pigz" and filePath.endswith(".gz"):
+    # Write uncompressed and compress with parallel gzip
+    rawPath = tmpPath[:-len(".gz")]
+    sitk.WriteImage(img, rawPath, False)
+    subprocess.check_call(["pigz", "-f", "-p", str(threads), rawPath])
+  elif compression == "fast":
+    sitk.WriteImage(img, tmpPath, True, 1)
+  else:
+    sitk.WriteImage(img, tmpPath, compression != "none")
+  os.replace(tmpPath, filePath)
+
+
+def cropBox(masks, pad):
+  # Bounding box (index, size in x, y, z) of the union of masks plus pad
+  # voxels on each side, clipped to the image
+  union = np.zeros(sitk.GetArrayViewFromImage(masks[0]).shape, bool)
+  for mask in masks:
+    union |= sitk.GetArrayViewFromImage(mask).astype(bool)
+  shape = union.shape[::-1]
+  if not union.any():
+    return [0] * len(shape), list(shape)
+  # numpy arrays are z, y, x
+  lower = []
+  upper = []
+  for axis in range(union.ndim):
+    other = tuple(a for a in range(union.ndim) if a != axis)
+    hits = np.flatnonzero(union.any(axis = other))
+    lower.insert(0, max(int(hits[0]) - pad, 0))
+    upper.insert(0, min(int(hits[-1]) + pad + 1, union.shape[axis]))
+  return lower, [u - l for l, u in zip(lower, upper)]
+
+
+def uncropImage(cropped, index, fullSize):
+  # Pad a cropped image (e.g. a prediction) back to the full image grid using
+  # the offsets in the crop file
+  upper = [f - i - c for f, i, c in zip(fullSize, index, cropped.GetSize())]
+  return sitk.ConstantPad(cropped, [int(i) for i in index],
+      [int(u) for u in upper], 0)
+
+
+def biasFieldPath(imagePath, shrink, levels, iterations):
+  # Bias field file for the n4 parameters, e.g. shrink 1, 4 levels and 50
+  # iterations: HGG/ID/ID_t1.nii.gz -> HGG/ID/ID_t1_n4bias_s1l4i50.nii.gz
+  suffix = "_n4bias_s{0}l{1}i{2}".format(shrink, levels, iterations)
+  if imagePath.endswith(".nii.gz"):
+    return imagePath[:-len(".nii.gz")] + suffix + ".nii.gz"
+  return os.path.splitext(imagePath)[0] + suffix + ".nii"
+
 
-imageNames = ["dm_T1_znorm", "dm_T2_znorm", "dm_T1C_znorm", 
-              "dm_FLAIR_znorm", "dm_roi_mask"]
+def n4Correct(img, imgMask, job):
+  # N4 bias correction. The bias field is estimated on a shrunk image and
+  # evaluated at full resolution. If job["bias"] is set the log bias field is
+  # read from / saved to that file
+  biasPath = job["bias"]
+  if (biasPath is not None and os.path.isfile(biasPath) and
+      os.path.getmtime(biasPath) >= os.path.getmtime(job["input"])):
+    logBias = sitk.ReadImage(biasPath)
+  else:
+    shrink = [job["n4Shrink"]] * img.GetDimension()
+    corrector = sitk.N4BiasFieldCorrectionImageFilter()
+    corrector.SetMaximumNumberOfIterations(
+        [job["n4Iterations"]] * job["n4Levels"])
+    corrector.Execute(sitk.Shrink(img, shrink), sitk.Shrink(imgMask, shrink))
+    logBias = sitk.Cast(corrector.GetLogBiasFieldAsImage(img),
+        sitk.sitkFloat32)
+    if biasPath is not None:
+      writeImage(logBias, biasPath)
+  return img / sitk.Exp(sitk.Cast(logBias, img.GetPixelID()))
 
-# Get directory of csv file
-directory = os.path.dirname(args.file)
 
-# Read csv into pandas dataframe
-paths = pd.read_csv(args.file)
+def maskedZScore(img, imgMask):
+  # Z-score normalize with mean/std of the voxels in imgMask. The variance
+  # is computed in float64 from the deviations (a second pass) since
+  # E[x^2] - E[x]^2 loses most of its precision at MRI intensities. Voxels
+  # outside the mask are 0
+  arr = sitk.GetArrayViewFromImage(img)
+  mask = sitk.GetArrayViewFromImage(imgMask).astype(bool)
+  values = arr[mask]
+  count = max(values.size, 1)
+  mean = values.sum(dtype = np.float64) / count
+  dev = values.astype(np.float64) - mean
+  var = np.dot(dev, dev) / count
+  # Constant (or empty) masks are only centered
+  std = np.sqrt(var) if var != 0 else 1.0
+  out = np.zeros(arr.shape, np.float32)
+  out[mask] = dev / std
+  normImg = sitk.GetImageFromArray(out)
+  normImg.CopyInformation(img)
+  return normImg
 
-# Num subjects in csv
-count = len(paths.index)
 
-# Loop for each subject in csv
-for i in range(count):
-  
-  print("Processing subject {1}/{2}...".format(i + 1, count))
+def jobOutputs(job):
+  # Returns list of output paths a job writes
+  outputs = [job["output"]]
+  if job["mask"] is not None:
+    outputs.append(job["mask"])
+  return outputs
 
-  # Loop for each image type
-  for name in imageNames:        
 
-    # Load image from file
-    filePath = directory + "/" + paths[name].iloc[i]
-    img = sitk.ReadImage(filePath)
+def cellPath(directory, value):
+  # Path of a csv cell relative to directory, None for a blank cell
+  if not isinstance(value, str) or not value:
+    return None
+  return os.path.join(directory, value)
+
+
+def rowID(paths, i, idColumn):
+  # Subject ID of row i, the row index if paths has no idColumn
+  if idColumn in paths:
+    return paths[idColumn].iloc[i]
+  return paths.index[i]
+
+
+def subjectJobs(paths, i, directory, args):
+  # One job per channel in imagePairs (and the label map if paths has a
+  # segPair output column) of row i of paths. args has the options of the
+  # command line (n4, compression, threads, ...). Channels with a blank
+  # input or output cell are skipped
+  jobs = []
+  pairs = imagePairs + ([segPair] if segPair[1] in paths else [])
+  for pair in pairs:
+    job = {"subject": i, "id": rowID(paths, i, args.id), "name": pair[1],
+           "input": cellPath(directory, paths[pair[0]].iloc[i]),
+           "output": cellPath(directory, paths[pair[1]].iloc[i]),
+           "label": pair == segPair,
+           "mask": None, "n4": args.n4 and pair != segPair,
+           "n4Shrink": args.n4_shrink,
+           "n4Levels": args.n4_levels, "n4Iterations": args.n4_iterations,
+           "bias": None, "compression": args.compression,
+           "threads": args.threads, "pad": args.pad}
+    if job["input"] is None or job["output"] is None:
+      print("Skipping {0} of {1}, blank path in csv".format(pair[1],
+          job["id"]))
+      continue
+    if args.bias_field and job["n4"]:
+      job["bias"] = biasFieldPath(job["input"], job["n4Shrink"],
+                                  job["n4Levels"], job["n4Iterations"])
+    if pair[0] == maskPair[0]:
+      job["mask"] = cellPath(directory, paths[maskPair[1]].iloc[i])
+    jobs.append(job)
+  return jobs
+
+
+def initWorker(threads):
+  # Cap ITK threads per worker so the pool does not oversubscribe the cores
+  sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+
+def loadImage(job):
+  # Read and cast image, returns image and brain mask (non zero voxels).
+  # Label maps keep their pixel type and have no brain mask
+  with stage(job["id"], "read", channel = job["name"]):
+    img = readImage(job["input"])
+  if job["label"]:
+    return img, None
+  with stage(job["id"], "cast", channel = job["name"]):
     img = sitk.Cast(img, sitk.sitkFloat32)
     imgMask = sitk.BinaryNot(sitk.BinaryThreshold(img, 0, 0))
-      
-    # If specified on cmd line, do n4 bias correction
-    if args.n4:
-      img = sitk.N4BiasFieldCorrection(img, imgMask)
-      
-    # Z-score normalize image
-    img = sitk.Normalize(img)
-
-    # Create binary path from T1 image
-    if name is "T1":
-      sitk.WriteImage(imgMask, filePath)
-      print("Created binary mask") 
+  return img, imgMask
+
+
+def processImage(job, img, imgMask, box = None):
+  # If specified on cmd line, do n4 bias correction
+  if job["n4"]:
+    with stage(job["id"], "n4", channel = job["name"]):
+      img = n4Correct(img, imgMask, job)
+
+  # Z-score normalize image inside the brain
+  if not job["label"]:
+    with stage(job["id"], "normalize", channel = job["name"]):
+      img = maskedZScore(img, imgMask)
+
+  # Crop to the subject's bounding box
+  if box is not None:
+    with stage(job["id"], "crop", channel = job["name"]):
+      img = sitk.RegionOfInterest(img, box[1], box[0])
+      if imgMask is not None:
+        imgMask = sitk.RegionOfInterest(imgMask, box[1], box[0])
+
+  with stage(job["id"], "write", channel = job["name"]):
+    # Create binary mask from T1 image
+    if job["mask"] is not None:
+      writeImage(imgMask, job["mask"], job["compression"], job["threads"])
 
     # Write corrected image to new file
-    sitk.WriteImage(img, filepath)
-    print("  Created file at {0}".format(newFilePath))
+    writeImage(img, job["output"], job["compression"], job["threads"])
+
+
+def preprocessImage(job):
+  # Read, cast, n4 correct (optional) and normalize one image
+  img, imgMask = loadImage(job)
+  processImage(job, img, imgMask)
+  return [job], None
+
+
+def preprocessSubject(jobs):
+  # Preprocess all channels of one subject and crop them to the same box.
+  # Returns jobs and crop box (index, size, full size)
+  images = [loadImage(job) for job in jobs]
+  with stage(jobs[0]["id"], "cropbox"):
+    box = cropBox([imgMask for img, imgMask in images if imgMask is not None],
+        jobs[0]["pad"])
+  for job, (img, imgMask) in zip(jobs, images):
+    processImage(job, img, imgMask, box)
+  return jobs, (box[0], box[1], list(images[0][0].GetSize()))
+
+
+def uncompressedCSVPath(csvPath):
+  # e.g. paths.csv -> paths_nii.csv
+  split = os.path.splitext(csvPath)
+  return split[0] + "_nii" + split[1]
+
+
+def uncompressedPaths(paths):
+  # Copy of paths with the dm_* output paths changed to .nii
+  paths = paths.copy()
+  for col in [pair[1] for pair in imagePairs] + [maskPair[1], segPair[1]]:
+    if col not in paths:
+      continue
+    paths[col] = [outputPath(p, "none") for p in paths[col]]
+  return paths
+
+
+def cropTable(crops, idColumn = "BraTS18ID"):
+  # Crop file rows (see preprocessPaths) as a DataFrame
+  axes = ["x", "y", "z"]
+  columns = ([idColumn] + ["index_" + a for a in axes] +
+      ["size_" + a for a in axes] + ["fullsize_" + a for a in axes])
+  return pd.DataFrame(list(crops.values()), columns = columns)
+
+
+def readCrops(cropFile):
+  # Dict of subject ID -> crop file row, the last row of an ID wins
+  crops = {}
+  if os.path.isfile(cropFile):
+    for row in pd.read_csv(cropFile).itertuples(index = False):
+      crops[row[0]] = list(row)
+  return crops
+
+
+def appendCrop(cropFile, row, idColumn = "BraTS18ID"):
+  # Append one crop file row, writing the header to a new file
+  cropTable({row[0]: row}, idColumn).to_csv(cropFile, mode = "a",
+      header = not os.path.isfile(cropFile), index = False)
+
+
+def preprocessPaths(paths, directory, args, crops = None, cropFile = None):
+  # Preprocess every subject of paths (DataFrame from createFilePaths.py,
+  # paths relative to directory). args has the options of the command line.
+  # Returns dict of subject ID -> crop file row, updating crops if given.
+  # With cropFile each subject's row is appended to it once it is done, so
+  # the offsets of finished subjects survive a crash
+  count = len(paths.index)
+  if crops is None:
+    crops = {}
+
+  # Build one job per (subject, channel)
+  jobs = []
+  for i in range(count):
+    jobs.extend(subjectJobs(paths, i, directory, args))
+
+  # With --crop all channels of a subject are one job
+  if args.crop:
+    tasks = [[job for job in jobs if job["subject"] == i] for i in range(count)]
+    worker = preprocessSubject
+  else:
+    tasks = [[job] for job in jobs]
+    worker = preprocessImage
+
+  # Skip jobs with all outputs already written. Cropped subjects also need
+  # their crop offsets, or their outputs can not be uncropped
+  if args.resume:
+    todo = [task for task in tasks if not all(os.path.isfile(f)
+            for job in task for f in jobOutputs(job)) or (args.crop and
+            task and task[0]["id"] not in crops)]
+    print("Resuming, skipping {0}/{1} finished jobs".format(
+        len(tasks) - len(todo), len(tasks)))
+    tasks = todo
+
+  print("Processing {0} jobs for {1} subjects with {2} worker(s)...".format(
+      len(tasks), count, args.workers))
+
+  if args.crop:
+    tasks = [task for task in tasks if task]
+  else:
+    tasks = [task[0] for task in tasks]
+
+  if args.workers > 1:
+    pool = multiprocessing.Pool(args.workers, initializer = initWorker,
+        initargs = (args.threads,))
+    results = pool.imap_unordered(worker, tasks)
+  else:
+    initWorker(args.threads)
+    pool = None
+    results = map(worker, tasks)
+
+  for n, (done, box) in enumerate(results):
+    for job in done:
+      print("  [{0}/{1}] Subject {2}/{3} created file at {4}".format(
+          n + 1, len(tasks), job["subject"] + 1, count, job["output"]))
+    if box is not None:
+      subjectID = rowID(paths, done[0]["subject"], args.id)
+      crops[subjectID] = [subjectID] + box[0] + box[1] + box[2]
+      if cropFile is not None:
+        appendCrop(cropFile, crops[subjectID], args.id)
+
+  if pool is not None:
+    pool.close()
+    pool.join()
+
+  return crops
+
+
+if __name__ == "__main__":
+  # Get params from cmd line
+  parser = argparse.ArgumentParser(description = "Preprocess nii files")
+  parser.add_argument("--file", "-f", help = "CSV with filepaths",
+        required = True)
+  parser.add_argument("-n4", action = "store_true",
+        help = "Apply n4 bias correction. NOTE: Takes a long time")
+  parser.add_argument("--n4-shrink", default = 1, type = int,
+        help = "Shrink factor used to estimate the n4 bias field " +
+        "(default = 1, full resolution)")
+  parser.add_argument("--n4-levels", default = 4, type = int,
+        help = "Number of n4 fitting levels")
+  parser.add_argument("--n4-iterations", default = 50, type = int,
+        help = "Max n4 iterations per fitting level")
+  parser.add_argument("--bias-field", "-b", action = "store_true",
+        help = "Save and reuse n4 bias fields next to the input images")
+  parser.add_argument("--workers", "-w", default = 1, type = int,
+        help = "Number of worker processes")
+  parser.add_argument("--threads", default = None, type = int,
+        help = "SimpleITK threads per worker (default = cpus / workers)")
+  parser.add_argument("--resume", "-r", action = "store_true",
+        help = "Skip outputs already finished in an earlier run")
+  parser.add_argument("--crop", "-c", action = "store_true",
+        help = "Crop channels of each subject to the brain bounding box")
+  parser.add_argument("--pad", default = 4, type = int,
+        help = "Padding in voxels around the crop bounding box")
+  parser.add_argument("--id", "-i", default = "BraTS18ID",
+        help = "Name of column with IDs")
+  parser.add_argument("--compression", default = "gzip",
+        choices = compressionTypes, help = "Output compression")
+  parser.add_argument("--trace", default = None,
+        help = "JSON lines file to append stage timing records to")
+  parser.add_argument("--shard", default = None, type = parseShard,
+        help = "Only process shard i of N (i/N)")
+  args = parser.parse_args()
+
+  enableTrace(args.trace, "deepmedicPreprocess")
+
+  if args.compression == "pigz" and shutil.which("pigz") is None:
+    parser.error("--compression pigz needs pigz on the PATH")
+
+  if args.threads is None:
+    args.threads = max(1, multiprocessing.cpu_count() // max(1, args.workers))
+
+  # Get directory of csv file
+  directory = os.path.dirname(args.file)
+
+  # Read csv into pandas dataframe
+  paths = pd.read_csv(args.file)
+
+  # Num subjects in csv
+  count = len(paths.index)
+
+  # Uncompressed outputs are .nii, the csv with the new paths is written
+  # next to the input csv
+  if args.compression == "none":
+    paths = uncompressedPaths(paths)
+    niiFile = uncompressedCSVPath(args.file)
+    # Moved into place so shards running at the same time never read a
+    # partly written csv
+    tmpFile = "{0}.{1}.tmp".format(niiFile, os.getpid())
+    paths.to_csv(tmpFile, index = False)
+    os.replace(tmpFile, niiFile)
+    print("Csv file with .nii dm_* paths written to {0}".format(niiFile))
+
+  # Only this shard's subjects
+  if args.shard is not None:
+    paths = selectShard(paths, args.shard, directory)
+    count = len(paths.index)
+    print("Shard {0}/{1}: {2} subjects".format(args.shard[0], args.shard[1],
+        count))
+
+  # Crop offsets of each subject, kept from earlier runs
+  cropFile = shardPath(os.path.splitext(args.file)[0] + "_crop.csv",
+      args.shard)
+  crops = readCrops(cropFile) if args.crop else {}
+
+  preprocessPaths(paths, directory, args, crops,
+                  cropFile if args.crop else None)
+
+  # Rewrite the appended rows with one row per subject
+  if args.crop:
+    tmpFile = "{0}.{1}.tmp".format(cropFile, os.getpid())
+    cropTable(crops, args.id).to_csv(tmpFile, index = False)
+    os.replace(tmpFile, cropFile)
+    print("Crop offsets written to {0}".format(cropFile))
 
-print("Preprocessing and normalization complete")
+  print("Preprocessing and normalization complete")
@@ -0,0 +1,190 @@
+# Precomputes patch sampling indexes for each subject
+#
+# Patch samplers need the voxel coordinates of each class (background inside
+# the roi mask and each seg label) to draw class-balanced patch centers.
+# Instead of scanning dm_roi_mask and seg every time a subject is loaded,
+# this writes the coordinates of each class once to ID_sampling.npz next to
+# the roi mask. Coordinates are (z, y, x) in uint8 if every dimension is
+# below 256 (e.g. 240x240x155 BraTS volumes) and int16 otherwise, and can be
+# subsampled to a maximum number per class.
+#
+# The index records the size and modification time of the mask files it
+# was built from. loadSamplingIndex returns None once either file changed,
+# and running this script again only rebuilds those subjects.
+#
+# Usage:
+#   $ python deepmedicSamplingIndex.py -f csvwithfilepaths.csv
+#
+#   Optional command line args
+#     --max-per-class [N]  Keep at most N random coordinates per class
+#                            (default = keep all)
+#     --seed [N]           Seed for subsampling (default = 0)
+#     --force              Rebuild indexes that are still current
+#     --workers, -w [N]    Number of worker processes (default = 1)
+#
+# In a sampler:
+#   index = loadSamplingIndex(roiMaskPath, [roiMaskPath, segPath])
+#   centers = samplePatchCenters(index, 20, rng)
+
+import argparse, json, os
+import multiprocessing
+import numpy as np
+
+# Columns of the roi mask and label map. The label map is the dm_seg copy
+# (cropped like the roi mask) if the csv has it, seg otherwise
+roiColumn = "dm_roi_mask"
+segColumn = "dm_seg"
+fullSegColumn = "seg"
+
+# Class 0 is background inside the roi mask, the others are seg labels
+segLabels = [1, 2, 4]
+
+
+def indexPath(roiPath):
+  # e.g. HGG/ID/ID_dm_roi_mask.nii.gz -> HGG/ID/ID_sampling.npz
+  directory = os.path.dirname(roiPath)
+  return os.path.join(directory, os.path.basename(directory) + "_sampling.npz")
+
+
+def fileSignatures(paths):
+  # [absolute path, size, mtime] of each file, used to detect changed masks.
+  # Absolute paths so callers using relative and absolute paths share the
+  # index
+  signatures = []
+  for path in paths:
+    st = os.stat(path)
+    signatures.append([os.path.abspath(path), st.st_size, st.st_mtime_ns])
+  return signatures
+
+
+def loadSamplingIndex(roiPath, sourcePaths):
+  # Returns dict of class -> coordinate array, or None if the index is
+  # missing or was built from different versions of sourcePaths
+  path = indexPath(roiPath)
+  if not os.path.isfile(path):
+    return None
+  with np.load(path) as data:
+    try:
+      current = fileSignatures(sourcePaths)
+    except OSError:
+      return None
+    if json.loads(str(data["sources"])) != current:
+      return None
+    return dict((int(key[len("class_"):]), data[key]) for key in data.files
+                if key.startswith("class_"))
+
+
+def buildSamplingIndex(job):
+  # Write the sampling index of one subject. Returns (job, counts per class)
+  # or (job, None) if the existing index is current
+  import SimpleITK as sitk
+  sources = [job["roi"], job["seg"]]
+  if not job["force"] and loadSamplingIndex(job["roi"], sources) is not None:
+    return job, None
+  roi = sitk.GetArrayFromImage(sitk.ReadImage(job["roi"])) != 0
+  seg = sitk.GetArrayFromImage(sitk.ReadImage(job["seg"]))
+  if roi.shape != seg.shape:
+    raise ValueError("{0} and {1} differ in size".format(job["roi"], job["seg"]))
+  dtype = np.uint8 if max(roi.shape) <= 256 else np.int16
+
+  # One pass: class of every voxel in the roi or tumor, -1 elsewhere
+  classes = np.full(seg.shape, -1, np.int8)
+  classes[roi & (seg == 0)] = 0
+  for label in segLabels:
+    classes[seg == label] = label
+  flat = classes.ravel()
+  rng = np.random.default_rng(job["seed"])
+  arrays = {}
+  counts = {}
+  for label in [0] + segLabels:
+    where = np.flatnonzero(flat == label)
+    if job["maxPerClass"] is not None and where.size > job["maxPerClass"]:
+      where = np.sort(rng.choice(where, job["maxPerClass"], replace = False))
+    coords = np.stack(np.unravel_index(where, seg.shape), axis = 1)
+    arrays["class_" + str(label)] = coords.astype(dtype)
+    counts[label] = int(where.size)
+
+  path = indexPath(job["roi"])
+  tmpPath = path + ".tmp.npz"
+  np.savez(tmpPath, sources = json.dumps(fileSignatures(sources)), **arrays)
+  os.replace(tmpPath, path)
+  return job, counts
+
+
+def indexSubject(job):
+  # buildSamplingIndex for the worker pool: a subject whose files cannot be
+  # read or differ in size is returned with its error instead of stopping
+  # the other subjects. Returns (job, counts, error message or None)
+  try:
+    job, counts = buildSamplingIndex(job)
+  except (RuntimeError, ValueError) as e:
+    return job, None, str(e)
+  return job, counts, None
+
+
+def samplePatchCenters(index, count, rng, classWeights = None):
+  # Draw count patch centers (z, y, x). Classes are picked with
+  # classWeights (default = equal for all non empty classes), then a random
+  # coordinate of that class
+  classes = [label for label in sorted(index) if len(index[label])]
+  weights = np.array([1.0 if classWeights is None else
+      classWeights.get(label, 0.0) for label in classes])
+  picks = rng.choice(len(classes), count, p = weights / weights.sum())
+  centers = np.empty((count, 3), np.int64)
+  for i, pick in enumerate(picks):
+    coords = index[classes[pick]]
+    centers[i] = coords[rng.integers(len(coords))]
+  return centers
+
+
+if __name__ == "__main__":
+  import pandas as pd
+
+  parser = argparse.ArgumentParser(description = "Precompute patch " +
+      "sampling indexes for each subject")
+  parser.add_argument("--file", "-f", help = "CSV with filepaths",
+      required = True)
+  parser.add_argument("--max-per-class", default = None, type = int,
+      help = "Keep at most this many coordinates per class")
+  parser.add_argument("--seed", default = 0, type = int,
+      help = "Seed for subsampling")
+  parser.add_argument("--force", action = "store_true",
+      help = "Rebuild indexes that are still current")
+  parser.add_argument("--workers", "-w", default = 1, type = int,
+      help = "Number of worker processes")
+  args = parser.parse_args()
+
+  # Paths in csv are relative to its directory
+  directory = os.path.dirname(args.file)
+  paths = pd.read_csv(args.file)
+  if segColumn not in paths:
+    segColumn = fullSegColumn
+  jobs = [{"roi": os.path.join(directory, paths[roiColumn].iloc[i]),
+           "seg": os.path.join(directory, paths[segColumn].iloc[i]),
+           "maxPerClass": args.max_per_class, "seed": args.seed + i,
+           "force": args.force} for i in range(len(paths.index))]
+
+  if args.workers > 1:
+    pool = multiprocessing.Pool(args.workers)
+    results = pool.imap_unordered(indexSubject, jobs)
+  else:
+    pool = None
+    results = map(indexSubject, jobs)
+
+  built = 0
+  failed = []
+  for n, (job, counts, error) in enumerate(results):
+    if error is not None:
+      print("  [{0}/{1}] Error: {2}".format(n + 1, len(jobs), error))
+      failed.append(job["roi"])
+      continue
+    if counts is None:
+      continue
+    built += 1
+    print("  [{0}/{1}] {2} {3}".format(n + 1, len(jobs),
+        indexPath(job["roi"]), counts))
+  if pool is not None:
+    pool.close()
+    pool.join()
+  print("Built {0} sampling indexes, {1} were current, {2} failed".format(
+      built, len(jobs) - built - len(failed), len(failed)))
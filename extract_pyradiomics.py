@@ -0,0 +1,347 @@
+# Runs pyradiomics for every subject in a filepath csv (from createFilePaths.py)
+#
+# Replaces the filepaths_to_pyradiomicsin.R + pyradiomics batch step, where
+# every (Image, Mask, Label) row decodes its image and mask again. Here each
+# subject is one job: every image is read once and every mask is read once,
+# and all masks and labels are extracted from the images in memory. Subjects
+# run in parallel in a process pool and each finished subject's rows are
+# appended to the output right away, so a crash only loses the subjects that
+# were running.
+#
+# The output has the same layout as the pyradiomics batch output
+# (ID columns, Image, Mask, Label, features) and can be passed to
+# pyradiomics_to_short.py. Shape features only depend on the mask and label,
+# so they are computed once per (Mask, Label) and written in a row with
+# Image = "mask". The rows of each image only have intensity and texture
+# features.
+#
+# Usage:
+#   $ python extract_pyradiomics.py -f BraTS18_filepaths.csv
+#
+#   Optional command line args
+#      --output, -o [FILE]    Output csv
+#                               (default = CSVNAME_pyradiomicsout.csv)
+#      --ids [COL ..]         Columns copied to the output to identify cases,
+#                               the first one is the case ID
+#                               (default = BraTS18ID type)
+#      --type, -t [TYPE ..]   Only extract these types (i.e. HGG, VAL, etc.)
+#      --image-suffix [SUF]   Inserted before .nii.gz in image paths, e.g.
+#                               _NLM for the NLM filtered images
+#      --params, -p [FILE]    pyradiomics parameter file
+#      --workers, -w [N]      Number of worker processes (default = 1)
+#      --shape-per-image      Compute shape features again for every image
+#                               like the pyradiomics batch output
+#      --resume, -r           Append to the output and skip cases already in
+#                               it. Cases that had errors (listed in
+#                               OUTPUT_errors.csv) are extracted again
+#      --trace [FILE]         Append per subject/stage timing and resource
+#                               records to FILE, see stageTrace.py
+#      --shard [i/N]          Only extract shard i (0 based) of N, balanced
+#                               by input file sizes. The output gets a
+#                               _shardIofN suffix, see shardCohort.py
+#
+# Images and mask/label combinations are set in imageColumns and maskLabels.
+#
+# The output header is taken from the first case without errors. A later
+# case with feature columns that are not in the header stops the run instead
+# of silently losing those columns.
+
+import argparse, csv, os, sys
+import multiprocessing
+import SimpleITK as sitk
+
+from shardCohort import parseShard, selectShard, shardPath
+from stageTrace import enableTrace, stage
+from volumeCache import readImage
+
+imageColumns = ["T1", "T2", "T1C", "FLAIR"]
+
+# List of list of length 2 where the first index is the mask column and the
+# second index is the list of labels to extract in that mask
+#   e.g.  ["seg", [1, 2, 4]]
+maskLabels = [["seg", [1, 2, 4]], ["tumor", [1]]]
+
+# Image column value of rows with the shape features of a mask/label
+shapeImage = "mask"
+
+extractor = None
+shapeExtractor = None
+
+
+def initWorker(params, threads, shapePerImage = False):
+  # Create the feature extractors once per worker process. Unless
+  # shapePerImage is set, extractor computes everything but the shape
+  # classes and shapeExtractor computes only the shape classes
+  global extractor, shapeExtractor
+  from radiomics import featureextractor
+  sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+  extractorClass = getattr(featureextractor, "RadiomicsFeatureExtractor",
+      None) or getattr(featureextractor, "RadiomicsFeaturesExtractor")
+  args = [] if params is None else [params]
+  extractor = extractorClass(*args)
+  shapeExtractor = None
+  shapeClasses = dict((name, features) for name, features in
+      extractor.enabledFeatures.items() if name.startswith("shape"))
+  if shapeClasses and not shapePerImage:
+    shapeExtractor = extractorClass(*args)
+    shapeExtractor.disableAllFeatures()
+    shapeExtractor.enableFeaturesByName(**shapeClasses)
+    for name in shapeClasses:
+      del extractor.enabledFeatures[name]
+
+
+def featureValue(value):
+  # numpy scalars/0-d arrays to python values so they are written as numbers
+  if hasattr(value, "item") and getattr(value, "size", 1) == 1:
+    return value.item()
+  return value
+
+
+def imagePath(path, suffix):
+  if suffix and path.endswith(".nii.gz") and suffix not in path:
+    return path[:-len(".nii.gz")] + suffix + ".nii.gz"
+  return path
+
+
+def extractRows(featureExtractor, image, imageRel, mask, maskRel, labels,
+                job, rows, errors):
+  # Run featureExtractor for each label and append output rows/errors
+  for label in labels:
+    try:
+      features = featureExtractor.execute(image, mask, label = label)
+    except Exception as e:
+      errors.append("{0} {1} label {2}: {3}".format(
+          imageRel, maskRel, label, e))
+      continue
+    row = dict(job["ids"])
+    row["Mask"] = maskRel
+    row["Label"] = label
+    row["Image"] = imageRel
+    for key, value in features.items():
+      row[key] = featureValue(value)
+    rows.append(row)
+
+
+def extractSubject(job):
+  # Extract all masks and labels for one subject. Returns
+  # (job, list of output rows, list of error messages)
+  rows = []
+  errors = []
+  masks = {}
+  shapesDone = set()
+  subject = list(job["ids"].values())[0]
+  for imageRel in job["images"]:
+    try:
+      with stage(subject, "read", image = imageRel):
+        image = readImage(os.path.join(job["directory"], imageRel))
+    except Exception as e:
+      errors.append("{0}: {1}".format(imageRel, e))
+      continue
+    for maskRel, labels in job["masks"]:
+      if maskRel not in masks:
+        # Unreadable masks are stored as None and reported once
+        try:
+          with stage(subject, "read", image = maskRel):
+            masks[maskRel] = readImage(os.path.join(job["directory"],
+                maskRel))
+        except Exception as e:
+          masks[maskRel] = None
+          errors.append("{0}: {1}".format(maskRel, e))
+      if masks[maskRel] is None:
+        continue
+      # Shape features once per mask/label, with the first readable image
+      # for geometry
+      if maskRel not in shapesDone and shapeExtractor is not None:
+        shapesDone.add(maskRel)
+        with stage(subject, "shape", mask = maskRel):
+          extractRows(shapeExtractor, image, shapeImage, masks[maskRel],
+              maskRel, labels, job, rows, errors)
+      with stage(subject, "extract", image = imageRel, mask = maskRel):
+        extractRows(extractor, image, imageRel, masks[maskRel], maskRel,
+            labels, job, rows, errors)
+  return job, rows, errors
+
+
+def errorsPath(outPath):
+  # File with the errors of each case, e.g. out.csv -> out_errors.csv
+  return os.path.splitext(outPath)[0] + "_errors.csv"
+
+
+def readCases(path, idColumn):
+  # Case IDs in a csv file
+  if not os.path.isfile(path):
+    return set()
+  with open(path, "r") as f:
+    return set(row[idColumn] for row in csv.DictReader(f))
+
+
+def finishedCases(outPath, idColumn):
+  # Case IDs written to outPath without errors
+  return readCases(outPath, idColumn) - readCases(errorsPath(outPath),
+                                                  idColumn)
+
+
+def dropCases(path, idColumn, cases):
+  # Rewrite the csv at path without the rows of cases
+  if not cases or not os.path.isfile(path):
+    return
+  tmpPath = path + ".tmp"
+  with open(path, "r", newline = "") as f, \
+       open(tmpPath, "w", newline = "") as out:
+    reader = csv.DictReader(f)
+    writer = csv.DictWriter(out, reader.fieldnames)
+    writer.writeheader()
+    writer.writerows(row for row in reader if row[idColumn] not in cases)
+  os.replace(tmpPath, path)
+
+
+def outputHeader(ids, rows):
+  # ID columns, Mask, Label, Image and the features of rows in order
+  header = ids + ["Mask", "Label", "Image"]
+  for row in rows:
+    header.extend(key for key in row if key not in header)
+  return header
+
+
+def writeRows(outFile, writer, header, rows):
+  # Append rows to outFile, writing the header to an empty file. Raises
+  # ValueError if rows have columns that are not in header. Returns writer
+  unknown = sorted(set(key for row in rows for key in row) - set(header))
+  if unknown:
+    raise ValueError("{0} column(s) not in the output header, e.g. {1}"
+        .format(len(unknown), ", ".join(unknown[:5])))
+  if writer is None:
+    writer = csv.DictWriter(outFile, header)
+    if outFile.tell() == 0:
+      writer.writeheader()
+  writer.writerows(rows)
+  outFile.flush()
+  return writer
+
+
+if __name__ == "__main__":
+  import pandas as pd
+
+  parser = argparse.ArgumentParser(description = "Extract pyradiomics " +
+      "features for every subject in a filepath csv")
+  parser.add_argument("--file", "-f", help = "CSV with filepaths",
+      required = True)
+  parser.add_argument("--output", "-o", default = None,
+      help = "Output csv")
+  parser.add_argument("--ids", nargs = "+", default = ["BraTS18ID", "type"],
+      help = "Columns identifying cases, the first one is the case ID")
+  parser.add_argument("--type", "-t", nargs = "+", default = None,
+      help = "Only extract these types")
+  parser.add_argument("--image-suffix", default = "",
+      help = "Inserted before .nii.gz in image paths, e.g. _NLM")
+  parser.add_argument("--params", "-p", default = None,
+      help = "pyradiomics parameter file")
+  parser.add_argument("--workers", "-w", default = 1, type = int,
+      help = "Number of worker processes")
+  parser.add_argument("--shape-per-image", action = "store_true",
+      help = "Compute shape features for every image")
+  parser.add_argument("--resume", "-r", action = "store_true",
+      help = "Append to output and skip cases already in it")
+  parser.add_argument("--trace", default = None,
+      help = "JSON lines file to append stage timing records to")
+  parser.add_argument("--shard", default = None, type = parseShard,
+      help = "Only extract shard i of N (i/N)")
+  args = parser.parse_args()
+
+  enableTrace(args.trace, "extract_pyradiomics")
+
+  if args.output is None:
+    args.output = os.path.splitext(args.file)[0] + "_pyradiomicsout.csv"
+  args.output = shardPath(args.output, args.shard)
+  threads = max(1, multiprocessing.cpu_count() // max(1, args.workers))
+
+  # Paths in csv are relative to its directory
+  directory = os.path.dirname(args.file)
+  paths = pd.read_csv(args.file)
+  if args.type is not None:
+    paths = paths[paths["type"].isin(args.type)]
+  paths = selectShard(paths, args.shard, directory)
+
+  done = set()
+  errorFile = errorsPath(args.output)
+  if args.resume:
+    done = finishedCases(args.output, args.ids[0])
+    # Cases with errors are extracted again, without their earlier rows
+    retry = readCases(errorFile, args.ids[0]) & set(
+        paths[args.ids[0]].astype(str))
+    dropCases(args.output, args.ids[0], retry)
+    dropCases(errorFile, args.ids[0], retry)
+  elif os.path.isfile(errorFile):
+    os.remove(errorFile)
+
+  jobs = []
+  for i in range(len(paths.index)):
+    ids = dict((col, paths[col].iloc[i]) for col in args.ids)
+    if str(ids[args.ids[0]]) in done:
+      continue
+    jobs.append({"ids": ids, "directory": directory,
+        "images": [imagePath(paths[col].iloc[i], args.image_suffix)
+                   for col in imageColumns],
+        "masks": [(paths[pair[0]].iloc[i], pair[1]) for pair in maskLabels]})
+  print("Extracting {0} cases ({1} already done) with {2} worker(s)...".format(
+      len(jobs), len(done), args.workers))
+
+  if args.workers > 1:
+    pool = multiprocessing.Pool(args.workers, initializer = initWorker,
+        initargs = (args.params, threads, args.shape_per_image))
+    results = pool.imap_unordered(extractSubject, jobs)
+  else:
+    initWorker(args.params, threads, args.shape_per_image)
+    pool = None
+    results = map(extractSubject, jobs)
+
+  # Append rows of each finished case. The header comes from the existing
+  # output or from the first case without errors, rows of cases with errors
+  # that finish before it are held back until then
+  header = None
+  if args.resume and os.path.isfile(args.output):
+    with open(args.output, "r") as f:
+      header = next(csv.reader(f), None)
+  outFile = open(args.output, "a" if header else "w", newline = "")
+  writer = None
+  pending = []
+  failed = []
+  try:
+    for n, (job, rows, errors) in enumerate(results):
+      pending.extend(rows)
+      if header is None and rows and not errors:
+        header = outputHeader(args.ids, pending)
+      if header is not None and pending:
+        writer = writeRows(outFile, writer, header, pending)
+        pending = []
+      caseID = job["ids"][args.ids[0]]
+      for error in errors:
+        print("  Error: {0}".format(error))
+      if errors:
+        # Cases in the errors file are not finished for --resume
+        newFile = not os.path.isfile(errorFile)
+        with open(errorFile, "a", newline = "") as f:
+          errorWriter = csv.writer(f)
+          if newFile:
+            errorWriter.writerow([args.ids[0], "error"])
+          errorWriter.writerows([caseID, error] for error in errors)
+      failed.extend(errors)
+      print("  [{0}/{1}] {2}: {3} rows".format(n + 1, len(jobs), caseID,
+          len(rows)))
+    if pending:
+      writer = writeRows(outFile, writer,
+          header or outputHeader(args.ids, pending), pending)
+  except ValueError as e:
+    sys.exit("Error: {0}. Write to a new output file or remove {1}".format(
+        e, args.output))
+  finally:
+    outFile.close()
+
+  if pool is not None:
+    pool.close()
+    pool.join()
+
+  print("Features written to {0}, {1} extraction(s) failed".format(
+      args.output, len(failed)))
+  if failed:
+    print("Errors written to {0}".format(errorFile))
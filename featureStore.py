@@ -0,0 +1,138 @@
+#
+#  Columnar (Parquet/Feather) storage for pyradiomics output and filepath
+#  tables
+#
+#  Pyradiomics output repeats large constant strings (general_info_Version,
+#  general_info_GeneralSettings, ...) on every row and stores every feature
+#  as text. Written with writeTable, repeated strings are stored as
+#  categories (dictionary encoded in the file). float64 columns are only
+#  downcast to float32 when asked for (downcast = True), which the command
+#  line below does when converting a table; the scripts that write tables
+#  with writeTable keep full precision. readTable can load only the columns that are needed,
+#  e.g. pattern="_firstorder_", without reading the rest of the file.
+#
+#  The format is chosen from the file extension: .parquet, .feather or .csv.
+#  Parquet and Feather need pyarrow.
+#
+#  Usage:
+#    $ python featureStore.py pyradiomicsout.csv pyradiomicsout.parquet
+#
+#    Optional command line args
+#      --columns, -c [COL ..] Only export these columns
+#      --pattern, -p [REGEX]  Only export columns matching regex (ID columns
+#                               given with --columns are kept as well)
+#      --no-downcast          Keep float64 columns as float64 (they are
+#                               downcast to float32 by default here)
+#
+#  In python:
+#    from featureStore import readTable
+#    firstorder = readTable("pyradiomicsout.parquet", columns = ["BraTS18ID"],
+#        pattern = "_firstorder_")
+
+import argparse, os, re
+import pandas as pd
+
+columnarExtensions = [".parquet", ".feather"]
+
+# String columns with at most this fraction of unique values are stored as
+# categories
+categoryRatio = 0.5
+
+
+def isColumnar(path):
+  return os.path.splitext(path)[1] in columnarExtensions
+
+
+def compactTable(frame, downcast = False):
+  # Returns frame with repeated strings as categories, and float64 as float32
+  # if downcast is set
+  frame = frame.copy()
+  for col in frame.columns:
+    values = frame[col]
+    if downcast and values.dtype == "float64":
+      frame[col] = values.astype("float32")
+    elif values.dtype == "object" or pd.api.types.is_string_dtype(values):
+      if values.nunique(dropna = True) <= categoryRatio * max(len(values), 1):
+        frame[col] = values.astype("category")
+  return frame
+
+
+def writeTable(frame, path, downcast = False):
+  # Write frame to path, format from extension. downcast stores float64
+  # columns of .parquet/.feather files as float32
+  ext = os.path.splitext(path)[1]
+  if ext == ".parquet":
+    compactTable(frame, downcast).to_parquet(path, index = False)
+  elif ext == ".feather":
+    compactTable(frame, downcast).reset_index(drop = True).to_feather(path)
+  else:
+    frame.to_csv(path, index = False)
+
+
+def tableColumns(path):
+  # Column names without reading the data
+  ext = os.path.splitext(path)[1]
+  if ext in columnarExtensions:
+    import pyarrow.ipc, pyarrow.parquet
+    if ext == ".parquet":
+      return pyarrow.parquet.read_schema(path).names
+    return pyarrow.ipc.open_file(path).schema.names
+  return list(pd.read_csv(path, nrows = 0).columns)
+
+
+def selectColumns(names, columns = None, pattern = None):
+  # Columns in names that are in columns or match pattern, in file order.
+  # All columns if neither is given
+  if columns is None and pattern is None:
+    return list(names)
+  columns = set(columns or [])
+  regex = re.compile(pattern) if pattern is not None else None
+  return [name for name in names
+          if name in columns or (regex is not None and regex.search(name))]
+
+
+def readTable(path, columns = None, pattern = None, chunksize = None):
+  # Read only the selected columns of path. With chunksize returns an
+  # iterator of DataFrames
+  ext = os.path.splitext(path)[1]
+  selected = None
+  if columns is not None or pattern is not None:
+    selected = selectColumns(tableColumns(path), columns, pattern)
+  if ext == ".parquet":
+    if chunksize is not None:
+      import pyarrow.parquet
+      batches = pyarrow.parquet.ParquetFile(path).iter_batches(
+          batch_size = chunksize, columns = selected)
+      return (batch.to_pandas() for batch in batches)
+    return pd.read_parquet(path, columns = selected)
+  if ext == ".feather":
+    frame = pd.read_feather(path, columns = selected)
+    if chunksize is not None:
+      return (frame.iloc[i:i + chunksize]
+              for i in range(0, len(frame.index), chunksize))
+    return frame
+  usecols = None
+  if selected is not None:
+    keep = set(selected)
+    usecols = lambda col: col in keep
+  return pd.read_csv(path, usecols = usecols, chunksize = chunksize)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Convert tables between " +
+      "csv, parquet and feather")
+  parser.add_argument("input", help = "Table to read (.csv/.parquet/.feather)")
+  parser.add_argument("output", help = "Table to write (.csv/.parquet/.feather)")
+  parser.add_argument("--columns", "-c", nargs = "+", default = None,
+      help = "Only export these columns")
+  parser.add_argument("--pattern", "-p", default = None,
+      help = "Only export columns matching regex")
+  parser.add_argument("--no-downcast", dest = "downcast",
+      action = "store_false", help = "Keep float64 columns as float64")
+  args = parser.parse_args()
+
+  print("Reading {0}".format(args.input))
+  frame = readTable(args.input, args.columns, args.pattern)
+  writeTable(frame, args.output, args.downcast)
+  print("{0} rows x {1} columns written to {2}".format(
+      len(frame.index), len(frame.columns), args.output))
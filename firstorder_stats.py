@@ -0,0 +1,242 @@
+# Fast first-order statistics for every label of a label map
+#
+# For quick QC and baseline models. Instead of one pyradiomics run (one full
+# volume pass) per label, all labels of a label map are computed together:
+# voxels are grouped by label with one sort and bincount-style reductions.
+# Writes one row per case with the same column names as the short matrix
+# from pyradiomics_to_short.py, e.g. t1_nonenh_original_firstorder_Mean and
+# t1_nonenh_general_info_VoxelNum.
+#
+# Usage:
+#   $ python firstorder_stats.py -f BraTS18_filepaths.csv -o firstorder.csv
+#
+#   Optional command line args
+#      --output, -o [FILE]    Output file, .csv/.parquet/.feather
+#                               (default = CSVNAME_firstorder.csv)
+#      --ids [COL ..]         Columns copied to the output to identify cases
+#                               (default = BraTS18ID type)
+#      --type, -t [TYPE ..]   Only use these types (i.e. HGG, VAL, etc.)
+#      --image-suffix [SUF]   Inserted before .nii.gz in image paths, e.g.
+#                               _NLM for the NLM filtered images
+#      --bin-width [W]        Bin width for Entropy and Uniformity, as in
+#                               pyradiomics (default = 25)
+#      --workers, -w [N]      Number of worker processes (default = 1)
+#      --trace [FILE]         Append per subject/stage timing and resource
+#                               records to FILE, see stageTrace.py
+#      --shard [i/N]          Only process shard i (0 based) of N, balanced
+#                               by input file sizes. The output gets a
+#                               _shardIofN suffix, see shardCohort.py
+#
+# Images are set in extract_pyradiomics.imageColumns and label maps in
+# labelMaps. Label maps in optionalMaps (Atropos tissue labels, grade maps)
+# only exist for some cohorts and are skipped without an error where the
+# file is missing. Image/mask type names come from pyradiomics_to_short.py.
+
+import argparse, os
+import multiprocessing
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from extract_pyradiomics import imageColumns, imagePath
+from shardCohort import parseShard, selectShard, shardPath
+from stageTrace import enableTrace, stage
+from volumeCache import readImage
+from pyradiomics_to_short import imageTypes, maskTypes
+
+# List of list of length 2 where the first index is the label map column and
+# the second index is the list of labels to compute statistics for
+labelMaps = [["seg", [1, 2, 4]], ["atropos", [1, 2, 3]],
+             ["BE3_Grade", [1, 2, 3]]]
+
+# Label map columns that may be missing on disk
+optionalMaps = ["atropos", "BE3_Grade"]
+
+percentiles = [10, 25, 50, 75, 90]
+
+
+def labelStatistics(values, labels, wanted, voxelVolume, binWidth = 25):
+  # First-order statistics of values for each label in wanted. Returns dict
+  # of label -> dict of feature name -> value. Labels with no voxels are
+  # left out
+  keep = np.isin(labels, wanted)
+  lab = labels[keep].astype(np.intp)
+  val = values[keep].astype(np.float64)
+  size = int(max(wanted)) + 1
+
+  # Grouped sums
+  count = np.bincount(lab, minlength = size)
+  total = np.bincount(lab, weights = val, minlength = size)
+  energy = np.bincount(lab, weights = val * val, minlength = size)
+  with np.errstate(invalid = "ignore", divide = "ignore"):
+    mean = total / count
+    dev = val - mean[lab]
+    m2 = np.bincount(lab, weights = dev ** 2, minlength = size) / count
+    m3 = np.bincount(lab, weights = dev ** 3, minlength = size) / count
+    m4 = np.bincount(lab, weights = dev ** 4, minlength = size) / count
+    mad = np.bincount(lab, weights = np.abs(dev), minlength = size) / count
+
+  # One sort by (label, value) gives min, max and percentiles of each label
+  order = np.lexsort((val, lab))
+  sortedVal = val[order]
+  ends = np.cumsum(count)
+  starts = ends - count
+
+  # Discretized histogram for Entropy/Uniformity, bins aligned at multiples
+  # of binWidth from each label's minimum
+  stats = {}
+  for label in wanted:
+    n = count[label]
+    if n == 0:
+      continue
+    segment = sortedVal[starts[label]:ends[label]]
+    p10, p25, p50, p75, p90 = np.percentile(segment, percentiles)
+    robust = segment[(segment >= p10) & (segment <= p90)]
+    bins = np.floor(segment / binWidth) - np.floor(segment[0] / binWidth)
+    prob = np.bincount(bins.astype(np.intp)) / float(n)
+    prob = prob[prob > 0]
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+      stats[label] = {
+          "general_info_VoxelNum": int(n),
+          "original_firstorder_Mean": mean[label],
+          "original_firstorder_Variance": m2[label],
+          "original_firstorder_StandardDeviation": np.sqrt(m2[label]),
+          "original_firstorder_Skewness": m3[label] / m2[label] ** 1.5,
+          "original_firstorder_Kurtosis": m4[label] / m2[label] ** 2,
+          "original_firstorder_Minimum": segment[0],
+          "original_firstorder_Maximum": segment[-1],
+          "original_firstorder_Range": segment[-1] - segment[0],
+          "original_firstorder_10Percentile": p10,
+          "original_firstorder_Median": p50,
+          "original_firstorder_90Percentile": p90,
+          "original_firstorder_InterquartileRange": p75 - p25,
+          "original_firstorder_MeanAbsoluteDeviation": mad[label],
+          "original_firstorder_RobustMeanAbsoluteDeviation":
+              np.mean(np.abs(robust - robust.mean())),
+          "original_firstorder_Energy": energy[label],
+          "original_firstorder_TotalEnergy": energy[label] * voxelVolume,
+          "original_firstorder_RootMeanSquared": np.sqrt(energy[label] / n),
+          "original_firstorder_Entropy": -np.sum(prob * np.log2(prob)),
+          "original_firstorder_Uniformity": np.sum(prob * prob)}
+  return stats
+
+
+def subjectJob(paths, i, directory, ids, maps, imageSuffix = "",
+               binWidth = 25):
+  # Job for row i of paths. maps are the labelMaps pairs in paths
+  images = [imagePath(paths[col].iloc[i], imageSuffix) for col in imageColumns]
+  mapPaths = [(paths[pair[0]].iloc[i], pair[1]) for pair in maps
+              if isinstance(paths[pair[0]].iloc[i], str)]
+  optional = [paths[col].iloc[i] for col in optionalMaps if col in paths]
+  # Name image and mask types like the short matrix
+  masks = [mapRel for mapRel, labels in mapPaths for label in labels]
+  labels = [label for mapRel, labels in mapPaths for label in labels]
+  return {"ids": dict((col, paths[col].iloc[i]) for col in ids),
+          "directory": directory, "images": images,
+          "imagetypes": list(imageTypes(images, imageSuffix + ".nii.gz")),
+          "maps": mapPaths, "optional": optional, "binWidth": binWidth,
+          "masktypes": dict(zip(zip(masks, labels), maskTypes(masks, labels)))}
+
+
+def subjectStatistics(job):
+  # One output row for a subject. Each image and label map is read once
+  row = dict(job["ids"])
+  errors = []
+  maps = {}
+  subject = list(job["ids"].values())[0]
+  for mapRel, labels in job["maps"]:
+    path = os.path.join(job["directory"], mapRel)
+    if not os.path.isfile(path):
+      if mapRel not in job["optional"]:
+        errors.append("{0} not found".format(mapRel))
+      continue
+    with stage(subject, "read", image = mapRel):
+      maps[mapRel] = sitk.GetArrayFromImage(readImage(path))
+  for imageRel, imagetype in zip(job["images"], job["imagetypes"]):
+    path = os.path.join(job["directory"], imageRel)
+    if not os.path.isfile(path):
+      errors.append("{0} not found".format(imageRel))
+      continue
+    with stage(subject, "read", image = imageRel):
+      image = readImage(path)
+    values = sitk.GetArrayViewFromImage(image)
+    voxelVolume = float(np.prod(image.GetSpacing()))
+    for mapRel, labels in job["maps"]:
+      if mapRel not in maps:
+        continue
+      if maps[mapRel].shape != values.shape:
+        errors.append("{0} and {1} differ in size".format(imageRel, mapRel))
+        continue
+      with stage(subject, "statistics", image = imageRel, mask = mapRel):
+        stats = labelStatistics(values, maps[mapRel], labels, voxelVolume,
+            job["binWidth"])
+      for label, features in stats.items():
+        masktype = job["masktypes"][(mapRel, label)]
+        for name, value in features.items():
+          row[imagetype + "_" + masktype + "_" + name] = value
+  return row, errors
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "First-order statistics " +
+      "for every label of each label map")
+  parser.add_argument("--file", "-f", help = "CSV with filepaths",
+      required = True)
+  parser.add_argument("--output", "-o", default = None,
+      help = "Output file (.csv/.parquet/.feather)")
+  parser.add_argument("--ids", nargs = "+", default = ["BraTS18ID", "type"],
+      help = "Columns identifying cases")
+  parser.add_argument("--type", "-t", nargs = "+", default = None,
+      help = "Only use these types")
+  parser.add_argument("--image-suffix", default = "",
+      help = "Inserted before .nii.gz in image paths, e.g. _NLM")
+  parser.add_argument("--bin-width", default = 25, type = float,
+      help = "Bin width for Entropy and Uniformity")
+  parser.add_argument("--workers", "-w", default = 1, type = int,
+      help = "Number of worker processes")
+  parser.add_argument("--trace", default = None,
+      help = "JSON lines file to append stage timing records to")
+  parser.add_argument("--shard", default = None, type = parseShard,
+      help = "Only process shard i of N (i/N)")
+  args = parser.parse_args()
+
+  enableTrace(args.trace, "firstorder_stats")
+
+  if args.output is None:
+    args.output = os.path.splitext(args.file)[0] + "_firstorder.csv"
+  args.output = shardPath(args.output, args.shard)
+
+  # Paths in csv are relative to its directory
+  directory = os.path.dirname(args.file)
+  paths = pd.read_csv(args.file)
+  if args.type is not None:
+    paths = paths[paths["type"].isin(args.type)]
+  paths = selectShard(paths, args.shard, directory)
+  maps = [pair for pair in labelMaps if pair[0] in paths]
+
+  jobs = [subjectJob(paths, i, directory, args.ids, maps, args.image_suffix,
+                     args.bin_width) for i in range(len(paths.index))]
+  print("Computing statistics for {0} cases with {1} worker(s)...".format(
+      len(jobs), args.workers))
+
+  if args.workers > 1:
+    pool = multiprocessing.Pool(args.workers)
+    results = pool.imap(subjectStatistics, jobs)
+  else:
+    pool = None
+    results = map(subjectStatistics, jobs)
+
+  rows = []
+  for n, (row, errors) in enumerate(results):
+    for error in errors:
+      print("  Error: {0}".format(error))
+    rows.append(row)
+  if pool is not None:
+    pool.close()
+    pool.join()
+
+  from featureStore import writeTable
+  table = pd.DataFrame(rows)
+  table = table[args.ids + sorted(c for c in table.columns if c not in args.ids)]
+  writeTable(table, args.output)
+  print("{0} cases written to {1}".format(len(table.index), args.output))
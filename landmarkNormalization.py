@@ -0,0 +1,251 @@
+#
+#  Cohort-level histogram landmark normalization (Nyul & Udupa)
+#
+#  Two phases:
+#    learn  Streams over the cohort once. For each image the intensity
+#           percentiles inside its mask are found and mapped onto a standard
+#           scale. The mean of the mapped landmarks over the cohort is saved
+#           to a small json file, one set of landmarks per image column.
+#    apply  Maps each image's own landmarks onto the learned landmarks with a
+#           piecewise linear function. Subjects are processed in parallel.
+#  Landmarks learned on a training cohort can be reused for validation and
+#  test cohorts without recomputing them.
+#
+#  Usage:
+#    $ python landmarkNormalization.py learn -f csvwithfilepaths.csv
+#    $ python landmarkNormalization.py apply -f csvwithfilepaths.csv
+#
+#    Optional command line args
+#      --landmarks, -l [FILE] Landmark json file to write/read
+#                               (default = CSVNAME_landmarks.json)
+#      --columns, -c [COL ..] Image columns to normalize
+#                               (default = T1 T2 T1C FLAIR)
+#      --mask, -m [COL]       Column with mask statistics are computed in
+#                               (default = nontumor)
+#      --workers, -w [N]      Number of worker processes (default = 1)
+#      --trace [FILE]         Append per subject/stage timing and resource
+#                               records to FILE, see stageTrace.py
+#
+#  Normalized images are written next to their input with the suffix
+#  "_landmark.nii.gz", see landmarkOutputPath. Images whose mask is empty
+#  are skipped and reported in both phases.
+
+import argparse, json, os
+import multiprocessing
+import numpy as np
+import SimpleITK as sitk
+
+from stageTrace import enableTrace, stage
+from volumeCache import readImage
+
+landmarkImages = ["T1", "T2", "T1C", "FLAIR"]
+landmarkMask = "nontumor"
+
+# Percentiles used as landmarks. The first and last are the ends of the
+# intensity range of interest and are mapped to standardScale
+landmarkPercentiles = [1, 10, 20, 30, 40, 50, 60, 70, 80, 90, 99]
+standardScale = [1.0, 100.0]
+
+
+def landmarkOutputPath(imagePath):
+  # e.g. HGG/ID/ID_t1.nii.gz -> HGG/ID/ID_t1_landmark.nii.gz
+  if imagePath.endswith(".nii.gz"):
+    return imagePath[:-len(".nii.gz")] + "_landmark.nii.gz"
+  return os.path.splitext(imagePath)[0] + "_landmark" + \
+      os.path.splitext(imagePath)[1]
+
+
+def subjectID(imagePath):
+  # Subject ID from a TYPE/ID/ID_suffix.nii.gz path
+  return os.path.basename(os.path.dirname(imagePath))
+
+
+def readMasked(imagePath, maskPath):
+  # Returns image, float32 voxel array and boolean mask array
+  img = readImage(imagePath)
+  arr = sitk.GetArrayFromImage(img).astype(np.float32)
+  if maskPath is None:
+    mask = arr != 0
+  else:
+    mask = sitk.GetArrayFromImage(readImage(maskPath)) != 0
+  return img, arr, mask
+
+
+def maskedPercentiles(arr, mask, imagePath):
+  # Landmark percentiles of arr inside mask, None (reported) if the mask is
+  # empty
+  if not mask.any():
+    print("Skipping {0}, its mask is empty".format(imagePath))
+    return None
+  return np.percentile(arr[mask], landmarkPercentiles)
+
+
+def imageLandmarks(pair):
+  # Percentile landmarks of one image inside its mask, None if the mask is
+  # empty
+  imagePath, maskPath = pair
+  with stage(subjectID(imagePath), "landmarks_learn", image = imagePath):
+    img, arr, mask = readMasked(imagePath, maskPath)
+    return maskedPercentiles(arr, mask, imagePath)
+
+
+def scaleLandmarks(landmarks):
+  # Map landmarks linearly so the first/last land on standardScale
+  low, high = landmarks[0], landmarks[-1]
+  if high <= low:
+    return None
+  return standardScale[0] + (landmarks - low) * \
+      (standardScale[1] - standardScale[0]) / (high - low)
+
+
+def learnLandmarks(imagePaths, maskPaths, workers = 1):
+  # Mean standard-scale landmarks over all images. Only the running sum is
+  # kept so memory does not grow with the cohort size
+  total = np.zeros(len(landmarkPercentiles))
+  count = 0
+  pairs = list(zip(imagePaths, maskPaths))
+  pool = multiprocessing.Pool(workers) if workers > 1 else None
+  results = pool.imap(imageLandmarks, pairs) if pool else \
+      map(imageLandmarks, pairs)
+  for landmarks in results:
+    if landmarks is None:
+      continue
+    scaled = scaleLandmarks(landmarks)
+    if scaled is not None:
+      total += scaled
+      count += 1
+  if pool is not None:
+    pool.close()
+    pool.join()
+  if count == 0:
+    raise ValueError("No images with a valid intensity range to learn from")
+  if count < len(pairs):
+    print("Learned from {0} of {1} images".format(count, len(pairs)))
+  return total / count
+
+
+def mapIntensities(arr, source, target):
+  # Piecewise linear map from source to target landmarks, extrapolating
+  # linearly past the end landmarks
+  out = np.interp(arr, source, target).astype(np.float32)
+  low = arr < source[0]
+  high = arr > source[-1]
+  slopeLow = (target[1] - target[0]) / max(source[1] - source[0], 1e-6)
+  slopeHigh = (target[-1] - target[-2]) / max(source[-1] - source[-2], 1e-6)
+  out[low] = target[0] + (arr[low] - source[0]) * slopeLow
+  out[high] = target[-1] + (arr[high] - source[-1]) * slopeHigh
+  return out
+
+
+def applyImage(job):
+  # Normalize one image with the learned landmarks. Voxels outside the brain
+  # (image == 0) stay 0. Returns the written path, None if the mask is empty
+  imagePath, maskPath, outPath, target = job
+  with stage(subjectID(imagePath), "landmarks_read", image = imagePath):
+    img, arr, mask = readMasked(imagePath, maskPath)
+  source = maskedPercentiles(arr, mask, imagePath)
+  if source is None:
+    return None
+  with stage(subjectID(imagePath), "landmarks_map", image = imagePath):
+    # np.interp needs strictly increasing landmarks
+    source = source + np.arange(len(source)) * 1e-6
+    out = np.where(arr != 0, mapIntensities(arr, source, np.asarray(target)), 0)
+    outImg = sitk.GetImageFromArray(out.astype(np.float32))
+    outImg.CopyInformation(img)
+  with stage(subjectID(imagePath), "landmarks_write", image = imagePath):
+    sitk.WriteImage(outImg, outPath)
+  return outPath
+
+
+def applyLandmarks(imagePaths, maskPaths, outPaths, landmarks, workers = 1):
+  # Normalize all images to landmarks, returns list of written files (None
+  # for skipped images)
+  jobs = [(img, mask, out, list(landmarks)) for img, mask, out in
+          zip(imagePaths, maskPaths, outPaths)]
+  if workers > 1:
+    pool = multiprocessing.Pool(workers)
+    written = pool.map(applyImage, jobs)
+    pool.close()
+    pool.join()
+  else:
+    written = [applyImage(job) for job in jobs]
+  return written
+
+
+def saveLandmarks(path, landmarks):
+  # landmarks is a dict of column name -> standard landmarks
+  with open(path, "w") as f:
+    json.dump({"percentiles": landmarkPercentiles,
+               "standardScale": standardScale,
+               "landmarks": dict((col, list(map(float, values)))
+                                 for col, values in landmarks.items())},
+              f, indent = 1)
+
+
+def loadLandmarks(path):
+  with open(path, "r") as f:
+    data = json.load(f)
+  if data["percentiles"] != landmarkPercentiles:
+    raise ValueError("Landmarks in {0} were learned with percentiles {1}"
+        .format(path, data["percentiles"]))
+  return dict((col, np.asarray(values))
+              for col, values in data["landmarks"].items())
+
+
+def defaultLandmarksPath(csvPath):
+  return os.path.splitext(csvPath)[0] + "_landmarks.json"
+
+
+if __name__ == "__main__":
+  import pandas as pd
+
+  # Get params from cmd line
+  parser = argparse.ArgumentParser(description = "Learn and apply " +
+      "histogram landmark normalization for a cohort")
+  parser.add_argument("phase", choices = ["learn", "apply"],
+      help = "learn landmarks or apply them")
+  parser.add_argument("--file", "-f", help = "CSV with filepaths",
+      required = True)
+  parser.add_argument("--landmarks", "-l", default = None,
+      help = "Landmark json file to write (learn) or read (apply)")
+  parser.add_argument("--columns", "-c", nargs = "+",
+      default = landmarkImages, help = "Image columns to normalize")
+  parser.add_argument("--mask", "-m", default = landmarkMask,
+      help = "Column with masks to compute statistics in")
+  parser.add_argument("--workers", "-w", default = 1, type = int,
+      help = "Number of worker processes")
+  parser.add_argument("--trace", default = None,
+      help = "JSON lines file to append stage timing records to")
+  args = parser.parse_args()
+
+  enableTrace(args.trace, "landmarkNormalization")
+
+  if args.landmarks is None:
+    args.landmarks = defaultLandmarksPath(args.file)
+
+  # Paths in csv are relative to its directory
+  directory = os.path.dirname(args.file)
+  paths = pd.read_csv(args.file)
+  maskPaths = [os.path.join(directory, p) for p in paths[args.mask]]
+
+  if args.phase == "learn":
+    landmarks = {}
+    for col in args.columns:
+      print("Learning landmarks for {0}...".format(col))
+      imagePaths = [os.path.join(directory, p) for p in paths[col]]
+      landmarks[col] = learnLandmarks(imagePaths, maskPaths, args.workers)
+    saveLandmarks(args.landmarks, landmarks)
+    print("Landmarks written to {0}".format(args.landmarks))
+  else:
+    landmarks = loadLandmarks(args.landmarks)
+    for col in args.columns:
+      print("Normalizing {0}...".format(col))
+      imagePaths = [os.path.join(directory, p) for p in paths[col]]
+      outPaths = [landmarkOutputPath(p) for p in imagePaths]
+      written = applyLandmarks(imagePaths, maskPaths, outPaths,
+          landmarks[col], args.workers)
+      skipped = sum(path is None for path in written)
+      if skipped:
+        print("Skipped {0} {1} images with an empty mask".format(skipped,
+            col))
+    print("Landmark normalization complete")
@@ -0,0 +1,200 @@
+# Reshapes pyradiomics output (one row per Image, Mask, Label) into a short
+# matrix with one row per case and one column per image/mask type + feature
+#
+# Python version of pyradiomics_to_short.R with the same command line. Mask
+# and label types are classified once per unique (Mask, Label) pair and each
+# image/mask type is pivoted straight into its block of wide columns, so the
+# long (rows x features) frame is never built. With --chunksize the input is
+# read in chunks of rows.
+#
+# Usage:
+#   $ python pyradiomics_to_short.py pyradiomicsout.csv pyradiomicsout_SHORT.csv suffix ID1 ID2 ID3 ...
+#
+#  Command line args
+#     pyradiomicsout.csv       Name of csv file pyradiomics output (Image,
+#                                Mask, label) and other feature columns
+#     pyradiomicsout_SHORT.csv Name of output shortened matrix
+#     suffix                   Image type is assumed to be everything between
+#                                 the last _ and suffix
+#                                   (default: .nii.gz)
+#     ID[X]                    Strings with column names that identify
+#                                unique cases (ex: MRN, age)
+#                                  (default: use each image as one case)
+#     --chunksize [N]          Read input in chunks of N rows
+#                                  (default: read whole file)
+#     --all-shapes             Keep shape features of every image type
+#                                  (default: shape features are only written
+#                                  once per mask type as mask_MASKTYPE_...)
+#
+# Input and output can also be .parquet or .feather files (see
+# featureStore.py). Only the ID, Image, Mask, Label and feature columns are
+# read.
+#
+# Command line:
+# python pyradiomics_to_short.py BraTS18_validation_pyradiomicsout.csv testSHORT.csv _NLM.nii.gz BraTS18ID Age ResectionStatus type
+
+import argparse, re, sys
+import pandas as pd
+from featureStore import isColumnar, readTable, tableColumns, writeTable
+
+# Pyradiomics features
+featurePattern = re.compile(
+    "(general_info_VoxelNum|_firstorder_|_shape_|_glcm_|_glrlm_|_ngtdm_|_glszm_|_gldm_)")
+
+# Shape features are computed from the mask only. They are written once per
+# mask type with this prefix instead of once per image type
+shapePattern = re.compile("_shape(2D)?_")
+shapePrefix = "mask"
+
+# Rules to name mask/label types, applied in order so later rules win
+#   [MASKPATTERN, LABEL, MASKTYPE]
+# Rows whose Mask contains MASKPATTERN and whose Label equals LABEL (any
+# label if None) get MASKTYPE. Rows matching no rule are "mask".
+# This is mosty specific for BraTS data
+# replace 'nonenh', 'edema' etc with project specific names or just "Label1"
+maskTypeRules = [
+    ["tumor", None, "tumor"],
+    ["atropos", 1, "atropos_csf"], ["atropos", 2, "atropos_gm"],
+    ["atropos", 3, "atropos_wm"],
+    ["tissue", 1, "tissue_csf"], ["tissue", 2, "tissue_gm"],
+    ["tissue", 3, "tissue_wm"],
+    ["seg", 1, "nonenh"], ["seg", 2, "edema"], ["seg", 4, "enhanc"],
+    ["Grade", 1, "normal"], ["Grade", 2, "lower"], ["Grade", 3, "higher"]
+  ]
+
+
+def featureColumns(columns):
+  return [col for col in columns if featurePattern.search(col)]
+
+
+def imageTypes(images, suffix):
+  # get repeat image types by removing suffix (like _NLM.nii.gz) and
+  # beginning stuff. Done once per unique image
+  images = pd.Series(images)
+  unique = pd.Series(images.unique())
+  types = unique.astype(str).str.replace(suffix, "", n = 1, regex = True) \
+      .str.replace(".*_", "", regex = True)
+  return images.map(dict(zip(unique, types))).values
+
+
+def maskTypes(masks, labels):
+  # Classify each row's mask type with maskTypeRules. Rules are evaluated on
+  # the unique (Mask, Label) pairs and mapped back to the rows
+  pairs = pd.DataFrame({"Mask": masks, "Label": labels})
+  unique = pairs.drop_duplicates()
+  types = pd.Series("mask", index = unique.index)
+  uniqueMasks = unique["Mask"].astype(str)
+  for pattern, label, masktype in maskTypeRules:
+    match = uniqueMasks.str.contains(pattern, regex = True)
+    if label is not None:
+      match &= unique["Label"] == label
+    types[match.values] = masktype
+  unique = unique.assign(masktype = types.values)
+  return pairs.merge(unique, on = ["Mask", "Label"], how = "left")["masktype"].values
+
+
+def fullTypes(frame, suffix):
+  # get unique regions by combining image and mask type. Returns
+  # (imagetype, masktype, fulltype)
+  imagetype = pd.Series(imageTypes(frame["Image"], suffix), index = frame.index)
+  masktype = maskTypes(frame["Mask"].values, frame["Label"].values)
+  return imagetype, masktype, imagetype + "_" + masktype
+
+
+def wideBlocks(frame, IDs, suffix, feats, allShapes = False):
+  # Yields (fulltype, block) where block has one row per case (IDs index)
+  # and the features of that image/mask type as "fulltype_feature" columns.
+  # Shape features only depend on the mask and label, so unless allShapes
+  # is set they are taken once per mask type and named "mask_masktype_..."
+  imagetype, masktype, fulltype = fullTypes(frame, suffix)
+  if allShapes:
+    shapeFeats = []
+  else:
+    shapeFeats = [col for col in feats if shapePattern.search(col)]
+  otherFeats = [col for col in feats if col not in shapeFeats]
+
+  if shapeFeats:
+    for name, rows in frame.groupby(masktype, sort = False):
+      block = rows.groupby(IDs, dropna = False, sort = False)[shapeFeats].first()
+      block.columns = [shapePrefix + "_" + name + "_" + col for col in shapeFeats]
+      yield shapePrefix + "_" + name, block
+
+  # Rows from extract_pyradiomics.py with Image == shapePrefix only hold
+  # shape features
+  intensity = (imagetype != shapePrefix).values
+  fulltype = fulltype[intensity].astype("category")
+  for name, rows in frame[intensity].groupby(fulltype.values, observed = True, sort = False):
+    block = rows.set_index(IDs)[otherFeats]
+    block.columns = [name + "_" + col for col in otherFeats]
+    yield name, block
+
+
+def reshapeToShort(frames, IDs, suffix = ".nii.gz", allShapes = False):
+  # frames is a DataFrame or iterable of DataFrame chunks of pyradiomics
+  # output. Returns the short matrix
+  if isinstance(frames, pd.DataFrame):
+    frames = [frames]
+  blocks = {}
+  for frame in frames:
+    feats = featureColumns(frame.columns)
+    for name, block in wideBlocks(frame, IDs, suffix, feats, allShapes):
+      blocks.setdefault(name, []).append(block)
+
+  columns = []
+  for name in blocks:
+    block = pd.concat(blocks[name]) if len(blocks[name]) > 1 else blocks[name][0]
+    # The shape rows of a case can be split across chunks, merge them like
+    # the rows within a chunk
+    if len(blocks[name]) > 1 and name.startswith(shapePrefix + "_"):
+      block = block.groupby(level = list(range(block.index.nlevels)),
+                            dropna = False, sort = False).first()
+    if block.index.has_duplicates:
+      print("Warning: {0} has more than one row per case, keeping first"
+          .format(name))
+      block = block[~block.index.duplicated()]
+    columns.append(block)
+
+  shortMatrix = pd.concat(columns, axis = 1, sort = True)
+  # Copy to consolidate the blocks into one before adding the ID columns
+  shortMatrix = shortMatrix[sorted(shortMatrix.columns)].copy()
+  return shortMatrix.reset_index()
+
+
+def readRadiomics(csvName, IDs, chunksize = None):
+  # Read only ID, type and feature columns. Returns DataFrame or iterator of
+  # chunks if chunksize is given
+  header = tableColumns(csvName)
+  missing = [col for col in IDs if col not in header]
+  if missing:
+    print("One or more ID variables is not a column name")
+    print(missing)
+    sys.exit("Remove that column name from your command")
+  keep = set(IDs) | set(["Image", "Mask", "Label"]) | set(featureColumns(header))
+  return readTable(csvName, columns = [col for col in header if col in keep],
+                   chunksize = chunksize)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Reshape pyradiomics " +
+      "output into a short matrix with one row per case")
+  parser.add_argument("csvName", help = "pyradiomics output csv")
+  parser.add_argument("outcsvName", help = "short matrix csv to write")
+  parser.add_argument("suffix", nargs = "?", default = ".nii.gz",
+      help = "Image suffix after the image type")
+  parser.add_argument("IDs", nargs = "*", default = ["Image"],
+      help = "Columns that identify unique cases")
+  parser.add_argument("--all-shapes", action = "store_true",
+      help = "Keep shape features of every image type")
+  parser.add_argument("--chunksize", default = None, type = int,
+      help = "Read input in chunks of this many rows")
+  args = parser.parse_args()
+  print("args:")
+  print(args)
+  print("=========================================")
+
+  frames = readRadiomics(args.csvName, args.IDs, args.chunksize)
+  shortMatrix = reshapeToShort(frames, args.IDs, args.suffix, args.all_shapes)
+  if isColumnar(args.outcsvName):
+    writeTable(shortMatrix, args.outcsvName)
+  else:
+    shortMatrix.to_csv(args.outcsvName, index = False, na_rep = "NA")
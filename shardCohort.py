@@ -0,0 +1,180 @@
+#
+#  Splits a filepath csv into balanced shards for cluster array jobs
+#
+#  deepmedicPreprocess.py, apply_normalization.py, extract_pyradiomics.py and
+#  firstorder_stats.py take --shard i/N and only process shard i (0 based)
+#  of N. Shards are balanced by cost, the total size of each subject's input
+#  images, not by row count: subjects are assigned largest first to the
+#  shard with the smallest total so far. Only input files the scripts never
+#  write are used, so every shard of a run computes the same assignment.
+#  Outputs of a shard that would be shared (e.g. the feature csv, crop file
+#  or build manifest) get a _shardIofN suffix, e.g. features_shard0of8.csv,
+#  and are combined with merge.
+#
+#  Usage:
+#    $ python shardCohort.py plan -f paths.csv -n 8
+#    $ python shardCohort.py merge -o features.csv features_shard*of8.csv
+#    $ python shardCohort.py run -n 4 --outputs out.csv --merge all.csv -- \
+#          python extract_pyradiomics.py -f paths.csv -o out.csv
+#
+#    plan    Print the subjects and cost of each shard
+#    merge   Concatenate shard outputs (.csv/.parquet/.feather) into one
+#              table. Columns missing in a shard are left empty
+#              --sort [COL ..]   Sort the merged rows by these columns
+#    run     Run a command once per shard as separate local processes, with
+#              --shard i/N appended. --merge [FILE] merges the shard
+#              outputs of the --outputs [FILE] given to the command
+
+import argparse, heapq, os, subprocess, sys
+import pandas as pd
+
+from featureStore import readTable, writeTable
+
+# Input image columns whose file sizes estimate the cost of a subject
+costColumns = ["T1", "T2", "T1C", "FLAIR", "seg"]
+
+
+def parseShard(text):
+  # "i/N" -> (i, N)
+  try:
+    index, count = [int(part) for part in text.split("/")]
+  except ValueError:
+    raise argparse.ArgumentTypeError("shard must be i/N, e.g. 0/8")
+  if count < 1 or not 0 <= index < count:
+    raise argparse.ArgumentTypeError("shard index must be in [0, N)")
+  return index, count
+
+
+def shardPath(path, shard):
+  # e.g. out.csv -> out_shard0of8.csv, unchanged without a shard
+  if shard is None:
+    return path
+  base, ext = os.path.splitext(path)
+  return "{0}_shard{1}of{2}{3}".format(base, shard[0], shard[1], ext)
+
+
+def rowCosts(paths, directory = "", columns = costColumns):
+  # Total size in bytes of each row's files, missing files count 0. Rows
+  # without any file cost 1 so they are still spread over the shards.
+  # paths is a DataFrame or dict of column -> list of paths
+  costs = []
+  columns = [col for col in columns if col in paths]
+  for values in zip(*[paths[col] for col in columns]):
+    total = 0
+    for value in values:
+      if isinstance(value, str) and value:
+        try:
+          total += os.path.getsize(os.path.join(directory, value))
+        except OSError:
+          pass
+    costs.append(max(total, 1))
+  return costs
+
+
+def assignShards(costs, count):
+  # Shard of each row: largest cost first to the least loaded shard. Ties
+  # go to the earlier row and the lower shard so the result is stable
+  order = sorted(range(len(costs)), key = lambda i: (-costs[i], i))
+  loads = [(0, shard) for shard in range(count)]
+  shards = [0] * len(costs)
+  for i in order:
+    load, shard = heapq.heappop(loads)
+    shards[i] = shard
+    heapq.heappush(loads, (load + costs[i], shard))
+  return shards
+
+
+def selectShard(paths, shard, directory = ""):
+  # Rows of paths (a DataFrame) in shard (i, N), in their original order
+  if shard is None:
+    return paths
+  shards = assignShards(rowCosts(paths, directory), shard[1])
+  return paths[[s == shard[0] for s in shards]]
+
+
+def shardRows(rows, shard, directory = ""):
+  # Same as selectShard for a list of dicts (e.g. from csv.DictReader)
+  if shard is None:
+    return rows
+  columns = dict((col, [row.get(col) for row in rows]) for col in costColumns)
+  shards = assignShards(rowCosts(columns, directory), shard[1])
+  return [row for row, s in zip(rows, shards) if s == shard[0]]
+
+
+def mergeShards(inputs, output, sort = None):
+  # Concatenate shard tables into output, returns the merged table
+  frames = [readTable(path) for path in inputs]
+  merged = pd.concat(frames, ignore_index = True, sort = False)
+  if sort:
+    merged = merged.sort_values(sort, kind = "stable").reset_index(drop = True)
+  writeTable(merged, output)
+  return merged
+
+
+def runShards(command, count):
+  # Start one process per shard and wait for all. Returns exit codes
+  procs = []
+  for i in range(count):
+    procs.append(subprocess.Popen(command + ["--shard", "{0}/{1}".format(i,
+        count)]))
+  return [proc.wait() for proc in procs]
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Plan, run and merge " +
+      "cohort shards")
+  parser.add_argument("command", choices = ["plan", "merge", "run"])
+  parser.add_argument("inputs", nargs = "*",
+      help = "Shard outputs to merge (merge)")
+  parser.add_argument("--file", "-f", default = None,
+      help = "CSV with filepaths (plan)")
+  parser.add_argument("--shards", "-n", default = None, type = int,
+      help = "Number of shards (plan, run)")
+  parser.add_argument("--output", "-o", default = None,
+      help = "Merged output file (merge)")
+  parser.add_argument("--outputs", default = None,
+      help = "Output file given to the command (run)")
+  parser.add_argument("--merge", default = None,
+      help = "Merge shard outputs of the command into this file (run)")
+  parser.add_argument("--sort", nargs = "+", default = None,
+      help = "Sort merged rows by these columns (merge, run)")
+  # Everything after -- is the command to run
+  argv = sys.argv[1:]
+  command = []
+  if "--" in argv:
+    command = argv[argv.index("--") + 1:]
+    argv = argv[:argv.index("--")]
+  args = parser.parse_args(argv)
+
+  if args.command == "plan":
+    if args.file is None or args.shards is None:
+      parser.error("plan needs --file and --shards")
+    paths = pd.read_csv(args.file)
+    costs = rowCosts(paths, os.path.dirname(args.file))
+    shards = pd.Series(assignShards(costs, args.shards), name = "shard")
+    plan = pd.DataFrame({"subjects": shards.value_counts(),
+        "cost_mb": pd.Series(costs).groupby(shards).sum() / 2.0 ** 20})
+    print(plan.sort_index().round(1).to_string())
+
+  elif args.command == "merge":
+    if args.output is None or not args.inputs:
+      parser.error("merge needs --output and shard outputs")
+    merged = mergeShards(args.inputs, args.output, args.sort)
+    print("{0} rows from {1} shards written to {2}".format(
+        len(merged.index), len(args.inputs), args.output))
+
+  else:
+    if args.shards is None or not command:
+      parser.error("run needs --shards and a command after --")
+    codes = runShards(command, args.shards)
+    failed = [i for i, code in enumerate(codes) if code != 0]
+    if failed:
+      sys.exit("Shards {0} failed".format(failed))
+    if args.merge is not None:
+      if args.outputs is None:
+        parser.error("--merge needs --outputs")
+      inputs = [shardPath(args.outputs, (i, args.shards))
+                for i in range(args.shards)]
+      merged = mergeShards(inputs, args.merge, args.sort)
+      print("{0} rows from {1} shards written to {2}".format(
+          len(merged.index), args.shards, args.merge))
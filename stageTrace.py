@@ -0,0 +1,196 @@
+#
+#  Per-subject, per-stage timing and resource records
+#
+#  Scripts wrap each step of a subject in a stage:
+#    with stageTrace.stage(subjectID, "read", channel = "T1"):
+#      img = sitk.ReadImage(path)
+#  When tracing is enabled (--trace FILE in the scripts) every stage appends
+#  one JSON line to FILE:
+#    script, subject, stage, extra fields, pid,
+#    start     unix time the stage started
+#    wall      wall time (s)
+#    cpu       cpu time of the process (s, user + system)
+#    read      bytes read by the process during the stage
+#    written   bytes written by the process during the stage
+#    process_peak_rss
+#              peak resident memory of the process since it started (MB),
+#              so it includes earlier stages and subjects of a worker
+#    peak_rss_delta
+#              how much the stage raised that peak (MB), 0 if it stayed
+#              below the peak of earlier stages
+#    error     exception type if the stage failed
+#  Stages that run an external command (stage(..., external = True), see
+#  commandScheduler.py) leave out the counters of this process, which do
+#  not include the command. cpu and process_peak_rss are then the command's
+#  own usage from os.wait4 if given with childUsage, read/written are left
+#  out.
+#  read/written come from /proc/self/io (rchar/wchar), so they include page
+#  cache hits, and are left out where that is not available. Counters are
+#  per process: stages running in threads of one process share them.
+#  Tracing is enabled through the STAGE_TRACE environment variable, so
+#  worker processes inherit it. Without it stages cost nothing but a check.
+#
+#  Usage:
+#    $ python deepmedicPreprocess.py -f paths.csv -w 8 --trace trace.jsonl
+#    $ python stageTrace.py trace.jsonl
+#
+#    Optional command line args
+#      --by [COL ..]          Columns to group by (default = script stage)
+#      --top [N]              Also list the N slowest subjects (default = 10)
+#      --output, -o [FILE]    Also write the hotspot table to a csv file
+
+import argparse, json, os, resource, time
+
+traceVariable = "STAGE_TRACE"
+scriptVariable = "STAGE_TRACE_SCRIPT"
+
+
+def enableTrace(path, script):
+  # Trace stages of this process and of worker processes started after this
+  if path is None:
+    return
+  os.environ[traceVariable] = os.path.abspath(path)
+  os.environ[scriptVariable] = script
+
+
+def ioCounters():
+  # (bytes read, bytes written) of this process, or None
+  try:
+    with open("/proc/self/io", "r") as f:
+      counters = dict(line.split(":") for line in f)
+    return int(counters["rchar"]), int(counters["wchar"])
+  except (OSError, KeyError, ValueError):
+    return None
+
+
+def peakRSS():
+  # Peak resident memory of this process in MB (ru_maxrss is KB on Linux)
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class StageTimer:
+
+  def __init__(self, subject, name, fields, external = False):
+    self.path = os.environ.get(traceVariable)
+    self.external = external
+    self.record = {"script": os.environ.get(scriptVariable), "subject":
+        None if subject is None else str(subject), "stage": name}
+    self.record.update(fields)
+
+  def __enter__(self):
+    if self.path is not None:
+      self.io = ioCounters()
+      self.peak = peakRSS()
+      self.start = time.time()
+      self.wall = time.perf_counter()
+      self.cpu = time.process_time()
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    if self.path is None:
+      return False
+    record = self.record
+    record["pid"] = os.getpid()
+    record["start"] = round(self.start, 3)
+    record["wall"] = time.perf_counter() - self.wall
+    if not self.external:
+      record["cpu"] = time.process_time() - self.cpu
+      io = ioCounters()
+      if io is not None and self.io is not None:
+        record["read"] = io[0] - self.io[0]
+        record["written"] = io[1] - self.io[1]
+      peak = peakRSS()
+      record["process_peak_rss"] = round(peak, 1)
+      record["peak_rss_delta"] = round(peak - self.peak, 1)
+    if excType is not None:
+      record["error"] = excType.__name__
+    # One write per record in append mode so records of processes writing
+    # the same file do not interleave
+    fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+      os.write(fd, (json.dumps(record) + "\n").encode())
+    finally:
+      os.close(fd)
+    return False
+
+
+  def childUsage(self, usage):
+    # Record the cpu time and peak memory of an external command from its
+    # resource usage (os.wait4). The peak includes the memory of this
+    # process at the fork, which only matters for very small commands
+    self.record["cpu"] = usage.ru_utime + usage.ru_stime
+    self.record["process_peak_rss"] = round(usage.ru_maxrss / 1024.0, 1)
+
+
+def stage(subject, name, external = False, **fields):
+  # Context manager timing one stage of one subject. external is set for
+  # stages that run an external command
+  return StageTimer(subject, name, fields, external)
+
+
+def readTrace(path):
+  import pandas as pd
+  return pd.read_json(path, lines = True)
+
+
+def total(values):
+  # Sum that stays NaN for groups without any value, e.g. the read/written
+  # bytes of external command stages
+  return values.sum(min_count = 1)
+
+
+def hotspots(trace, by = None):
+  # Totals per group (default = script and stage), sorted by total wall time
+  if by is None:
+    by = ["script", "stage"]
+  trace = trace.copy()
+  # Traces written before the peak was split into process/delta
+  if "peak_rss" in trace and "process_peak_rss" not in trace:
+    trace["process_peak_rss"] = trace["peak_rss"]
+  for col in ["read", "written", "process_peak_rss", "peak_rss_delta"]:
+    if col not in trace:
+      trace[col] = float("nan")
+  trace["read"] = trace["read"] / 2.0 ** 20
+  trace["written"] = trace["written"] / 2.0 ** 20
+  grouped = trace.groupby(by, dropna = False)
+  table = grouped.agg(count = ("wall", "size"), wall = ("wall", "sum"),
+      wall_mean = ("wall", "mean"), wall_max = ("wall", "max"),
+      cpu = ("cpu", "sum"), read_mb = ("read", total),
+      written_mb = ("written", total),
+      process_peak_rss_mb = ("process_peak_rss", "max"),
+      peak_rss_delta_mb = ("peak_rss_delta", "max"))
+  table["wall_share"] = 100.0 * table["wall"] / table["wall"].sum()
+  table["cpu_per_wall"] = table["cpu"] / table["wall"]
+  if "error" in trace:
+    table["errors"] = grouped["error"].count()
+  return table.sort_values("wall", ascending = False).reset_index()
+
+
+if __name__ == "__main__":
+  import pandas as pd
+
+  parser = argparse.ArgumentParser(description = "Summarize stage trace " +
+      "records into a hotspot table")
+  parser.add_argument("trace", help = "JSON lines trace file")
+  parser.add_argument("--by", nargs = "+", default = ["script", "stage"],
+      help = "Columns to group by")
+  parser.add_argument("--top", default = 10, type = int,
+      help = "Number of slowest subjects to list")
+  parser.add_argument("--output", "-o", default = None,
+      help = "CSV file to write the hotspot table to")
+  args = parser.parse_args()
+
+  trace = readTrace(args.trace)
+  print("{0} records, {1} subjects, {2:.1f}s wall".format(len(trace.index),
+      trace["subject"].nunique(), trace["wall"].sum()))
+  table = hotspots(trace, args.by)
+  with pd.option_context("display.width", 200, "display.max_columns", None):
+    print(table.round(3).to_string(index = False))
+    if args.top > 0:
+      subjects = trace.groupby("subject")["wall"].sum()
+      print("\nSlowest subjects:")
+      print(subjects.sort_values(ascending = False).head(args.top).round(3)
+            .to_string())
+  if args.output is not None:
+    table.to_csv(args.output, index = False)
+    print("Hotspots written to {0}".format(args.output))
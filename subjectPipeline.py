@@ -0,0 +1,220 @@
+#
+#  Runs several pipeline stages for one subject at a time
+#
+#  Running apply_normalization.py, deepmedicPreprocess.py, landmark
+#  normalization and firstorder_stats.py one after another decodes each
+#  subject's T1, seg and masks once per script. This driver runs the stages
+#  back to back for each subject in the same worker process, reading
+#  through the volume cache (volumeCache.py), so every input is decoded at
+#  most once and masks written by one stage are reused by the next.
+#
+#  Stages, in order:
+#    masks       mask, tumor and nontumor masks (as apply_normalization.py)
+#    preprocess  dm_* z-score images and roi mask (as deepmedicPreprocess.py)
+#    landmarks   landmark normalized images, needs a landmark file
+#                  (landmarkNormalization.py learn)
+#    firstorder  first-order statistics table (as firstorder_stats.py)
+#  Mask and landmark outputs are tracked in the build manifest like
+#  apply_normalization.py does.
+#
+#  Usage:
+#    $ python subjectPipeline.py -f csvwithfilepaths.csv -w 8
+#
+#    Optional command line args
+#      --stages [STAGE ..]    Stages to run (default = all, landmarks only if
+#                               the landmark file exists)
+#      --landmarks, -l [FILE] Landmark json file
+#                               (default = CSVNAME_landmarks.json)
+#      --manifest, -m [FILE]  Build manifest (default = CSVNAME_manifest.json)
+#      --output, -o [FILE]    First-order statistics table
+#                               (default = CSVNAME_firstorder.csv)
+#      --id, -i [ID]          Name of column with IDs (default = BraTS18ID)
+#      --cache-mb [MB]        Memory for decoded volumes in total. Each
+#                               worker has its own cache of MB / workers, so
+#                               volumes are not shared between workers
+#                               (default = 2048)
+#      --spill [DIR]          Also keep decoded volumes as .npy files in DIR
+#                               for later runs
+#      --workers, -w [N]      Number of worker processes (default = 1)
+#      --trace [FILE]         Append per subject/stage timing and resource
+#                               records to FILE, see stageTrace.py
+
+import argparse, os, sys
+import multiprocessing
+import pandas as pd
+import SimpleITK as sitk
+
+from apply_normalization import deriveMasks, landmarkParams
+from buildManifest import BuildManifest, manifestPath
+import deepmedicPreprocess as dp
+import firstorder_stats as fs
+import landmarkNormalization as ln
+from stageTrace import enableTrace, stage
+from volumeCache import cacheStats, enableCache
+
+stages = ["masks", "preprocess", "landmarks", "firstorder"]
+
+manifest = None
+
+
+def initWorker(manifestFile, threads):
+  # Each worker checks staleness against its own copy of the manifest, the
+  # parent merges the entries it returns
+  global manifest
+  manifest = BuildManifest(manifestFile)
+  sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(threads)
+
+
+def runSubject(job):
+  # Run the stages of one subject. Returns dict with manifest entries,
+  # statistics row, errors and cache statistics
+  path = lambda col: os.path.join(job["directory"], job["row"][col])
+  sid = job["id"]
+  result = {"job": job, "outputs": {}, "statistics": None, "errors": []}
+  tracked = []
+  try:
+    if "masks" in job["stages"]:
+      with stage(sid, "masks"):
+        deriveMasks(path("T1"), path("seg"), path("mask"), path("tumor"),
+                    path("nontumor"), manifest)
+      tracked += [path("mask"), path("tumor"), path("nontumor")]
+
+    if "preprocess" in job["stages"]:
+      for imageJob in job["preprocess"]:
+        dp.preprocessImage(imageJob)
+
+    if "landmarks" in job["stages"]:
+      maskPath = path(ln.landmarkMask)
+      for col in ln.landmarkImages:
+        outPath = ln.landmarkOutputPath(path(col))
+        inputs = [path(col), maskPath, job["landmarksFile"]]
+        if manifest.isStale(outPath, inputs, landmarkParams):
+          if ln.applyImage((path(col), maskPath, outPath,
+                            job["landmarks"][col])) is None:
+            result["errors"].append("{0} not normalized, empty {1}".format(
+                col, ln.landmarkMask))
+            continue
+          manifest.record(outPath, inputs, landmarkParams)
+        tracked.append(outPath)
+
+    if "firstorder" in job["stages"]:
+      result["statistics"], errors = fs.subjectStatistics(job["firstorder"])
+      result["errors"].extend(errors)
+  except Exception as e:
+    result["errors"].append("{0}: {1}".format(type(e).__name__, e))
+
+  for output in tracked:
+    if output in manifest.outputs:
+      result["outputs"][output] = manifest.outputs[output]
+  result["files"] = dict((p, manifest.files[p]) for entry in
+      result["outputs"].values() for p in entry["inputs"]
+      if p in manifest.files)
+  result["cache"] = cacheStats()
+  result["pid"] = os.getpid()
+  return result
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Run pipeline stages " +
+      "subject by subject, decoding each input once")
+  parser.add_argument("--file", "-f", help = "CSV with filepaths",
+      required = True)
+  parser.add_argument("--stages", nargs = "+", default = None,
+      choices = stages, help = "Stages to run")
+  parser.add_argument("--landmarks", "-l", default = None,
+      help = "Landmark json file")
+  parser.add_argument("--manifest", "-m", default = None,
+      help = "Build manifest file")
+  parser.add_argument("--output", "-o", default = None,
+      help = "First-order statistics table")
+  parser.add_argument("--id", "-i", default = "BraTS18ID",
+      help = "Name of column with IDs")
+  parser.add_argument("--cache-mb", default = 2048, type = float,
+      help = "Total memory for decoded volumes, split into a separate " +
+      "cache of MB / workers in each worker process")
+  parser.add_argument("--spill", default = None,
+      help = "Directory to keep decoded volumes in as .npy files")
+  parser.add_argument("--workers", "-w", default = 1, type = int,
+      help = "Number of worker processes")
+  parser.add_argument("--trace", default = None,
+      help = "JSON lines file to append stage timing records to")
+  args = parser.parse_args()
+
+  enableTrace(args.trace, "subjectPipeline")
+  enableCache(args.cache_mb / max(1, args.workers), args.spill)
+  threads = max(1, multiprocessing.cpu_count() // max(1, args.workers))
+
+  if args.landmarks is None:
+    args.landmarks = ln.defaultLandmarksPath(args.file)
+  if args.manifest is None:
+    args.manifest = manifestPath(args.file)
+  if args.output is None:
+    args.output = os.path.splitext(args.file)[0] + "_firstorder.csv"
+  if args.stages is None:
+    args.stages = [s for s in stages if s != "landmarks" or
+                   os.path.isfile(args.landmarks)]
+  landmarks = None
+  if "landmarks" in args.stages:
+    landmarks = ln.loadLandmarks(args.landmarks)
+
+  # Paths in csv are relative to its directory
+  directory = os.path.dirname(args.file)
+  paths = pd.read_csv(args.file)
+  options = argparse.Namespace(id = args.id, n4 = False, n4_shrink = 1,
+      n4_levels = 4, n4_iterations = 50, bias_field = False,
+      compression = "gzip", threads = threads, pad = 4)
+  maps = [pair for pair in fs.labelMaps if pair[0] in paths]
+  ids = [col for col in [args.id, "type"] if col in paths]
+
+  jobs = []
+  for i in range(len(paths.index)):
+    jobs.append({"id": paths[args.id].iloc[i], "directory": directory,
+        "row": paths.iloc[i].to_dict(), "stages": args.stages,
+        "preprocess": dp.subjectJobs(paths, i, directory, options),
+        "landmarks": landmarks, "landmarksFile": args.landmarks,
+        "firstorder": fs.subjectJob(paths, i, directory, ids, maps)})
+  print("Running {0} for {1} subjects with {2} worker(s)...".format(
+      " ".join(args.stages), len(jobs), args.workers))
+
+  if args.workers > 1:
+    pool = multiprocessing.Pool(args.workers, initializer = initWorker,
+        initargs = (args.manifest, threads))
+    results = pool.imap_unordered(runSubject, jobs)
+  else:
+    initWorker(args.manifest, threads)
+    pool = None
+    results = map(runSubject, jobs)
+
+  manifest = BuildManifest(args.manifest)
+  rows = []
+  failed = 0
+  cache = {}
+  for n, result in enumerate(results):
+    manifest.files.update(result["files"])
+    manifest.outputs.update(result["outputs"])
+    if result["statistics"] is not None:
+      rows.append(result["statistics"])
+    for error in result["errors"]:
+      print("  Error: {0} {1}".format(result["job"]["id"], error))
+    failed += bool(result["errors"])
+    # Cache statistics are running totals per worker process
+    cache[result["pid"]] = result["cache"]
+    print("  [{0}/{1}] {2}".format(n + 1, len(jobs), result["job"]["id"]))
+    manifest.save()
+  if pool is not None:
+    pool.close()
+    pool.join()
+
+  if "firstorder" in args.stages and rows:
+    from featureStore import writeTable
+    table = pd.DataFrame(rows)
+    table = table[ids + sorted(c for c in table.columns if c not in ids)]
+    writeTable(table, args.output)
+    print("{0} cases written to {1}".format(len(table.index), args.output))
+  # No cache statistics if the csv had no subjects
+  if cache:
+    totals = pd.DataFrame(list(cache.values())).sum()
+    print("Volume cache: {0} decoded, {1} from spill, {2} from memory".format(
+        totals["misses"], totals["spill_hits"], totals["hits"]))
+  if failed:
+    sys.exit("{0} subjects had errors".format(failed))
@@ -0,0 +1,182 @@
+#
+#  Creates a synthetic BraTS shaped cohort for timing and regression tests
+#
+#  Writes the directory structure createFilePaths.py assumes:
+#    .
+#    +-- ids.csv                # BraTS18ID and type of every subject
+#    +-- HGG
+#    |   +-- ID                 # e.g. Synth_HGG_0001
+#    |   |  +-- ID_t1.nii.gz    # T1, T2, T1C and FLAIR images
+#    |   |  +-- ID_t2.nii.gz
+#    |   |  +-- ID_t1ce.nii.gz
+#    |   |  +-- ID_flair.nii.gz
+#    |   |  +-- ID_seg.nii.gz   # labels 1 (necrosis), 2 (edema), 4 (enhancing)
+#    +-- LGG
+#    ...
+#  Each subject has an ellipsoid brain with a smooth gray/white pattern and a
+#  nested spherical tumor at a random position, with modality specific int16
+#  intensities and noise. Subjects are generated from --seed so the same
+#  arguments always give the same cohort.
+#
+#  Usage:
+#    $ python syntheticCohort.py -o cohortdir -n 20
+#
+#    Optional command line args
+#      --subjects, -n [N]     Number of subjects (default = 10)
+#      --shape [X Y Z]        Image size (default = 240 240 155, as BraTS)
+#      --lgg [0,1]            Fraction of LGG subjects (default = 0.25)
+#      --seed [N]             Seed (default = 0)
+#      --radiomics [N]        Also write radiomics.csv, a pyradiomics
+#                               output table of N features per mask/label
+#                               for pyradiomics_to_short.py (default = 0)
+#      --workers, -w [N]      Number of worker processes (default = 1)
+
+import argparse, os
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+# Modality file suffix, mean intensity in [white matter, gray matter, csf,
+# necrosis, edema, enhancing tumor]
+modalities = [
+    ["t1", [700, 500, 200, 250, 400, 550]],
+    ["t2", [300, 450, 1200, 1000, 900, 700]],
+    ["t1ce", [700, 500, 200, 250, 400, 1100]],
+    ["flair", [350, 450, 150, 500, 900, 700]]
+  ]
+segLabels = [1, 2, 4]
+noise = 0.05
+
+
+def subjectIDs(count, lggFraction):
+  # [ID, type] of each subject
+  nLGG = int(round(count * lggFraction))
+  types = ["HGG"] * (count - nLGG) + ["LGG"] * nLGG
+  return [["Synth_{0}_{1:04d}".format(t, i), t] for i, t in enumerate(types)]
+
+
+def makeSubject(job):
+  # Write the images and seg of one subject. Returns list of files written
+  import SimpleITK as sitk
+  rng = np.random.default_rng(job["seed"])
+  nx, ny, nz = job["shape"]
+  z, y, x = np.ogrid[0:nz, 0:ny, 0:nx]
+  center = np.array([nz, ny, nx]) / 2.0
+  radii = np.array([nz, ny, nx]) * rng.uniform(0.36, 0.42, 3)
+  r = np.sqrt(((z - center[0]) / radii[0]) ** 2 +
+              ((y - center[1]) / radii[1]) ** 2 +
+              ((x - center[2]) / radii[2]) ** 2)
+  brain = r < 1
+
+  # Tissue: csf at the border and ventricles, gray/white folding pattern
+  folds = np.sin(x * 0.21 + rng.uniform(0, 6)) * np.sin(y * 0.17) * \
+      np.sin(z * 0.23 + rng.uniform(0, 6))
+  tissue = np.where(folds > 0.2, 1, 0).astype(np.uint8)
+  tissue[(r > 0.92) | (r < 0.18)] = 2
+
+  # Tumor: enhancing shell around a necrotic core inside edema. LGG tumors
+  # are smaller and mostly edema
+  scale = min(nx, ny, nz)
+  size = scale * (rng.uniform(0.08, 0.16) if job["type"] == "HGG" else
+                  rng.uniform(0.05, 0.1))
+  offset = rng.uniform(-0.35, 0.35, 3) * radii
+  d = np.sqrt((z - center[0] - offset[0]) ** 2 +
+              (y - center[1] - offset[1]) ** 2 +
+              (x - center[2] - offset[2]) ** 2)
+  seg = np.zeros(brain.shape, np.uint8)
+  seg[d < size * 1.8] = 2
+  if job["type"] == "HGG":
+    seg[d < size] = 4
+    seg[d < size * 0.55] = 1
+  else:
+    seg[d < size * 0.4] = 1
+  seg[~brain] = 0
+
+  classes = np.where(seg == 0, tissue, np.searchsorted(segLabels, seg) + 3)
+  path = os.path.join(job["directory"], job["type"], job["id"])
+  if not os.path.isdir(path):
+    os.makedirs(path)
+  written = []
+  for suffix, means in modalities:
+    means = np.array(means, np.float32) * rng.uniform(0.9, 1.1)
+    arr = means[classes] * (1 + noise * rng.standard_normal(
+        classes.shape, np.float32))
+    arr[~brain] = 0
+    img = sitk.GetImageFromArray(np.clip(arr, 0, 32767).astype(np.int16))
+    filePath = os.path.join(path, job["id"] + "_" + suffix + ".nii.gz")
+    sitk.WriteImage(img, filePath)
+    written.append(filePath)
+  filePath = os.path.join(path, job["id"] + "_seg.nii.gz")
+  sitk.WriteImage(sitk.GetImageFromArray(seg), filePath)
+  written.append(filePath)
+  return written
+
+
+def syntheticRadiomics(subjects, features, seed = 0):
+  # Long pyradiomics output table (one row per image/mask/label) in the
+  # format of extract_pyradiomics.py, for the short matrix reshape
+  rng = np.random.default_rng(seed)
+  masks = [["seg", segLabels], ["atropos", [1, 2, 3]]]
+  names = ["original_firstorder_Feature{0}".format(i) for i in range(features)]
+  rows = []
+  for sid, t in subjects:
+    prefix = t + "/" + sid + "/" + sid + "_"
+    for suffix, means in modalities:
+      for mask, labels in masks:
+        for label in labels:
+          rows.append([sid, t, prefix + suffix + ".nii.gz",
+                       prefix + mask + ".nii.gz", label])
+  table = pd.DataFrame(rows, columns = ["BraTS18ID", "type", "Image", "Mask",
+                                        "Label"])
+  values = pd.DataFrame(rng.standard_normal((len(rows), features)),
+                        columns = names)
+  return pd.concat([table, values], axis = 1)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Create a synthetic " +
+      "BraTS shaped cohort")
+  parser.add_argument("--output", "-o", required = True,
+      help = "Directory to create the cohort in")
+  parser.add_argument("--subjects", "-n", default = 10, type = int,
+      help = "Number of subjects")
+  parser.add_argument("--shape", nargs = 3, default = [240, 240, 155],
+      type = int, help = "Image size x y z")
+  parser.add_argument("--lgg", default = 0.25, type = float,
+      help = "Fraction of LGG subjects")
+  parser.add_argument("--seed", default = 0, type = int,
+      help = "Seed")
+  parser.add_argument("--radiomics", default = 0, type = int,
+      help = "Features per mask/label in a synthetic radiomics.csv")
+  parser.add_argument("--workers", "-w", default = 1, type = int,
+      help = "Number of worker processes")
+  args = parser.parse_args()
+
+  subjects = subjectIDs(args.subjects, args.lgg)
+  jobs = [{"id": sid, "type": t, "directory": args.output,
+           "shape": args.shape, "seed": [args.seed, i]}
+          for i, (sid, t) in enumerate(subjects)]
+
+  if args.workers > 1:
+    pool = multiprocessing.Pool(args.workers)
+    results = pool.imap_unordered(makeSubject, jobs)
+  else:
+    pool = None
+    results = map(makeSubject, jobs)
+  for n, written in enumerate(results):
+    print("  [{0}/{1}] {2}".format(n + 1, len(jobs),
+        os.path.dirname(written[0])))
+  if pool is not None:
+    pool.close()
+    pool.join()
+
+  idFile = os.path.join(args.output, "ids.csv")
+  pd.DataFrame(subjects, columns = ["BraTS18ID", "type"]).to_csv(idFile,
+      index = False)
+  print("{0} subjects written to {1}".format(len(subjects), args.output))
+
+  if args.radiomics > 0:
+    radiomicsFile = os.path.join(args.output, "radiomics.csv")
+    syntheticRadiomics(subjects, args.radiomics, args.seed).to_csv(
+        radiomicsFile, index = False)
+    print("Radiomics table written to {0}".format(radiomicsFile))
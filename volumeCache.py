@@ -0,0 +1,165 @@
+#
+#  Shared cache of decoded volumes
+#
+#  readImage(path) is a drop in for sitk.ReadImage used by the pipeline
+#  stages. When the cache is enabled, decoded images are kept in memory in
+#  a least recently used cache with a byte budget, so stages run one after
+#  another on a subject (see subjectPipeline.py) decode each file once.
+#  With a spill directory every decoded volume is also saved uncompressed
+#  (ID.npy voxels + ID.json geometry). Later reads, also by other processes
+#  and later runs, load it with a memory map instead of decoding the gzip
+#  again. Entries are keyed by path, modification time and size, so a
+#  changed file is never served from the cache.
+#
+#  The cache is enabled with enableCache (or the VOLUME_CACHE_MB and
+#  VOLUME_CACHE_SPILL environment variables), so pool workers get their
+#  own cache with the same settings. Without it readImage is sitk.ReadImage.
+#
+#  In python:
+#    enableCache(4096, "/scratch/spill")
+#    img = readImage("HGG/ID/ID_t1.nii.gz")
+#    cacheStats()
+
+import hashlib, json, os, threading
+from collections import OrderedDict
+import numpy as np
+import SimpleITK as sitk
+
+budgetVariable = "VOLUME_CACHE_MB"
+spillVariable = "VOLUME_CACHE_SPILL"
+
+
+def fileKey(path):
+  # (absolute path, mtime, size) of a file
+  st = os.stat(path)
+  return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+def imageBytes(img):
+  return sitk.GetArrayViewFromImage(img).nbytes
+
+
+class VolumeCache:
+
+  def __init__(self, maxBytes, spillDir = None):
+    self.maxBytes = maxBytes
+    self.spillDir = spillDir
+    self.images = OrderedDict()
+    self.bytes = 0
+    self.stats = {"hits": 0, "spill_hits": 0, "misses": 0, "evictions": 0}
+    self.lock = threading.Lock()
+    if spillDir is not None and not os.path.isdir(spillDir):
+      os.makedirs(spillDir, exist_ok = True)
+
+  def spillPath(self, key):
+    name = hashlib.sha1(repr(key).encode()).hexdigest()
+    return os.path.join(self.spillDir, name)
+
+  def readSpill(self, key):
+    # Image from the spill directory, or None
+    base = self.spillPath(key)
+    if not os.path.isfile(base + ".json"):
+      return None
+    with open(base + ".json", "r") as f:
+      geometry = json.load(f)
+    arr = np.load(base + ".npy", mmap_mode = "r")
+    img = sitk.GetImageFromArray(arr, isVector = geometry["vector"])
+    img.SetSpacing(geometry["spacing"])
+    img.SetOrigin(geometry["origin"])
+    img.SetDirection(geometry["direction"])
+    return img
+
+  def writeSpill(self, key, img):
+    # Voxels first, then the json that marks the entry complete
+    base = self.spillPath(key)
+    tmp = "{0}.{1}.{2}.tmp".format(base, os.getpid(), threading.get_ident())
+    np.save(tmp + ".npy", sitk.GetArrayViewFromImage(img))
+    os.replace(tmp + ".npy", base + ".npy")
+    with open(tmp + ".json", "w") as f:
+      json.dump({"path": key[0], "spacing": img.GetSpacing(),
+                 "origin": img.GetOrigin(), "direction": img.GetDirection(),
+                 "vector": img.GetNumberOfComponentsPerPixel() > 1}, f)
+    os.replace(tmp + ".json", base + ".json")
+
+  def store(self, key, img):
+    size = imageBytes(img)
+    if size > self.maxBytes:
+      return
+    with self.lock:
+      if key in self.images:
+        return
+      self.images[key] = img
+      self.bytes += size
+      while self.bytes > self.maxBytes:
+        oldKey, old = self.images.popitem(last = False)
+        self.bytes -= imageBytes(old)
+        self.stats["evictions"] += 1
+
+  def read(self, path):
+    key = fileKey(path)
+    with self.lock:
+      if key in self.images:
+        self.images.move_to_end(key)
+        self.stats["hits"] += 1
+        # Copy on write, callers can not change the cached image
+        return sitk.Image(self.images[key])
+    img = None
+    if self.spillDir is not None:
+      img = self.readSpill(key)
+      if img is not None:
+        self.stats["spill_hits"] += 1
+    if img is None:
+      self.stats["misses"] += 1
+      img = sitk.ReadImage(path)
+      if self.spillDir is not None:
+        self.writeSpill(key, img)
+    self.store(key, img)
+    return sitk.Image(img)
+
+  def written(self, path, img):
+    # Add an image just written to path, so later stages reading it do not
+    # decode it again
+    self.store(fileKey(path), sitk.Image(img))
+
+
+cache = None
+
+
+def enableCache(megabytes, spillDir = None):
+  # Enable the cache in this process and in worker processes started after
+  global cache
+  os.environ[budgetVariable] = str(megabytes)
+  if spillDir is not None:
+    os.environ[spillVariable] = os.path.abspath(spillDir)
+  cache = None
+  return currentCache()
+
+
+def currentCache():
+  # The process' cache, created from the environment, or None
+  global cache
+  if cache is None and os.environ.get(budgetVariable):
+    cache = VolumeCache(int(float(os.environ[budgetVariable]) * 2 ** 20),
+                        os.environ.get(spillVariable))
+  return cache
+
+
+def readImage(path):
+  current = currentCache()
+  if current is None:
+    return sitk.ReadImage(path)
+  return current.read(path)
+
+
+def imageWritten(path, img):
+  current = currentCache()
+  if current is not None:
+    current.written(path, img)
+
+
+def cacheStats():
+  current = currentCache()
+  if current is None:
+    return None
+  return dict(current.stats, bytes = current.bytes,
+              images = len(current.images))